@@ -0,0 +1,36 @@
+<?php
+
+/**
+ * Move old audit trail rows out of the live LibraryAudit table.
+ *
+ * Run from the api directory, giving the date before which rows should
+ * be archived. The rows go to the LibraryAuditArchive table unless the
+ * path to a file is also given, in which case they are appended to that
+ * file as JSON lines.
+ *
+ *   php archive-audit.php 2023-01-01
+ *   php archive-audit.php 2023-01-01 /var/backups/audit-2022.jsonl
+ */
+
+require 'utilities.php';
+require 'audit.php';
+
+use MusicLibrary\Audit\Trail;
+use MusicLibrary\Utilities\Session;
+
+$before = $argv[1] ?? '';
+if (!preg_match('/^\d{4}-\d\d-\d\d$/', $before)) {
+  fwrite(STDERR, "usage: php archive-audit.php YYYY-MM-DD [FILE]\n");
+  exit(1);
+}
+$db = Session::connect_to_database();
+$db->beginTransaction();
+try {
+  $count = Trail::archive($db, $before, $argv[2] ?? null);
+  $db->commit();
+  echo "Archived $count audit rows from before $before.\n";
+} catch (Exception $e) {
+  $db->rollBack();
+  fwrite(STDERR, $e->getMessage() . "\n");
+  exit(1);
+}
@@ -0,0 +1,171 @@
+<?php
+
+/**
+ * Access to the audit trail of changes to the catalog.
+ *
+ * The trail is read newest first, a page at a time, seeking past the
+ * (AuditWhen, AuditID) key of the last row of the previous page, so
+ * that the cost of a page doesn't grow with the size of the table.
+ */
+
+namespace MusicLibrary\Audit;
+
+class Trail {
+
+  const DEFAULT_LIMIT = 100;
+  const MAX_LIMIT = 1000;
+
+  public $session;
+
+  public function __construct($session) {
+    $this->session = $session;
+  }
+
+  // Move rows older than a cutoff date out of the live audit table.
+  //
+  // The rows go to the LibraryAuditArchive table, or, if a path is
+  // given, are appended to that file (one JSON object per line). The
+  // newest row is always kept, because the catalog version used to key
+  // the caches is the highest AuditID, and it must never go backwards.
+  // Returns the number of rows moved.
+  public static function archive($db, $before, $path = null) {
+    $newest = $db->query('SELECT MAX(AuditID) FROM LibraryAudit')->fetchColumn();
+    if ($newest === null || $newest === false) {
+      return 0;
+    }
+    $values = [$before, $newest];
+    if (empty($path)) {
+      $stmt = $db->prepare('
+        INSERT INTO LibraryAuditArchive
+             SELECT * FROM LibraryAudit WHERE AuditWhen < ? AND AuditID < ?
+      ');
+      $stmt->execute($values);
+      $count = $stmt->rowCount();
+    } else {
+      $fp = fopen($path, 'a');
+      if ($fp === false) {
+        throw new \Exception("unable to open $path");
+      }
+      $stmt = $db->prepare('
+        SELECT * FROM LibraryAudit
+         WHERE AuditWhen < ? AND AuditID < ?
+      ORDER BY AuditWhen, AuditID
+      ');
+      $stmt->execute($values);
+      $count = 0;
+      while ($row = $stmt->fetch(\PDO::FETCH_ASSOC)) {
+        fwrite($fp, json_encode($row) . "\n");
+        $count++;
+      }
+      fclose($fp);
+    }
+    $sql = 'DELETE FROM LibraryAudit WHERE AuditWhen < ? AND AuditID < ?';
+    $db->prepare($sql)->execute($values);
+    return $count;
+  }
+
+  // Fetch a page of the audit trail, optionally filtered.
+  //
+  // Filters are `who`, `table`, `action` (matching the start of the
+  // action), and a `from`/`to` date range (inclusive, given as
+  // YYYY-MM-DD). Pass the `next` value from one page as `after` to get
+  // the following page.
+  public function get() {
+    $this->session->verify_is_admin();
+    $dates = [];
+    foreach (['from', 'to'] as $name) {
+      if (!empty($_GET[$name])) {
+        $dates[$name] = self::parse_date($_GET[$name]);
+        if ($dates[$name] === null) {
+          http_response_code(400);
+          $error = "$name must be a date in the form YYYY-MM-DD";
+          error_log($error);
+          return ['status' => 'failure', 'message' => $error];
+        }
+      }
+    }
+    $conditions = [];
+    $values = [];
+    if (!empty($_GET['who'])) {
+      $conditions[] = 'AuditWho = ?';
+      $values[] = $_GET['who'];
+    }
+    if (!empty($_GET['table'])) {
+      $conditions[] = 'AuditTable = ?';
+      $values[] = $_GET['table'];
+    }
+    if (!empty($_GET['action'])) {
+      $conditions[] = 'AuditAction LIKE ?';
+      $values[] = str_replace(['%', '_'], '', $_GET['action']) . '%';
+    }
+    if (!empty($dates['from'])) {
+      $conditions[] = 'AuditWhen >= ?';
+      $values[] = $dates['from']->format('Y-m-d');
+    }
+    if (!empty($dates['to'])) {
+      $conditions[] = 'AuditWhen < ?';
+      $values[] = $dates['to']->modify('+1 day')->format('Y-m-d');
+    }
+    $cursor = self::decode_cursor($_GET['after'] ?? '');
+    if ($cursor !== null) {
+      $conditions[] = '(AuditWhen < ? OR (AuditWhen = ? AND AuditID < ?))';
+      array_push($values, $cursor[0], $cursor[0], $cursor[1]);
+    }
+    $where = '';
+    if (count($conditions) > 0) {
+      $where = 'WHERE ' . implode(' AND ', $conditions);
+    }
+    $limit = (int) ($_GET['limit'] ?? self::DEFAULT_LIMIT);
+    $limit = max(1, min($limit, self::MAX_LIMIT));
+    $sql = "
+        SELECT * FROM LibraryAudit $where
+      ORDER BY AuditWhen DESC, AuditID DESC
+         LIMIT $limit
+    ";
+    $this->session->debug_log($sql);
+    $rows = $this->session->cursor($sql, $values);
+
+    // The rows are streamed to the client as they're fetched, so the
+    // cursor for the next page is worked out once they've all been sent.
+    $count = 0;
+    $last = null;
+    $track = function() use ($rows, &$count, &$last) {
+      foreach ($rows as $last) {
+        $count++;
+        yield $last;
+      }
+    };
+    $next = function() use (&$count, &$last, $limit) {
+      if ($count < $limit) {
+        return null;
+      }
+      return self::encode_cursor([$last['AuditWhen'], $last['AuditID']]);
+    };
+    return ['status' => 'success', 'rows' => $track(), 'next' => $next];
+  }
+
+  // Unpack the (AuditWhen, AuditID) key carried by a cursor.
+  private static function decode_cursor($cursor) {
+    if ($cursor === '') {
+      return null;
+    }
+    $json = base64_decode(strtr($cursor, '-_', '+/'), true);
+    $key = $json === false ? null : json_decode($json);
+    return is_array($key) && count($key) === 2 ? $key : null;
+  }
+
+  // Wrap a row's key so the client can treat it as an opaque token.
+  private static function encode_cursor($key) {
+    return rtrim(strtr(base64_encode(json_encode($key)), '+/', '-_'), '=');
+  }
+
+  // Convert a YYYY-MM-DD date (null if it isn't a real date).
+  private static function parse_date($value) {
+    $date = \DateTimeImmutable::createFromFormat('!Y-m-d', $value);
+    if ($date === false || $date->format('Y-m-d') !== $value) {
+      return null;
+    }
+    return $date;
+  }
+
+}
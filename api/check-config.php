@@ -0,0 +1,50 @@
+<?php
+
+/**
+ * Validate the JSON configuration files.
+ *
+ * The web application compiles each configuration file to PHP (and
+ * recompiles it whenever it changes), so a mistake in one of the files
+ * breaks every request. Run this after editing them (from the api
+ * directory) to catch such mistakes before the users do.
+ *
+ *   php check-config.php
+ */
+
+require 'utilities.php';
+
+use MusicLibrary\Utilities\Config;
+use MusicLibrary\Utilities\Session;
+
+$files = [
+  Session::CONFIG => [
+    'columns',
+    'lookup_tables',
+    'multiple-links',
+    'multiple-subrecords',
+    'record_types',
+    'report_columns',
+    'tables',
+  ],
+  __DIR__ . '/../config.json' => [
+    'fieldsets',
+    'lookup_tables',
+    'report',
+  ],
+];
+
+$errors = 0;
+foreach ($files as $path => $required) {
+  try {
+    $values = Config::validate($path);
+    $missing = array_diff($required, array_keys($values));
+    if (!empty($missing)) {
+      throw new Exception('missing ' . implode(', ', $missing));
+    }
+    echo "$path: OK\n";
+  } catch (Exception $e) {
+    fwrite(STDERR, "$path: {$e->getMessage()}\n");
+    $errors++;
+  }
+}
+exit($errors ? 1 : 0);
@@ -4,7 +4,7 @@
  * Top-level routing for the music library API.
  */
 
-require 'utilities.php';
+require_once 'utilities.php';
 
 // Ensure consistent locale
 setlocale(LC_ALL, 'en_US.UTF-8');
@@ -14,23 +14,23 @@ switch ($session->method) {
 
 case 'GET':
 
-  // Fetch records.
+  // Fetch records (from the read-only replica, where that's safe).
   switch ($session->endpoint) {
 
   case 'account':
-    require 'users.php';
+    require_once 'users.php';
     $session->reply((new \MusicLibrary\Users\User($session))->get());
     break;
 
   case 'audit':
-    $session->verify_is_admin();
-    $query = 'SELECT * FROM LibraryAudit ORDER BY AuditWhen DESC';
-    $session->reply($session->select($query));
+    require_once 'audit.php';
+    $session->reply((new \MusicLibrary\Audit\Trail($session))->get());
     break;
 
   case 'music':
   case 'item':  // alias
-    require 'items.php';
+    require_once 'items.php';
+    $session->use_replica();
     $session->reply((new \MusicLibrary\Items\Item($session))->get());
     break;
 
@@ -38,13 +38,21 @@ case 'GET':
     $session->reply($session->check_maintenance_mode());
     break;
 
+  case 'picklists':
+    require_once 'tables.php';
+    $session->use_replica();
+    $session->reply((new \MusicLibrary\Lookup\Tables($session))->bundle());
+    break;
+
   case 'print':
-    require 'print.php';
+    require_once 'print.php';
+    $session->use_replica();
     $session->reply((new \MusicLibrary\Print\Job($session))->get());
     break;
 
   case 'report':
-    require 'reports.php';
+    require_once 'reports.php';
+    $session->use_replica();
     $session->reply((new \MusicLibrary\Reports\Report($session))->get());
     break;
 
@@ -53,7 +61,10 @@ case 'GET':
     break;
 
   default:
-    require 'tables.php';
+    require_once 'tables.php';
+    if (empty($session->record_id)) {
+      $session->use_replica();
+    }
     $session->reply((new \MusicLibrary\Lookup\Tables($session))->get());
     break;
   }
@@ -66,18 +77,23 @@ case 'POST':
   switch ($session->endpoint) {
 
   case 'account':
-    require 'users.php';
+    require_once 'users.php';
     $session->reply((new \MusicLibrary\Users\User($session))->post());
     break;
 
+  case 'import':
+    require_once 'items.php';
+    $session->reply((new \MusicLibrary\Items\Item($session))->import());
+    break;
+
   case 'music':
   case 'item':  // alias
-    require 'items.php';
+    require_once 'items.php';
     $session->reply((new \MusicLibrary\Items\Item($session))->post());
     break;
 
   case 'report':
-    require 'reports.php';
+    require_once 'reports.php';
     $session->reply((new \MusicLibrary\Reports\Report($session))->post());
     break;
 
@@ -86,7 +102,7 @@ case 'POST':
     break;
 
   default:
-    require 'tables.php';
+    require_once 'tables.php';
     $session->reply((new \MusicLibrary\Lookup\Tables($session))->post());
     break;
   }
@@ -99,18 +115,18 @@ case 'PUT':
   switch ($session->endpoint) {
 
   case 'account':
-    require 'users.php';
+    require_once 'users.php';
     $session->reply((new \MusicLibrary\Users\User($session))->put());
     break;
 
   case 'music':
   case 'item':  // alias
-    require 'items.php';
+    require_once 'items.php';
     $session->reply((new \MusicLibrary\Items\Item($session))->put());
     break;
 
   default:
-    require 'tables.php';
+    require_once 'tables.php';
     $session->reply((new \MusicLibrary\Lookup\Tables($session))->put());
     break;
   }
@@ -123,13 +139,13 @@ case 'DELETE':
   switch ($session->endpoint) {
 
   case 'account':  // used for testing; don't expose in the front end
-    require 'users.php';
+    require_once 'users.php';
     $session->reply((new \MusicLibrary\Users\User($session))->delete());
     break;
 
   case 'music':
   case 'item':  // alias
-    require 'items.php';
+    require_once 'items.php';
     $session->reply((new \MusicLibrary\Items\Item($session))->delete());
     break;
 
@@ -138,7 +154,7 @@ case 'DELETE':
     break;
 
   default:
-    require 'tables.php';
+    require_once 'tables.php';
     $session->reply((new \MusicLibrary\Lookup\Tables($session))->delete());
     break;
   }
@@ -2,9 +2,18 @@
 
 namespace MusicLibrary\Items;
 
+require_once 'search.php';
+require_once 'summary.php';
+
+use MusicLibrary\Search\Index;
+use MusicLibrary\Summary\ItemSummary;
+
 class Item {
 
-  const MULTIPLES = ['Performance', 'Inventory', 'Part', 'Loan'];
+  const BATCH_SIZE = 500;
+  const IMPORT_CHUNK_SIZE = 250;
+  const INSERT_PARAMETER_LIMIT = 5000;
+  const MAX_RECORDS = 1000;
 
   public $session;
 
@@ -21,29 +30,30 @@ class Item {
       http_response_code(400);
       return ['status' => 'failure', 'message' => 'missing record ID'];
     }
-    $this->session->db->beginTransaction();
-    try {
+    $delete = function() use ($record_id) {
+      $collection_id = $this->get_collection_id($record_id);
       foreach (['multiple-links', 'multiple-subrecords'] as $group) {
         foreach ($this->session->config[$group] as $field) {
           $table = $field['table'];
           $sql = "DELETE FROM $table WHERE LibraryItem = ?";
-          $stmt = $this->session->db->prepare($sql);
-          $stmt->execute([$record_id]);
+          $this->session->execute($sql, [$record_id]);
         }
       }
       $query = "DELETE FROM LibraryItem WHERE ItemID = ?";
-      $stmt = $this->session->db->prepare($query);
-      $stmt->execute([$record_id]);
-      $stmt = $this->session->db->prepare("
+      $this->session->execute($query, [$record_id]);
+      (new Index($this->session->db))->remove($record_id);
+      (new ItemSummary($this->session->db))->remove($record_id);
+      $this->adjust_member_count($collection_id, -1);
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'DELETE', 'LibraryItem', ?)
-      ");
-      $stmt->execute([$this->session->user->name, $this->session->localtime, $record_id]);
-      $this->session->db->commit();
+      ", [$this->session->user->name, $this->session->localtime, $record_id]);
+    };
+    try {
+      $this->session->transaction($delete);
       return ['status' => 'success'];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -51,30 +61,108 @@ class Item {
     }
   }
 
-  // Get a single record.
+  // Get a single record (or several, with ?ids=1,2,3).
   public function get() {
-    if (empty($this->session->record_id))
+    if (empty($this->session->record_id)) {
+      if (isset($_GET['ids']))
+        return $this->get_records();
       return $this->list();
+    }
     $id = $this->session->record_id;
-    $sql = "SELECT * FROM LibraryItem WHERE ItemID = ?";
-    $record = $this->session->select($sql, [$id], 'row');
-    $sql = 'SELECT LibraryKeyword FROM LibraryItemKeyword WHERE LibraryItem = ?';
-    $record['Keywords'] = $this->session->select($sql, [$id], 'column');
-    $sql = 'SELECT LibraryTag FROM LibraryItemTag WHERE LibraryItem = ?';
-    $record['Tags'] = $this->session->select($sql, [$id], 'column');
-    foreach (self::MULTIPLES as $name) {
-      $plural = $name === 'Inventory' ? 'Inventories' : "{$name}s";
-      $sql = "
-          SELECT *
-            FROM Library{$name}
-           WHERE LibraryItem = ?
-        ORDER BY 1
-        ";
-      $record[$plural] = $this->session->select($sql, [$id]);
+    $records = $this->load_records([(int)$id]);
+    if (empty($records)) {
+      http_response_code(404);
+      $error = "item $id not found";
+      error_log($error);
+      return ['status' => 'failure', 'message' => $error];
     }
-    $sql = 'SELECT COUNT(*) FROM LibraryItem WHERE CollectionID = ?';
-    $record['used_by'] = $this->session->select($sql, [$id], 'value');
-    return $record;
+    return $records[0];
+  }
+
+  // Add many new records at once.
+  //
+  // The request body is either a JSON array of items or NDJSON (one
+  // item per line), each in the shape used for POSTing a single item.
+  // Items are inserted in chunks, each in its own transaction with a
+  // single summary audit row, and rows which can't be imported are
+  // reported individually, without stopping the rest of the import.
+  // If a chunk fails, its rows are retried one at a time, so only the
+  // rows which are actually at fault are reported.
+  public function import() {
+    $this->session->verify_is_admin();
+    $started = microtime(true);
+    $errors = [];
+    $rows = [];
+    foreach ($this->load_import_rows() as $number => $item) {
+      if (is_string($item)) {
+        $errors[] = ['row' => $number, 'error' => $item];
+      } elseif (empty(trim($item['ItemTitle'] ?? ''))) {
+        $errors[] = ['row' => $number, 'error' => 'missing ItemTitle'];
+      } else {
+        $rows[$number] = $item;
+      }
+    }
+
+    // Resolve all of the people the items refer to in one pass.
+    $person_ids = [];
+    foreach ($rows as $item) {
+      foreach (['ComposerID', 'LyricistID', 'ArrangerID'] as $name) {
+        $person_ids[] = $item[$name] ?? null;
+      }
+    }
+    $persons = $this->load_persons($person_ids);
+    foreach ($rows as $number => $item) {
+      foreach (['ComposerID', 'LyricistID', 'ArrangerID'] as $name) {
+        $id = $item[$name] ?? null;
+        if (!empty($id) && !array_key_exists($id, $persons)) {
+          $errors[] = ['row' => $number, 'error' => "unknown $name $id"];
+          unset($rows[$number]);
+          break;
+        }
+      }
+    }
+
+    // Insert the items a chunk at a time.
+    $ids = [];
+    foreach (array_chunk($rows, self::IMPORT_CHUNK_SIZE, true) as $chunk) {
+      try {
+        $chunk_ids = $this->session->transaction(
+          fn() => $this->import_chunk($chunk, $persons)
+        );
+        array_push($ids, ...$chunk_ids);
+      } catch (\Exception $e) {
+        error_log($e->getMessage());
+        foreach ($chunk as $number => $item) {
+          try {
+            $item_ids = $this->session->transaction(
+              fn() => $this->import_chunk([$number => $item], $persons)
+            );
+            array_push($ids, ...$item_ids);
+          } catch (\Exception $e) {
+            $message = $e->getMessage();
+            error_log("import row $number: $message");
+            $errors[] = ['row' => $number, 'error' => $message];
+          }
+        }
+      }
+    }
+    usort($errors, fn($a, $b) => $a['row'] <=> $b['row']);
+    $elapsed = microtime(true) - $started;
+    $rate = $elapsed > 0 ? round(count($ids) / $elapsed, 1) : null;
+    $this->session->debug_log('imported ' . count($ids) . " items ($rate/sec)");
+    http_response_code(empty($ids) && !empty($errors) ? 400 : 201);
+    $status = 'success';
+    if (!empty($errors)) {
+      $status = empty($ids) ? 'failure' : 'partial';
+    }
+    return [
+      'status' => $status,
+      'imported' => count($ids),
+      'ids' => $ids,
+      'errors' => $errors,
+      'elapsed' => $elapsed,
+      'items_per_second' => $rate,
+    ];
   }
 
   // Create a new record.
@@ -105,25 +193,27 @@ class Item {
     $sql = "INSERT INTO LibraryItem ($columns) VALUES ($placeholders)";
     $this->session->debug_log($sql);
     $this->session->debug_log(json_encode($values));
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare($sql);
-      $stmt->execute($values);
+    $person_ids = [$data['ComposerID'] ?? null, $data['ArrangerID'] ?? null];
+    $persons = $this->load_persons($person_ids);
+    $save = function() use ($sql, $values, $data, $persons) {
+      $this->session->execute($sql, $values);
       $item_id = $this->session->db->lastInsertId();
-      $this->finish_item_save($data, $item_id);
-      $stmt = $this->session->db->prepare("
+      $this->finish_item_save($data, $item_id, $persons);
+      $this->adjust_member_count($this->get_collection_id($item_id), 1);
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'INSERT', 'LibraryItem', ?)
-      ");
-      $stmt->execute([$this->session->user->name, $this->session->localtime, $item_id]);
-      $this->session->db->commit();
+      ", [$this->session->user->name, $this->session->localtime, $item_id]);
+      return $item_id;
+    };
+    try {
+      $item_id = $this->session->transaction($save);
       http_response_code(201);
       return ['status' => 'success', 'ItemID' => $item_id];
     } catch (\Exception $e) {
       $message = $e->getMessage();
       error_log($message);
-      $this->session->db->rollback();
       http_response_code(500);
       return ['status' => 'failure', 'message' => $message];
     }
@@ -152,31 +242,27 @@ class Item {
     $sql = "UPDATE LibraryItem SET $assignments WHERE ItemID = ?";
     $this->session->debug_log($sql);
     $this->session->debug_log(json_encode($values));
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare($sql);
-      $stmt->execute($values);
-
-      // Start with a clean slate on related values.
-      foreach (['multiple-links', 'multiple-subrecords'] as $key) {
-        foreach ($this->session->config[$key] as $values) {
-          $table = $values['table'];
-          $sql = "DELETE FROM $table WHERE LibraryItem = ?";
-          $stmt = $this->session->db->prepare($sql);
-          $stmt->execute([$record_id]);
-        }
+    $person_ids = [$data['ComposerID'] ?? null, $data['ArrangerID'] ?? null];
+    $persons = $this->load_persons($person_ids);
+    $save = function() use ($sql, $values, $data, $persons, $record_id) {
+      $old_collection_id = $this->get_collection_id($record_id);
+      $this->session->execute($sql, $values);
+      $new_collection_id = $this->get_collection_id($record_id);
+      if ($new_collection_id != $old_collection_id) {
+        $this->adjust_member_count($old_collection_id, -1);
+        $this->adjust_member_count($new_collection_id, 1);
       }
-      $this->finish_item_save($data, $record_id);
-      $stmt = $this->session->db->prepare("
+      $this->finish_item_save($data, $record_id, $persons);
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'UPDATE', 'LibraryItem', ?)
-      ");
-      $stmt->execute([$this->session->user->name, $this->session->localtime, $record_id]);
-      $this->session->db->commit();
+      ", [$this->session->user->name, $this->session->localtime, $record_id]);
+    };
+    try {
+      $this->session->transaction($save);
       return ['status' => 'success'];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -184,10 +270,80 @@ class Item {
     }
   }
 
+  // Recalculate the number of member items for every collection.
+  public static function rebuild_member_counts($db) {
+    $db->exec('UPDATE LibraryItem SET MemberCount = 0');
+    if ($db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'sqlite') {
+      $db->exec('
+        UPDATE LibraryItem
+           SET MemberCount = (SELECT COUNT(*)
+                                FROM LibraryItem m
+                               WHERE m.CollectionID = LibraryItem.ItemID)
+      ');
+    } else {
+      $db->exec('
+        UPDATE LibraryItem i
+          JOIN (SELECT CollectionID, COUNT(*) AS n
+                  FROM LibraryItem
+                 WHERE CollectionID IS NOT NULL
+              GROUP BY CollectionID) m
+            ON m.CollectionID = i.ItemID
+           SET i.MemberCount = m.n
+      ');
+    }
+    $sql = 'SELECT COUNT(*) FROM LibraryItem WHERE MemberCount > 0';
+    return $db->query($sql)->fetchColumn();
+  }
+
+  // Keep a collection's count of its member items in step.
+  private function adjust_member_count($collection_id, $delta) {
+    if (!empty($collection_id)) {
+      $sql = 'UPDATE LibraryItem SET MemberCount = MemberCount + ? WHERE ItemID = ?';
+      $this->session->execute($sql, [$delta, $collection_id]);
+    }
+  }
+
+  // Create the sort keys for an item, given the names of its people.
+  //
+  // Without a row ID, the keys are built without the ID at the end (see
+  // finish_sort_keys()).
+  private static function build_sort_keys($rec, $row_id, $persons) {
+    $suffix = $row_id === null ? '' : sprintf('%06d', $row_id);
+    $sort_keys = [];
+    $title = $rec['ItemTitle'];
+    $composer = $persons[$rec['ComposerID'] ?? ''] ?? null;
+    $arranger = $persons[$rec['ArrangerID'] ?? ''] ?? null;
+    $last_name = $composer['LastName'] ?? '';
+    $first_name = $composer['FirstName'] ?? '';
+    $search_key = $composer['SearchKey'] ?? '';
+    $key = sprintf("%s\t%s\t%s\t%s", $title, $last_name, $first_name, $suffix);
+    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
+    $key = sprintf("%s\t%s\t%s", $search_key, $title, $suffix);
+    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
+    $search_key = $arranger['SearchKey'] ?? '';
+    $key = sprintf("%s\t%s\t%s", $search_key, $title, $suffix);
+    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
+    return $sort_keys;
+  }
+
+  // Unpack the sort key carried by a cursor (null if none was supplied).
+  private static function decode_cursor($cursor) {
+    if ($cursor === '') {
+      return null;
+    }
+    $key = base64_decode(strtr($cursor, '-_', '+/'), true);
+    return $key === false ? null : $key;
+  }
+
+  // Wrap a sort key so the client can treat it as an opaque token.
+  private static function encode_cursor($key) {
+    return rtrim(strtr(base64_encode($key), '+/', '-_'), '=');
+  }
+
   // Common code for saving new and modified catalog item records.
-  private function finish_item_save($data, $item_id) {
+  private function finish_item_save($data, $item_id, $persons) {
     $this->session->debug_log('finish_item_save() $item_id is ' . $item_id);
-    $values = $this->make_item_sort_keys($data, $item_id);
+    $values = self::build_sort_keys($data, $item_id, $persons);
     array_push($values, $item_id);
     $sql = '
       UPDATE LibraryItem
@@ -198,52 +354,186 @@ class Item {
     ';
     $this->session->debug_log($sql);
     $this->session->debug_log(json_encode($values));
-    $stmt = $this->session->db->prepare($sql);
-    $stmt->execute($values);
-    foreach ($this->session->config['multiple-links'] as $field) {
-      $name = $field['name'];
-      $ids = $data[$name] ?? [];
-      if (count($ids) > 0) {
-        $link_id = $field['link_id'];
-        $table_name = $field['table'];
-        $sql = "
-          INSERT INTO $table_name (LibraryItem, $link_id)
-               VALUES (?, ?)
-        ";
-        $this->session->debug_log($sql);
-        $stmt = $this->session->db->prepare($sql);
-        foreach ($ids as $id) {
-          $values = [$item_id, $id];
-          $this->session->debug_log(json_encode($values));
-          $stmt->execute($values);
-        }
+    $this->session->execute($sql, $values);
+    (new Index($this->session->db))->update([$item_id]);
+    $this->save_links($data, $item_id);
+    $this->save_subrecords($data, $item_id);
+    (new ItemSummary($this->session->db))->update([$item_id]);
+  }
+
+  // Add the IDs to the ends of newly imported items' sort keys.
+  private function finish_sort_keys($ids) {
+    if ($this->session->db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'sqlite') {
+      $template = "%1\$s = %1\$s || printf('%%06d', ItemID)";
+    } else {
+      $template = "%1\$s = CONCAT(%1\$s, LPAD(ItemID, GREATEST(LENGTH(ItemID), 6), '0'))";
+    }
+    $assignments = [];
+    foreach (['SortKey', 'ComposerSortKey', 'ArrangerSortKey'] as $name) {
+      $assignments[] = sprintf($template, $name);
+    }
+    $assignments = implode(', ', $assignments);
+    foreach (array_chunk($ids, self::BATCH_SIZE) as $batch) {
+      $ph = implode(', ', array_fill(0, count($batch), '?'));
+      $sql = "UPDATE LibraryItem SET $assignments WHERE ItemID IN ($ph)";
+      $this->session->execute($sql, $batch);
+    }
+  }
+
+  // Find the collection (if any) to which an item belongs.
+  private function get_collection_id($item_id) {
+    $sql = 'SELECT CollectionID FROM LibraryItem WHERE ItemID = ?';
+    return $this->session->select($sql, [$item_id], 'value');
+  }
+
+  // Fetch complete records for the items requested by the ?ids parameter.
+  private function get_records() {
+    $ids = array_map('intval', preg_split('/[\s,]+/', $_GET['ids'], -1, PREG_SPLIT_NO_EMPTY));
+    $ids = array_values(array_unique($ids));
+    if (count($ids) > self::MAX_RECORDS) {
+      http_response_code(400);
+      $error = 'at most ' . self::MAX_RECORDS . ' records can be fetched at once';
+      error_log($error);
+      return ['status' => 'failure', 'message' => $error];
+    }
+    return $this->load_records($ids);
+  }
+
+  // Insert one chunk of imported items, returning the new IDs.
+  //
+  // Everything goes in with multi-row INSERTs: the database assigns the
+  // items' IDs (see insert_items()), and the IDs are then added to the
+  // ends of the items' sort keys with a single UPDATE.
+  private function import_chunk($chunk, $persons) {
+    $columns = ['DateAdded', 'AddedBy', 'SortKey', 'ComposerSortKey', 'ArrangerSortKey'];
+    foreach ($this->session->config['columns'] as $column) {
+      $columns[] = $column['name'];
+    }
+    $items = [];
+    foreach ($chunk as $data) {
+      $values = [$this->session->localtime, $this->session->user->name];
+      array_push($values, ...self::build_sort_keys($data, null, $persons));
+      foreach ($this->session->config['columns'] as $column) {
+        $value = $data[$column['name']] ?? $column['default'] ?? null;
+        if (!$column['required'] && $value === '')
+          $value = null;
+        $values[] = $value;
       }
+      $items[] = $values;
     }
-    foreach ($this->session->config['multiple-subrecords'] as $field) {
-      $name = $field['name'];
-      $records = $data[$name] ?? [];
-      if (count($records) > 0) {
-        $table_name = $field['table'];
-        $column_names = [];
-        $placeholders = ['?'];
-        foreach ($field['columns'] as $column) {
-          $column_names[] = $column['name'];
-          $placeholders[] = '?';
+    $ids = $this->insert_items($columns, $items);
+    $this->finish_sort_keys($ids);
+    $links = [];
+    $subrecords = [];
+    $collections = [];
+    foreach (array_values($chunk) as $i => $data) {
+      $item_id = $ids[$i];
+      foreach ($this->session->config['multiple-links'] as $field) {
+        foreach (array_unique($data[$field['name']] ?? []) as $id) {
+          $links[$field['table']][] = [$item_id, $id];
         }
-        $columns = 'LibraryItem, ' . implode(', ', $column_names);
-        $placeholders = implode(', ', $placeholders);
-        $sql = "INSERT INTO $table_name ($columns) VALUES ($placeholders)";
-        $this->session->debug_log($sql);
-        $stmt = $this->session->db->prepare($sql);
-        foreach ($records as $record) {
+      }
+      foreach ($this->session->config['multiple-subrecords'] as $field) {
+        foreach ($data[$field['name']] ?? [] as $record) {
           $values = [$item_id];
-          foreach ($column_names as $column_name) {
-            $values[] = $record[$column_name] ?? null;
+          foreach ($field['columns'] as $column) {
+            $values[] = $record[$column['name']] ?? null;
           }
-          $this->session->debug_log(json_encode($values));
-          $stmt->execute($values);
+          $subrecords[$field['table']][] = $values;
         }
       }
+      $collection_id = $data['CollectionID'] ?? null;
+      if (!empty($collection_id)) {
+        $collections[$collection_id] = ($collections[$collection_id] ?? 0) + 1;
+      }
+    }
+    foreach ($this->session->config['multiple-links'] as $field) {
+      $table = $field['table'];
+      $columns = ['LibraryItem', $field['link_id']];
+      $this->insert_rows($table, $columns, $links[$table] ?? []);
+    }
+    foreach ($this->session->config['multiple-subrecords'] as $field) {
+      $table = $field['table'];
+      $columns = ['LibraryItem'];
+      foreach ($field['columns'] as $column) {
+        $columns[] = $column['name'];
+      }
+      $this->insert_rows($table, $columns, $subrecords[$table] ?? []);
+    }
+    foreach ($collections as $collection_id => $count) {
+      $this->adjust_member_count($collection_id, $count);
+    }
+    (new Index($this->session->db))->update($ids);
+    (new ItemSummary($this->session->db))->update($ids);
+    $audit = [];
+    foreach ($ids as $id) {
+      $audit[] = [
+        $this->session->user->name,
+        $this->session->localtime,
+        'IMPORT',
+        'LibraryItem',
+        $id,
+      ];
+    }
+    $columns = ['AuditWho', 'AuditWhen', 'AuditAction', 'AuditTable', 'AuditKey'];
+    $this->insert_rows('LibraryAudit', $columns, $audit);
+    return $ids;
+  }
+
+  // Add catalog items using as few INSERT statements as possible.
+  //
+  // Returns the IDs the database assigned to the items, in order. A
+  // multi-row INSERT is given consecutive IDs (stepping by MySQL's
+  // auto_increment_increment), ending with SQLite's last insert ID, or
+  // starting with MySQL's; the IDs are checked, in case that ever isn't
+  // so, and if they're wrong the chunk is imported again an item at a
+  // time.
+  private function insert_items($columns, $rows) {
+    $db = $this->session->db;
+    $mysql = $db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'mysql';
+    $step = 1;
+    if ($mysql) {
+      $sql = 'SELECT @@auto_increment_increment';
+      $step = (int)$this->session->select($sql, null, 'value');
+    }
+    $names = implode(', ', $columns);
+    $row_placeholders = '(' . implode(', ', array_fill(0, count($columns), '?')) . ')';
+    $batch_size = max(1, intdiv(self::INSERT_PARAMETER_LIMIT, count($columns)));
+    $ids = [];
+    foreach (array_chunk($rows, $batch_size) as $batch) {
+      $count = count($batch);
+      $placeholders = implode(', ', array_fill(0, $count, $row_placeholders));
+      $sql = "INSERT INTO LibraryItem ($names) VALUES $placeholders";
+      $this->session->execute($sql, array_merge(...$batch));
+      $first = (int)$db->lastInsertId();
+      if (!$mysql) {
+        $first -= $count - 1;
+      }
+      $batch_ids = range($first, $first + ($count - 1) * $step, $step);
+      $ph = implode(', ', array_fill(0, $count, '?'));
+      $sql = "
+        SELECT COUNT(*) FROM LibraryItem
+         WHERE ItemID IN ($ph) AND DateAdded = ? AND AddedBy = ?
+      ";
+      $values = $batch_ids;
+      array_push($values, $this->session->localtime, $this->session->user->name);
+      if ((int)$this->session->select($sql, $values, 'value') !== $count) {
+        throw new \Exception('unable to determine the IDs of the imported items');
+      }
+      array_push($ids, ...$batch_ids);
+    }
+    return $ids;
+  }
+
+  // Add rows to a table using as few INSERT statements as possible.
+  private function insert_rows($table, $columns, $rows) {
+    $names = implode(', ', $columns);
+    $row_placeholders = '(' . implode(', ', array_fill(0, count($columns), '?')) . ')';
+    $batch_size = max(1, intdiv(self::INSERT_PARAMETER_LIMIT, count($columns)));
+    foreach (array_chunk($rows, $batch_size) as $batch) {
+      $placeholders = implode(', ', array_fill(0, count($batch), $row_placeholders));
+      $sql = "INSERT INTO $table ($names) VALUES $placeholders";
+      $this->session->execute($sql, array_merge(...$batch));
     }
   }
 
@@ -255,25 +545,40 @@ class Item {
       'LEFT JOIN LibraryPerson c ON c.PersonID = i.ComposerID',
       'LEFT JOIN LibraryPerson a ON a.PersonID = i.ArrangerID',
     ];
-    $search_term = trim($_GET['title'] ?? '');
-    if ($search_term === '0' || $search_term) {
-      $search_term = "%{$search_term}%";
-      $conditions[] = '(i.ItemTitle LIKE ? OR i.OtherTitle LIKE ?)';
-      $values = [$search_term, $search_term];
-    }
-    $search_term = trim($_GET['composer_arranger'] ?? '');
-    if ($search_term === '0' || $search_term) {
-      $search_term = "%{$search_term}%";
-      $conditions[] = '(c.SearchKey LIKE ? OR a.SearchKey LIKE ?)';
-      array_push($values, $search_term, $search_term);
+    $search = (new Index($this->session->db))->plan(
+      $_GET['title'] ?? '',
+      $_GET['composer_arranger'] ?? ''
+    );
+    if ($search) {
+      $joins[] = $search['join'];
+      $conditions = $search['conditions'];
+      $values = $search['values'];
+    }
+    $joins = implode(' ', $joins);
+    $relevance = $search && ($_GET['order'] ?? '') === 'relevance';
+    $cursor = $relevance ? null : self::decode_cursor($_GET['after'] ?? '');
+    $offset = (int) ($_GET['offset'] ?? '0');
+    $response = [];
+
+    // The total only needs to be counted for the first page of a search.
+    if ($cursor === null && !$offset) {
+      $where = '';
+      if (count($conditions) > 0) {
+        $where = 'WHERE ' . implode(' AND ', $conditions);
+      }
+      $sql = "SELECT COUNT(*) FROM LibraryItem i $joins $where";
+      $response['total'] = $this->session->select($sql, $values, 'value');
+    }
+
+    // Seek past the last row of the previous page if we have its key.
+    if ($cursor !== null) {
+      $conditions[] = 'i.SortKey > ?';
+      $values[] = $cursor;
     }
     $where = '';
     if (count($conditions) > 0) {
       $where = 'WHERE ' . implode(' AND ', $conditions);
     }
-    $joins = implode(' ', $joins);
-    $sql = "SELECT COUNT(DISTINCT ItemID) FROM LibraryItem i $joins $where";
-    $total = $this->session->select($sql, $values, 'value');
     $fields = [
       'i.ItemID AS id',
       'i.ItemTitle',
@@ -285,59 +590,216 @@ class Item {
       'a.LastName AS ArrangerLastName',
       'a.FirstName AS ArrangerFirstName',
       'a.Dates AS ArrangerDates',
-      '(SELECT COUNT(*) FROM LibraryItem WHERE CollectionID = i.ItemID)' .
-      ' AS used_by',
+      'i.MemberCount AS used_by',
+      'i.SortKey',
     ];
     $fields = implode(', ', $fields);
+    $order = 'i.SortKey';
+    if ($relevance) {
+      $order = "{$search['order']}, i.SortKey";
+      $values = array_merge($values, $search['order_values']);
+    }
     $sql = "
-        SELECT DISTINCT $fields
-         FROM LibraryItem i $joins $where ORDER BY 2
+        SELECT $fields
+         FROM LibraryItem i $joins $where ORDER BY $order
       ";
     $limit = (int) ($_GET['limit'] ?? '0');
     if ($limit) {
       $sql .= " LIMIT $limit";
     }
-    $offset = (int) ($_GET['offset'] ?? '0');
-    if ($offset) {
+    if ($offset && $cursor === null) {
       $sql .= " OFFSET $offset";
     }
     $this->session->debug_log($sql);
     $results = $this->session->select($sql, $values);
-    return ['total' => $total, 'results' => $results];
+
+    // Give the client the key for fetching the following page.
+    $response['next'] = null;
+    if ($limit && count($results) === $limit && !$relevance) {
+      $response['next'] = self::encode_cursor(end($results)['SortKey']);
+    }
+    foreach ($results as &$result) {
+      unset($result['SortKey']);
+    }
+    unset($result);
+    $response['results'] = $results;
+    return $response;
   }
 
-  // Create the sort keys for the LibraryItem records.
-  private function make_item_sort_keys($rec, $row_id) {
-    $sort_keys = [];
-    $composer_id = $rec['ComposerID'] ?? null;
-    $arranger_id = $rec['ArrangerID'] ?? null;
-    $title = $rec['ItemTitle'];
-    if ($composer_id) {
-      $query = '
-        SELECT LastName, FirstName, SearchKey
+  // Parse the items to be imported, keyed by (1-based) row number.
+  //
+  // A row which can't be parsed is represented by its error message.
+  private function load_import_rows() {
+    $data = $this->session->request_data;
+    if (is_array($data) && array_is_list($data)) {
+      $rows = $data;
+    } else {
+      $rows = [];
+      $lines = preg_split('/\r?\n/', file_get_contents('php://input'));
+      while (!empty($lines) && trim(end($lines)) === '') {
+        array_pop($lines);
+      }
+      foreach ($lines as $line) {
+        $rows[] = json_decode($line, true) ?? 'unable to parse JSON';
+      }
+    }
+    $items = [];
+    foreach ($rows as $i => $row) {
+      if (!is_string($row) && (!is_array($row) || array_is_list($row))) {
+        $row = 'item must be a JSON object';
+      }
+      $items[$i + 1] = $row;
+    }
+    return $items;
+  }
+
+  // Fetch the names used for sorting for a set of people, keyed by ID.
+  private function load_persons($ids) {
+    $ids = array_values(array_unique(array_filter($ids)));
+    $persons = [];
+    foreach (array_chunk($ids, self::BATCH_SIZE) as $batch) {
+      $ph = implode(', ', array_fill(0, count($batch), '?'));
+      $query = "
+        SELECT PersonID, LastName, FirstName, SearchKey
           FROM LibraryPerson
-         WHERE PersonID = ?
-      ';
-      $row = $this->session->select($query, [$composer_id], 'row');
-      $last_name = $row['LastName'];
-      $first_name = $row['FirstName'];
-      $search_key = $row['SearchKey'];
-    }
-    else
-      $first_name = $last_name = $search_key = '';
-    $key = sprintf("%s\t%s\t%s\t%06d", $title, $last_name, $first_name, $row_id);
-    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
-    $key = sprintf("%s\t%s\t%06d", $search_key, $title, $row_id);
-    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
-    if ($arranger_id) {
-      $query = 'SELECT SearchKey FROM LibraryPerson WHERE PersonID = ?';
-      $search_key = $this->session->select($query, [$arranger_id], 'value');
+         WHERE PersonID IN ($ph)
+      ";
+      foreach ($this->session->select($query, $batch) as $row) {
+        $persons[$row['PersonID']] = $row;
+      }
+    }
+    return $persons;
+  }
+
+  // Load complete records for a set of items, in the order requested.
+  //
+  // Each table is queried once for each batch of items (instead of once
+  // for each item), and the rows are sorted out to their items here.
+  private function load_records($ids) {
+    $records = [];
+    $config = $this->session->config;
+    foreach (array_chunk($ids, self::BATCH_SIZE) as $batch) {
+      $ph = implode(', ', array_fill(0, count($batch), '?'));
+      $sql = "SELECT * FROM LibraryItem WHERE ItemID IN ($ph)";
+      foreach ($this->session->select($sql, $batch) as $record) {
+        foreach (['multiple-links', 'multiple-subrecords'] as $group) {
+          foreach ($config[$group] as $field) {
+            $record[$field['name']] = [];
+          }
+        }
+        $record['used_by'] = $record['MemberCount'];
+        $records[$record['ItemID']] = $record;
+      }
+      foreach ($config['multiple-links'] as $field) {
+        $sql = "
+          SELECT LibraryItem, {$field['link_id']}
+            FROM {$field['table']}
+           WHERE LibraryItem IN ($ph)
+        ";
+        $stmt = $this->session->execute($sql, $batch);
+        while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
+          $records[$row[0]][$field['name']][] = $row[1];
+        }
+      }
+      foreach ($config['multiple-subrecords'] as $field) {
+        $sql = "
+            SELECT *
+              FROM {$field['table']}
+             WHERE LibraryItem IN ($ph)
+          ORDER BY 1
+        ";
+        foreach ($this->session->select($sql, $batch) as $row) {
+          $records[$row['LibraryItem']][$field['name']][] = $row;
+        }
+      }
+    }
+    $ordered = [];
+    foreach ($ids as $id) {
+      if (array_key_exists($id, $records)) {
+        $ordered[] = $records[$id];
+      }
+    }
+    return $ordered;
+  }
+
+  // Bring an item's linked values (e.g., keywords) in line with the form's.
+  private function save_links($data, $item_id) {
+    foreach ($this->session->config['multiple-links'] as $field) {
+      $table = $field['table'];
+      $link_id = $field['link_id'];
+      $sql = "SELECT $link_id FROM $table WHERE LibraryItem = ?";
+      $stored = $this->session->select($sql, [$item_id], 'column');
+      $wanted = array_unique($data[$field['name']] ?? []);
+      $dropped = array_diff($stored, $wanted);
+      $added = array_diff($wanted, $stored);
+      if (!empty($dropped)) {
+        $ph = implode(', ', array_fill(0, count($dropped), '?'));
+        $sql = "DELETE FROM $table WHERE LibraryItem = ? AND $link_id IN ($ph)";
+        $this->session->execute($sql, array_merge([$item_id], array_values($dropped)));
+      }
+      $rows = array_map(fn($id) => [$item_id, $id], array_values($added));
+      $this->insert_rows($table, ['LibraryItem', $link_id], $rows);
+      $counts = count($added) . ' added, ' . count($dropped) . ' dropped';
+      $this->session->debug_log("$table for item $item_id: $counts");
+    }
+  }
+
+  // Apply only the inserts, updates, and deletes the subrecords need.
+  //
+  // Subrecords which came from the database carry their primary keys,
+  // so those are matched with the stored rows; the ones without keys
+  // are new, and stored rows which no longer appear have been removed.
+  private function save_subrecords($data, $item_id) {
+    foreach ($this->session->config['multiple-subrecords'] as $field) {
+      $table = $field['table'];
+      $primary_key = $field['primary_key'];
+      $columns = array_map(fn($column) => $column['name'], $field['columns']);
+      $sql = "SELECT * FROM $table WHERE LibraryItem = ?";
+      $stored = [];
+      foreach ($this->session->select($sql, [$item_id]) as $row) {
+        $stored[$row[$primary_key]] = $row;
+      }
+      $assignments = implode(', ', array_map(fn($name) => "$name = ?", $columns));
+      $update = "UPDATE $table SET $assignments WHERE $primary_key = ?";
+      $new_rows = [];
+      $updated = 0;
+      foreach ($data[$field['name']] ?? [] as $record) {
+        $values = [];
+        foreach ($columns as $name) {
+          $values[] = $record[$name] ?? null;
+        }
+        $key = $record[$primary_key] ?? null;
+        if ($key !== null && array_key_exists($key, $stored)) {
+          $current = $stored[$key];
+          unset($stored[$key]);
+          $changed = false;
+          foreach ($columns as $i => $name) {
+            $old = $current[$name];
+            $new = $values[$i];
+            if (is_null($old) !== is_null($new) || (string)$old !== (string)$new) {
+              $changed = true;
+              break;
+            }
+          }
+          if ($changed) {
+            $values[] = $key;
+            $this->session->execute($update, $values);
+            $updated++;
+          }
+        } else {
+          $new_rows[] = array_merge([$item_id], $values);
+        }
+      }
+      $this->insert_rows($table, array_merge(['LibraryItem'], $columns), $new_rows);
+      if (!empty($stored)) {
+        $ph = implode(', ', array_fill(0, count($stored), '?'));
+        $sql = "DELETE FROM $table WHERE $primary_key IN ($ph)";
+        $this->session->execute($sql, array_keys($stored));
+      }
+      $counts = count($new_rows) . " inserted, $updated updated, ";
+      $counts .= count($stored) . ' deleted';
+      $this->session->debug_log("$table for item $item_id: $counts");
     }
-    else
-      $search_key = '';
-    $key = sprintf("%s\t%s\t%06d", $search_key, $title, $row_id);
-    $sort_keys[] = mb_convert_encoding($key, 'ASCII', 'UTF-8');
-    return $sort_keys;
   }
 
 }
@@ -0,0 +1,35 @@
+<?php
+
+/**
+ * Apply any pending changes to the structure of the database.
+ *
+ * Run from the api directory after installing a new release (unless
+ * the `migrate` database setting is on, in which case the web
+ * application does this itself). It is safe to run this at any time;
+ * with --status it only reports the schema version.
+ *
+ *   php migrate.php
+ *   php migrate.php --status
+ */
+
+require_once 'utilities.php';
+require_once 'migrations.php';
+
+use MusicLibrary\Migrations\Migrator;
+use MusicLibrary\Utilities\Session;
+
+$migrator = new Migrator(Session::connect_to_database());
+if (($argv[1] ?? '') === '--status') {
+  echo "Schema version {$migrator->current()} (latest {$migrator->latest()}).\n";
+  exit(0);
+}
+try {
+  $applied = $migrator->apply();
+  foreach ($applied as $version => $description) {
+    echo "Applied migration $version: $description.\n";
+  }
+  echo "Schema version {$migrator->current()}.\n";
+} catch (Exception $e) {
+  fwrite(STDERR, $e->getMessage() . "\n");
+  exit(1);
+}
@@ -0,0 +1,320 @@
+<?php
+
+/**
+ * Versioned changes to the structure of the music library database.
+ *
+ * Each migration has a version number, and the versions which have
+ * been applied are recorded in the schema_version table. Every step
+ * checks what is already in place before changing anything, so that
+ * a migration can safely be applied to a database which already has
+ * some (or all) of its changes, such as one created from the current
+ * create-tables scripts, or one upgraded by hand.
+ */
+
+namespace MusicLibrary\Migrations;
+
+require_once 'search.php';
+require_once 'summary.php';
+
+use MusicLibrary\Items\Item;
+use MusicLibrary\Search\Index;
+use MusicLibrary\Summary\ItemSummary;
+use MusicLibrary\Utilities\Cache;
+
+class Migrator {
+
+  const ITEM_FOREIGN_KEYS = [
+    'Accompaniment',
+    'Alto',
+    'Arrangement',
+    'Arranger',
+    'Bass',
+    'Composer',
+    'HandbellEnsemble',
+    'Key',
+    'Lyricist',
+    'Owner',
+    'Publisher',
+    'Season',
+    'Skill',
+    'Soprano',
+    'Supplier',
+    'Tenor',
+  ];
+  const LOCK = Cache::DIRECTORY . '/schema-version.lock';
+
+  public $db;
+  public $driver;
+
+  public function __construct($db) {
+    $this->db = $db;
+    $this->driver = $db->getAttribute(\PDO::ATTR_DRIVER_NAME);
+  }
+
+  // Apply the migrations which haven't been applied yet.
+  //
+  // Returns the descriptions of the migrations applied, keyed by version.
+  public function apply() {
+    $applied = [];
+    $current = $this->current();
+    foreach ($this->migrations() as $version => list($description, $steps)) {
+      if ($version > $current) {
+        // MySQL commits DDL statements implicitly, so only SQLite can
+        // apply a migration atomically (the steps are idempotent anyway).
+        $atomic = $this->driver === 'sqlite';
+        if ($atomic) {
+          $this->db->beginTransaction();
+        }
+        try {
+          $steps();
+          $stmt = $this->db->prepare('
+            INSERT INTO schema_version (version, description, applied)
+                 VALUES (?, ?, ?)
+          ');
+          $stmt->execute([$version, $description, date('Y-m-d H:i:s')]);
+          if ($atomic) {
+            $this->db->commit();
+          }
+        } catch (\Exception $e) {
+          if ($atomic) {
+            $this->db->rollBack();
+          }
+          throw $e;
+        }
+        $applied[$version] = $description;
+      }
+    }
+    return $applied;
+  }
+
+  // Find the version of the most recent migration applied, if any.
+  //
+  // Unlike current(), this never changes the database (a database
+  // which has never been migrated has no schema_version table).
+  public function applied() {
+    try {
+      $query = 'SELECT MAX(version) FROM schema_version';
+      return (int)$this->db->query($query)->fetchColumn();
+    } catch (\PDOException $e) {
+      return 0;
+    }
+  }
+
+  // Find the version of the most recent migration applied.
+  public function current() {
+    $this->db->exec('
+      CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER NOT NULL,
+        description VARCHAR(255) NOT NULL,
+        applied DATETIME NOT NULL,
+        PRIMARY KEY (version)
+      )
+    ');
+    $query = 'SELECT COALESCE(MAX(version), 0) FROM schema_version';
+    return (int)$this->db->query($query)->fetchColumn();
+  }
+
+  // Bring the database up to date, unless it already is.
+  //
+  // Called when the database connection is opened (if the `migrate`
+  // database setting is on), so the check must be cheap: it's a single
+  // lookup in the schema_version table's primary key. The answer comes
+  // from the database itself, so restoring a backup or pointing the
+  // application at another database can't leave migrations unapplied.
+  public static function ensure_current($db) {
+    $migrator = new Migrator($db);
+    if ($migrator->applied() === $migrator->latest()) {
+      return;
+    }
+    Cache::make_directory(dirname(self::LOCK));
+    $fp = fopen(self::LOCK, 'c');
+    flock($fp, LOCK_EX);
+    try {
+      $applied = $migrator->apply();
+      foreach ($applied as $version => $description) {
+        error_log("applied schema migration $version: $description");
+      }
+    } finally {
+      flock($fp, LOCK_UN);
+      fclose($fp);
+    }
+  }
+
+  // Find the version of the newest migration we know about.
+  public function latest() {
+    return max(array_keys($this->migrations()));
+  }
+
+  // Add a column to a table if it isn't already there.
+  //
+  // Returns true if the column was added.
+  private function add_column($table, $column, $definition) {
+    if ($this->driver === 'sqlite') {
+      $columns = [];
+      foreach ($this->db->query("PRAGMA table_info($table)") as $row) {
+        $columns[] = $row['name'];
+      }
+      $exists = in_array($column, $columns);
+    } else {
+      $stmt = $this->db->prepare('
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+         WHERE TABLE_SCHEMA = DATABASE()
+           AND TABLE_NAME = ?
+           AND COLUMN_NAME = ?
+      ');
+      $stmt->execute([$table, $column]);
+      $exists = $stmt->fetchColumn() > 0;
+    }
+    if ($exists) {
+      return false;
+    }
+    $this->db->exec("ALTER TABLE $table ADD $column $definition");
+    return true;
+  }
+
+  // Create an index unless one already covers the columns.
+  //
+  // An index covers the columns if they are its leading columns, so an
+  // index created for a foreign key by MySQL, or a composite primary
+  // key whose first column is the one needing an index, will do.
+  private function add_index($name, $table, $columns) {
+    foreach ($this->indexes($table) as $indexed) {
+      if (array_slice($indexed, 0, count($columns)) === $columns) {
+        return false;
+      }
+    }
+    $columns = implode(', ', $columns);
+    $this->db->exec("CREATE INDEX $name ON $table ($columns)");
+    return true;
+  }
+
+  // Find out whether a table (or view) exists.
+  private function has_table($table) {
+    if ($this->driver === 'sqlite') {
+      $query = 'SELECT COUNT(*) FROM sqlite_master WHERE name = ?';
+    } else {
+      $query = '
+        SELECT COUNT(*) FROM information_schema.TABLES
+         WHERE TABLE_SCHEMA = DATABASE()
+           AND TABLE_NAME = ?
+      ';
+    }
+    $stmt = $this->db->prepare($query);
+    $stmt->execute([$table]);
+    return $stmt->fetchColumn() > 0;
+  }
+
+  // Get the columns of each of a table's indexes, in index order.
+  private function indexes($table) {
+    $indexes = [];
+    if ($this->driver === 'sqlite') {
+      $list = $this->db->query("PRAGMA index_list($table)")->fetchAll();
+      foreach ($list as $index) {
+        $name = $index['name'];
+        $columns = [];
+        foreach ($this->db->query("PRAGMA index_info($name)") as $row) {
+          $columns[$row['seqno']] = $row['name'];
+        }
+        ksort($columns);
+        $indexes[$name] = array_values($columns);
+      }
+    } else {
+      $stmt = $this->db->prepare('
+          SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS
+           WHERE TABLE_SCHEMA = DATABASE()
+             AND TABLE_NAME = ?
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+      ');
+      $stmt->execute([$table]);
+      while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
+        $indexes[$row[0]][] = $row[1];
+      }
+    }
+    return $indexes;
+  }
+
+  // The changes to the schema, in the order in which they are applied.
+  //
+  // Never change a migration once it has been released; add a new one.
+  private function migrations() {
+    return [
+      1 => ['collection member counts and sort key index', function() {
+        if ($this->add_column('LibraryItem', 'MemberCount',
+                              'INTEGER NOT NULL DEFAULT 0')) {
+          require_once 'items.php';
+          Item::rebuild_member_counts($this->db);
+        }
+        $this->add_index('LibraryItemCollection', 'LibraryItem', ['CollectionID']);
+        $this->add_index('LibraryItemSortKey', 'LibraryItem', ['SortKey']);
+      }],
+      2 => ['full-text search index', function() {
+        if (!$this->has_table('LibraryItemSearch')) {
+          (new Index($this->db))->rebuild();
+        }
+      }],
+      3 => ['audit trail indexes and archive table', function() {
+        $columns = ['AuditWhen', 'AuditID'];
+        $this->add_index('LibraryAuditWhen', 'LibraryAudit', $columns);
+        array_unshift($columns, 'AuditWho');
+        $this->add_index('LibraryAuditWho', 'LibraryAudit', $columns);
+        $columns[0] = 'AuditTable';
+        $this->add_index('LibraryAuditTable', 'LibraryAudit', $columns);
+        if (!$this->has_table('LibraryAuditArchive')) {
+          $this->db->exec('
+            CREATE TABLE LibraryAuditArchive (
+              AuditID INTEGER NOT NULL,
+              AuditWho VARCHAR(20) NOT NULL,
+              AuditWhen DATETIME NOT NULL,
+              AuditAction VARCHAR(20) NOT NULL,
+              AuditTable VARCHAR(32) NOT NULL,
+              AuditKey INTEGER NOT NULL,
+              PRIMARY KEY (AuditID)
+            )
+          ');
+          $this->db->exec('
+            CREATE INDEX LibraryAuditArchiveWhen
+                ON LibraryAuditArchive (AuditWhen)
+          ');
+        }
+      }],
+      4 => ['indexes for foreign keys', function() {
+        foreach (['Inventory', 'Part', 'Performance'] as $name) {
+          $table = "Library$name";
+          $this->add_index("{$table}Item", $table, ['LibraryItem']);
+        }
+        $columns = ['LibraryItem', 'LoanReturned'];
+        $this->add_index('LibraryLoanItem', 'LibraryLoan', $columns);
+        $columns = ['LibraryKeyword'];
+        $this->add_index('LibraryItemKeywordKeyword', 'LibraryItemKeyword', $columns);
+        $this->add_index('LibraryItemTagTag', 'LibraryItemTag', ['LibraryTag']);
+        $this->add_index('LibraryTagTagGroup', 'LibraryTag', ['TagGroup']);
+        foreach (self::ITEM_FOREIGN_KEYS as $name) {
+          $this->add_index("LibraryItem$name", 'LibraryItem', ["{$name}ID"]);
+        }
+      }],
+      5 => ['item summary table', function() {
+        if (!$this->has_table('LibraryItemSummary')) {
+          (new ItemSummary($this->db))->rebuild();
+        }
+      }],
+      6 => ['report request status for the background worker', function() {
+        $added = $this->add_column('report_request', 'status',
+                                   "VARCHAR(10) NOT NULL DEFAULT 'queued'");
+        if ($added) {
+          // Earlier requests were run (or abandoned) by the browser, and
+          // mustn't be picked up by the worker now.
+          $this->db->exec("UPDATE report_request SET status = 'done'");
+        }
+        $this->add_column('report_request', 'progress',
+                          'INTEGER NOT NULL DEFAULT 0');
+        $this->add_column('report_request', 'started', 'DATETIME');
+        $this->add_column('report_request', 'finished', 'DATETIME');
+        $this->add_column('report_request', 'worker', 'VARCHAR(100)');
+        $this->add_column('report_request', 'error', 'TEXT');
+        $columns = ['status', 'request_id'];
+        $this->add_index('report_request_status', 'report_request', $columns);
+      }],
+    ];
+  }
+
+}
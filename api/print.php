@@ -2,93 +2,192 @@
 
 namespace MusicLibrary\Print;
 
+use MusicLibrary\Utilities\Config;
+
 class Job {
 
   const CLIENT_CONFIG_PATH = __DIR__ . '/../config.json';
+  const MAX_ITEMS = 500;
 
-  public $blocks = [];
   public $client_config;
-  public $id;
-  public $item;
+  public $ids;
+  public $items = [];
+  public $lookup_maps = [];
   public $lookup_tables;
+  public $multiple_values = [];
+  public $records = [];
   public $session;
 
   public function __construct($session) {
     $this->session = $session;
     $this->client_config = self::load_client_config();
-    $this->id = $session->record_id;
-    $this->item = $this->load_item();
     $this->lookup_tables = $session->config['lookup_tables'];
-    $this->load_blocks();
+    if (!empty($session->record_id)) {
+      $this->ids = [(int)$session->record_id];
+    } else {
+      $ids = preg_split('/[\s,]+/', $_GET['ids'] ?? '', -1, PREG_SPLIT_NO_EMPTY);
+      $this->ids = array_values(array_unique(array_map('intval', $ids)));
+    }
+    if (count($this->ids) <= self::MAX_ITEMS) {
+      $this->load_items();
+    }
   }
 
+  // Assemble the printable view of one item (or of several, with ?ids=).
   public function get() {
-    return [
-      'status' => 'success',
-      'title' => trim($this->item['ItemTitle']),
-      'id' => $this->id,
-      'blocks' => $this->blocks,
-    ];
+    if (count($this->ids) > self::MAX_ITEMS) {
+      http_response_code(400);
+      $error = 'at most ' . self::MAX_ITEMS . ' items can be printed at once';
+      error_log($error);
+      return ['status' => 'failure', 'message' => $error];
+    }
+    $this->load_lookup_maps();
+    $items = [];
+    foreach ($this->ids as $id) {
+      if (array_key_exists($id, $this->items)) {
+        $items[] = [
+          'title' => trim($this->items[$id]['ItemTitle']),
+          'id' => $id,
+          'blocks' => $this->load_blocks($id),
+        ];
+      }
+    }
+    if (!empty($this->session->record_id)) {
+      if (empty($items)) {
+        http_response_code(404);
+        $error = "item {$this->session->record_id} not found";
+        error_log($error);
+        return ['status' => 'failure', 'message' => $error];
+      }
+      return array_merge(['status' => 'success'], $items[0]);
+    }
+    return ['status' => 'success', 'items' => $items];
   }
 
-  private function load_item() {
-    $query = 'SELECT * FROM LibraryItem WHERE ItemID = ?';
-    $item = $this->session->select($query, [$this->id], 'row');
-    $this->session->debug_log('item values: ' . json_encode($item));
-    return $item;
+  private function load_items() {
+    if (empty($this->ids)) {
+      return;
+    }
+    $ph = implode(', ', array_fill(0, count($this->ids), '?'));
+    $query = "SELECT * FROM LibraryItem WHERE ItemID IN ($ph)";
+    foreach ($this->session->select($query, $this->ids) as $item) {
+      $this->items[$item['ItemID']] = $item;
+    }
+    $this->session->debug_log('item values: ' . json_encode($this->items));
   }
 
   private static function load_client_config() {
-    $json = file_get_contents(self::CLIENT_CONFIG_PATH);
-    return json_decode($json, true);
+    return Config::load(self::CLIENT_CONFIG_PATH);
   }
 
-  private function load_records($fieldset) {
+  // Fetch the subrecords of a fieldset for all of the items at once.
+  private function load_records($fieldset, $id) {
     $table = $fieldset['table'];
-    $query = "SELECT * FROM $table WHERE LibraryItem = ? ORDER BY 1";
-    return $this->session->select($query, [$this->id]);
+    if (!array_key_exists($table, $this->records)) {
+      $this->records[$table] = [];
+      $ph = implode(', ', array_fill(0, count($this->ids), '?'));
+      $query = "SELECT * FROM $table WHERE LibraryItem IN ($ph) ORDER BY 1";
+      foreach ($this->session->select($query, $this->ids) as $record) {
+        $this->records[$table][$record['LibraryItem']][] = $record;
+      }
+    }
+    return $this->records[$table][$id] ?? [];
+  }
+
+  // Fetch the linked values (e.g., keywords) for all of the items at once.
+  private function load_multiple_values($picklist, $id) {
+    if (!array_key_exists($picklist, $this->multiple_values)) {
+      $this->multiple_values[$picklist] = [];
+      list($table, $columns, $pk) = $this->lookup_tables[$picklist];
+      $base_name = str_replace('Library', '', $table);
+      $ph = implode(', ', array_fill(0, count($this->ids), '?'));
+      $query = "
+        SELECT j.LibraryItem, {$columns[0]} FROM $table v
+          JOIN LibraryItem$base_name j ON j.Library$base_name = $pk
+         WHERE j.LibraryItem IN ($ph)
+      ORDER BY 2
+      ";
+      $stmt = $this->session->execute($query, $this->ids);
+      while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
+        $this->multiple_values[$picklist][$row[0]][] = $row[1];
+      }
+    }
+    return implode('; ', $this->multiple_values[$picklist][$id] ?? []);
   }
 
-  private function load_multiple_values($picklist) {
-    list($table, $columns, $pk) = $this->lookup_tables[$picklist];
-    $base_name = str_replace('Library', '', $table);
-    $query = "
-      SELECT {$columns[0]} FROM $table v
-        JOIN LibraryItem$base_name j ON j.Library$base_name = $pk
-       WHERE j.LibraryItem = ?
-    ORDER BY 1
-    ";
-    $values = $this->session->select($query, [$this->id], 'column');
-    return implode('; ', $values);
+  // Look up the display values for the items' single-valued picklist
+  // fields, fetching only the lookup rows the items (and their
+  // subrecords) actually refer to, with one query per lookup table.
+  private function load_lookup_maps() {
+    $keys = [];
+    foreach ($this->client_config['fieldsets'] as $fieldset) {
+      $records = [];
+      if (!empty($fieldset['multiple'])) {
+        foreach (array_keys($this->items) as $id) {
+          array_push($records, ...$this->load_records($fieldset, $id));
+        }
+      } else {
+        $records = $this->items;
+      }
+      foreach ($fieldset['rows'] as $row) {
+        foreach ($row as $field) {
+          $picklist = $field['picklist'] ?? null;
+          if (empty($picklist) || !empty($field['multiple'])) {
+            continue;
+          }
+          foreach ($records as $record) {
+            $value = $record[$field['name']] ?? null;
+            if (!empty($value)) {
+              $keys[$picklist][$value] = true;
+            }
+          }
+        }
+      }
+    }
+    foreach ($keys as $picklist => $values) {
+      list($table, $cols, $pk) = $this->lookup_tables[$picklist];
+      $columns = implode(',', (array)$cols);
+      $map = [];
+      foreach (array_chunk(array_keys($values), self::MAX_ITEMS) as $chunk) {
+        $ph = implode(', ', array_fill(0, count($chunk), '?'));
+        $query = "SELECT $pk, $columns FROM $table WHERE $pk IN ($ph)";
+        $stmt = $this->session->execute($query, $chunk);
+        while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
+          $key = array_shift($row);
+          if (count($row) === 1) {
+            $map[$key] = $row[0];
+            continue;
+          }
+          $display = trim($row[0]);
+          $forename = trim($row[1] ?? '');
+          $dates = trim($row[2] ?? '');
+          if (!empty($forename))
+            $display .= ", $forename";
+          if (!empty($dates))
+            $display .= " ($dates)";
+          $map[$key] = $display;
+        }
+      }
+      $this->lookup_maps[$picklist] = $map;
+    }
   }
 
+  // Find the display value for a picklist field's value.
   private function load_single_value($value, $picklist) {
     if (empty($value) || empty($picklist))
       return $value;
-    list($table, $cols, $pk) = $this->lookup_tables[$picklist];
-    $columns = implode(',', $cols);
-    $query = "SELECT $columns FROM $table WHERE $pk = ?";
-    if (count($cols) === 1)
-      return $this->session->select($query, [$value], 'value');
-    $person_name = $this->session->select($query, [$value], 'num');
-    $value = trim($person_name[0]);
-    $forename = trim($person_name[1]);
-    $dates = trim($person_name[2]);
-    if (!empty($forename))
-      $value .= ", $forename";
-    if (!empty($dates))
-      $value .= " ($dates)";
-    return $value;
+    return $this->lookup_maps[$picklist][$value] ?? false;
   }
 
-  private function load_blocks() {
+  private function load_blocks($id) {
+    $blocks = [];
     foreach ($this->client_config['fieldsets'] as $fieldset) {
       if (!empty($fieldset['multiple'])) {
         $block_title = $fieldset['singular'];
-        $records = $this->load_records($fieldset);
+        $records = $this->load_records($fieldset, $id);
       } else {
         $block_title = $fieldset['name'];
-        $records = [$this->item];
+        $records = [$this->items[$id]];
       }
       foreach ($records as $record) {
         $values = [];
@@ -97,7 +196,7 @@ class Job {
             $picklist = $field['picklist'] ?? null;
             $name = $field['name'];
             if (!empty($field['multiple']))
-              $val = $this->load_multiple_values($picklist);
+              $val = $this->load_multiple_values($picklist, $id);
             else
               $val = $this->load_single_value($record[$name] ?? '', $picklist);
             if (!empty($val) || $val === 0 || $val === '0' || $val === 0.0) {
@@ -111,9 +210,10 @@ class Job {
           }
         }
         if (count($values) > 0)
-          $this->blocks[] = ['label' => $block_title, 'values' => $values];
+          $blocks[] = ['label' => $block_title, 'values' => $values];
       }
     }
+    return $blocks;
   }
 
 }
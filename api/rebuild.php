@@ -0,0 +1,54 @@
+<?php
+
+/**
+ * Regenerate derived data in the music library database.
+ *
+ * Run from the api directory, naming what should be rebuilt:
+ *
+ *   php rebuild.php search-index
+ *   php rebuild.php member-counts
+ *   php rebuild.php item-summaries
+ */
+
+require_once 'utilities.php';
+require_once 'items.php';
+
+use MusicLibrary\Utilities\Session;
+
+$targets = [
+  'item-summaries' => function($db) {
+    $count = (new \MusicLibrary\Summary\ItemSummary($db))->rebuild();
+    return "Summarized $count catalog items.";
+  },
+  'member-counts' => function($db) {
+    $db->beginTransaction();
+    $count = \MusicLibrary\Items\Item::rebuild_member_counts($db);
+    $db->commit();
+    return "Counted members for $count collections.";
+  },
+  'search-index' => function($db) {
+    $count = (new \MusicLibrary\Search\Index($db))->rebuild();
+    return "Indexed $count catalog items.";
+  },
+];
+
+$target = $argv[1] ?? '';
+if (!array_key_exists($target, $targets)) {
+  $names = implode(' | ', array_keys($targets));
+  fwrite(STDERR, "usage: php rebuild.php $names\n");
+  exit(1);
+}
+
+// Each target uses its own transaction, because the tables some of them
+// create would commit an enclosing transaction implicitly on MySQL.
+$db = Session::connect_to_database();
+try {
+  $message = $targets[$target]($db);
+  echo "$message\n";
+} catch (Exception $e) {
+  if ($db->inTransaction()) {
+    $db->rollBack();
+  }
+  fwrite(STDERR, $e->getMessage() . "\n");
+  exit(1);
+}
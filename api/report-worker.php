@@ -0,0 +1,78 @@
+<?php
+
+/**
+ * Produce queued reports in the background.
+ *
+ * Run from the api directory, with the `enabled` report_worker setting
+ * in config.json turned on. Each worker produces one report at a time,
+ * and no more than `concurrency` workers run at once: a worker which
+ * can't get one of the slots exits right away, so it's safe to start
+ * workers from cron as well as from a service manager.
+ *
+ *   php report-worker.php          (keep polling for queued reports)
+ *   php report-worker.php --once   (exit when the queue is empty)
+ *
+ * Add --debug to log what the reports are doing.
+ */
+
+require_once 'utilities.php';
+require_once 'reports.php';
+
+use MusicLibrary\Reports\Report;
+use MusicLibrary\Utilities\Cache;
+use MusicLibrary\Utilities\Session;
+
+$session = new Session(false);
+$session->debugging = in_array('--debug', $argv);
+$settings = $session->config['report_worker'] ?? [];
+if (empty($settings['enabled'])) {
+  fwrite(STDERR, "Background reports are not enabled in config.json.\n");
+  exit(1);
+}
+$concurrency = max(1, (int)($settings['concurrency'] ?? 2));
+$poll_seconds = max(1, (int)($settings['poll_seconds'] ?? 2));
+$stale_after = (int)($settings['stale_after_seconds'] ?? 900);
+
+// Take one of the worker slots, holding its lock until we exit.
+$directory = Cache::DIRECTORY . '/report-worker';
+Cache::make_directory($directory);
+$slot = null;
+for ($i = 1; $i <= $concurrency && $slot === null; $i++) {
+  $lock = fopen("$directory/slot-$i.lock", 'c');
+  if (flock($lock, LOCK_EX | LOCK_NB)) {
+    $slot = $i;
+  } else {
+    fclose($lock);
+  }
+}
+if ($slot === null) {
+  echo "All $concurrency report worker slots are in use.\n";
+  exit(0);
+}
+
+$worker = gethostname() . ':' . getmypid() . ":$slot";
+while (true) {
+  $request = Report::claim($session, $worker, $stale_after);
+  if ($request === null) {
+    if (in_array('--once', $argv)) {
+      break;
+    }
+    sleep($poll_seconds);
+    continue;
+  }
+
+  // Start each report with a clean slate, so a long-running worker
+  // doesn't accumulate statistics and statements.
+  $session->start = microtime(true);
+  $session->queries = [];
+  $session->statements = [];
+  $session->streaming = [];
+  $request_id = $request['request_id'];
+  try {
+    $elapsed = (new Report($session))->run($request);
+    $when = Session::get_localtime();
+    printf("%s report %d done in %.3f seconds\n", $when, $request_id, $elapsed);
+  } catch (Throwable $e) {
+    fwrite(STDERR, "report $request_id failed: " . $e->getMessage() . "\n");
+  }
+}
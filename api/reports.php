@@ -2,13 +2,27 @@
 
 namespace MusicLibrary\Reports;
 
-use PhpOffice\PhpSpreadsheet\Spreadsheet;
-use PhpOffice\PhpSpreadsheet\Writer\Xlsx;
-use PhpOffice\PhpSpreadsheet\Style\Color;
-use PhpOffice\PhpSpreadsheet\Style\Fill;
-use PhpOffice\PhpSpreadsheet\Style\Alignment;
+use MusicLibrary\Utilities\Cache;
+use MusicLibrary\Utilities\Session;
 
 class Report {
+
+  const CONTENT_TYPES = [
+    'csv' => 'text/csv; charset=utf-8',
+    'ndjson' => 'application/x-ndjson',
+    'xlsx' => 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+  ];
+  const EXTENSIONS = ['excel' => 'xlsx', 'csv' => 'csv', 'ndjson' => 'ndjson'];
+  const FLUSH_INTERVAL = 1000;
+  const KEY_BATCH_SIZE = 500;
+  const MAX_CONCAT_LENGTH = 1024 * 1024;
+  const SUMMARY_JOIN = 'LEFT JOIN LibraryItemSummary s ON s.ItemID = i.ItemID';
+  const VALUE_SEPARATOR = "\x1f";
+
+  public $background = false;
+  public $cache;
+  public $cache_file;
+  public $cached = false;
   public $columns;
   public $format;
   public $id;
@@ -17,466 +31,888 @@ class Report {
   public $rows;
   public $title;
   public $session;
+  public $timings = [];
+  public $version;
 
   public function __construct($session) {
     $this->session = $session;
   }
 
+  // Take the oldest queued report request for a background worker.
+  //
+  // Requests left running by a worker which died are queued again once
+  // they have been running for longer than $stale_after seconds. The
+  // conditional UPDATE makes sure that only one worker gets a request.
+  // Returns null if nothing is waiting.
+  public static function claim($session, $worker, $stale_after) {
+    $cutoff = new \DateTime('now', new \DateTimeZone(Session::TIMEZONE));
+    $cutoff->modify("-$stale_after seconds");
+    $session->execute("
+      UPDATE report_request SET status = 'queued'
+       WHERE status = 'running' AND started < ?
+    ", [$cutoff->format('Y-m-d H:i:s.u')]);
+    $query = "
+        SELECT request_id FROM report_request
+         WHERE status = 'queued'
+      ORDER BY request_id
+         LIMIT 1
+    ";
+    while (($request_id = $session->select($query, null, 'value')) !== false) {
+      $stmt = $session->execute("
+        UPDATE report_request
+           SET status = 'running', progress = 0, started = ?, worker = ?
+         WHERE request_id = ? AND status = 'queued'
+      ", [Session::get_localtime(), $worker, $request_id]);
+      if ($stmt->rowCount() === 1) {
+        $query = 'SELECT * FROM report_request WHERE request_id = ?';
+        return $session->select($query, [$request_id], 'row');
+      }
+    }
+    return null;
+  }
+
   // Run the queued report and return the results.
+  //
+  // The rows are handed back as an iterator, so that reply() streams
+  // them to the browser instead of encoding them all at once.
+  //
+  // If reports are produced in the background (by report-worker.php),
+  // this returns the request's status, with a 202 response, until the
+  // worker has finished, and then the stored result. Adding `?status`
+  // gets the status without the report, however it is being produced.
   public function get() {
     $this->id = $this->session->record_id;
-    $this->parameters = $this->load_parameters();
-    $this->title = $this->parameters['report-title'];
-    $this->format = $this->parameters['report-format'] ?? 'html';
-    $this->columns = $this->parameters['report-columns'];
-    $this->item_ids = $this->apply_filters();
-    $this->rows = $this->assemble_values();
-    $elapsed = (microtime(true) - $this->session->start);
-    $sql = 'UPDATE report_request SET elapsed = ? WHERE request_id = ?';
-    $stmt = $this->session->db->prepare($sql);
-    $stmt->execute([$elapsed, $this->id]);
-    if ($this->format === 'excel') {
-      $this->session->debug_log('writing excel workbook');
-      $this->write_excel();
+    $request = $this->load_request();
+    if (empty($request)) {
+      http_response_code(404);
+      $message = "report request {$this->id} not found";
+      error_log($message);
+      return ['status' => 'failure', 'message' => $message];
+    }
+    $this->load_parameters($request['parameters']);
+    $background = !empty($this->session->config['report_worker']['enabled']);
+    $finished = in_array($request['status'], ['done', 'failed']);
+    if (isset($_GET['status']) || $background && !$finished) {
+      return $this->report_status($request);
+    }
+    if ($background) {
+      if ($request['status'] === 'failed') {
+        http_response_code(500);
+        return ['status' => 'failure', 'message' => $request['error']];
+      }
+      $result = $this->load_result();
+      if ($result !== null) {
+        return $result;
+      }
+      $this->session->debug_log("result for report {$this->id} was evicted");
+    }
+    $started = Session::get_localtime();
+    $this->update_request(['status' => 'running', 'started' => $started]);
+    $this->open_cache();
+    $download = isset(self::EXTENSIONS[$this->format]);
+    if ($download) {
+      $path = $this->cache->find($this->make_cache_key(true));
+      if ($path) {
+        $this->record_elapsed_time();
+        $this->send_cached_file($path);
+      }
     }
-    else {
-      return [
-        'status' => 'success',
-        'title' => $this->title,
-        'columns' => $this->columns,
-        'rows' => $this->rows,
-        'elapsed' => $elapsed,
-      ];
+    $this->load_rows();
+    $elapsed = $this->record_elapsed_time();
+    if ($download) {
+      header('X-Cache: ' . ($this->cached ? 'HIT' : 'MISS'));
+      $key = $this->make_cache_key(true);
+      $this->cache_file = [$this->cache, $key, $this->cache->temp_path()];
+      $this->write_file();
+      exit();
     }
+    $payload = $this->make_payload($elapsed);
+    $payload['rows'] = new \ArrayIterator($payload['rows']);
+    return $payload;
   }
 
   // Queue a report for future generation.
   public function post() {
     $parms = $this->session->request_data['parms'];
     $values = [$this->session->user->name, $this->session->localtime, json_encode($parms)];
-    $stmt = $this->session->db->prepare('
+    $this->session->execute('
       INSERT INTO report_request (account, requested, parameters)
            VALUES (?, ?, ?)
-    ');
-    $stmt->execute($values);
+    ', $values);
     $request_id = $this->session->db->lastInsertId();
     http_response_code(201);
     return ['request_id' => $request_id, 'status' => 'success'];
   }
 
-  private static function column_row($column, $row) {
-    $dividend = $column;
-    $letter = '';
-    while ($dividend > 0) {
-        $modulo = ($dividend - 1) % 26;
-        $letter = chr(65 + $modulo) . $letter;
-        $dividend = intval(($dividend - $modulo) / 26);
+  // Produce a report claimed by the background worker.
+  //
+  // The rows (for the HTML view) or the rendered file are stored in the
+  // report-results cache under the request's ID, where get() finds them.
+  public function run($request) {
+    $this->id = $request['request_id'];
+    $this->background = true;
+    $this->load_parameters($request['parameters']);
+    try {
+      $this->open_cache();
+      $this->load_rows();
+      $results = new Cache($this->session, 'report-results');
+      $extension = self::EXTENSIONS[$this->format] ?? 'json';
+      $key = "{$this->id}.$extension";
+      if ($extension === 'json') {
+        $elapsed = microtime(true) - $this->session->start;
+        $results->put($key, json_encode($this->make_payload($elapsed)));
+      } else {
+        $this->cache_file = [$results, $key, $results->temp_path()];
+        $this->write_file();
+      }
+      return $this->record_elapsed_time();
+    } catch (\Throwable $e) {
+      $this->update_request([
+        'status' => 'failed',
+        'finished' => Session::get_localtime(),
+        'error' => $e->getMessage(),
+      ]);
+      throw $e;
     }
-    return "$letter$row";
   }
 
-  private function filter_by_arrangement(&$sets) {
+  // Build a key for the cached rows (or rendered file) for this report.
+  private function make_cache_key($rendered) {
+    $parameters = $this->parameters;
+    if (!$rendered) {
+      unset($parameters['report-title'], $parameters['report-format']);
+    }
+    $parameters = self::normalize($parameters);
+    $config_version = filemtime(Session::CONFIG);
+    $hash = hash('sha256', json_encode([$parameters, $config_version]));
+    $extension = $rendered ? (self::EXTENSIONS[$this->format] ?? 'json') : 'json';
+    return "{$this->version}-$hash.$extension";
+  }
+
+  // Put the parameters in canonical form so equivalent requests match.
+  private static function normalize($parameters) {
+    $normalized = [];
+    foreach ($parameters as $name => $value) {
+      if (is_string($value)) {
+        $value = trim($value);
+      }
+      if ($value === '' || $value === null || $value === []) {
+        continue;
+      }
+      if (is_array($value) && array_is_list($value)) {
+        if (!in_array($name, ['report-columns', 'report-sorting'])) {
+          $value = array_map('strval', $value);
+          sort($value, SORT_STRING);
+        }
+      }
+      $normalized[$name] = $value;
+    }
+    ksort($normalized);
+    return $normalized;
+  }
+
+  // Remember how long it took to produce the report, and that it's done.
+  private function record_elapsed_time() {
+    $elapsed = microtime(true) - $this->session->start;
+    $this->update_request([
+      'status' => 'done',
+      'progress' => 100,
+      'finished' => Session::get_localtime(),
+      'elapsed' => $elapsed,
+    ]);
+    return $elapsed;
+  }
+
+  // Return a report file we've already rendered for the same request.
+  private function send_cached_file($path) {
+    $extension = self::EXTENSIONS[$this->format];
+    self::send_download_headers($extension, $this->make_filename($extension));
+    header('X-Cache: HIT');
+    header('Content-Length: ' . filesize($path));
+    readfile($path);
+    $this->session->debug_log("sent cached report $path");
+    exit();
+  }
+
+  private function filter_by_arrangement(&$plan) {
     if (!empty($this->parameters['arrangement'])) {
       $values = $this->parameters['arrangement'];
       $op = $this->parameters['arrangement-logic'] === 'ni' ? 'NOT IN' : 'IN';
       $ph = implode(',', array_fill(0, count($values), '?'));
-      $query = "SELECT ItemID FROM LibraryItem WHERE ArrangementID $op ($ph)";
-      $sets[] = $this->session->select($query, $values, 'column');
+      $plan['conditions'][] = "i.ArrangementID $op ($ph)";
+      array_push($plan['values'], ...$values);
     }
   }
 
-  private function filter_by_cataloger(&$sets) {
+  private function filter_by_cataloger(&$plan) {
     if (!empty($this->parameters['user'])) {
       $value = $this->parameters['user'];
       $op = $this->parameters['user-logic'] === 'ne' ? '<>' : '=';
-      $query = "SELECT ItemID FROM LibraryItem WHERE AddedBy $op ?";
-      $sets[] = $this->session->select($query, [$value], 'column');
+      $plan['conditions'][] = "i.AddedBy $op ?";
+      $plan['values'][] = $value;
     }
   }
 
-  private function filter_by_collection(&$sets) {
+  private function filter_by_collection(&$plan) {
     $collection = trim($this->parameters['collection'] ?? '');
     if (!empty($collection)) {
       $op = $this->parameters['collection-logic'] === 'nl' ? 'NOT LIKE' : 'LIKE';
-      $query = "
-        SELECT i.ItemID FROM LibraryItem i
-          JOIN LibraryItem c ON c.ItemID = i.CollectionID
-         WHERE c.ItemTitle $op ?
+      $plan['conditions'][] = "
+        EXISTS (SELECT 1 FROM LibraryItem c
+                 WHERE c.ItemID = i.CollectionID
+                   AND c.ItemTitle $op ?)
       ";
-      $value = '%' . str_replace('%', '%%', $collection) . '%';
-      $sets[] = $this->session->select($query, [$value], 'column');
+      $plan['values'][] = '%' . str_replace('%', '%%', $collection) . '%';
     }
   }
 
-  private function filter_by_creator(&$sets) {
+  private function filter_by_creator(&$plan) {
     $creator = trim($this->parameters['creator'] ?? '');
     if (!empty($creator)) {
       $op = $this->parameters['creator-logic'] === 'nl' ? 'NOT LIKE' : 'LIKE';
-      $query = "
-        SELECT DISTINCT i.ItemID FROM LibraryItem i
-              LEFT JOIN LibraryPerson c ON c.PersonID = i.ComposerID
-               AND c.SearchKey $op ?
-              LEFT JOIN LibraryPerson l ON l.PersonID = i.LyricistID
-               AND l.SearchKey $op ?
-              LEFT JOIN LibraryPerson a ON a.PersonID = i.ArrangerID
-               AND a.SearchKey $op ?
-             WHERE c.PersonID IS NOT NULL
-                OR l.PersonID IS NOT NULL
-                OR a.PersonID IS NOT NULL
+      $plan['conditions'][] = "
+        EXISTS (SELECT 1 FROM LibraryPerson p
+                 WHERE p.PersonID IN (i.ComposerID, i.LyricistID, i.ArrangerID)
+                   AND p.SearchKey $op ?)
       ";
-      $val = '%' . str_replace('%', '%%', $creator) . '%';
-      $sets[] = $this->session->select($query, [$val, $val, $val], 'column');
+      $plan['values'][] = '%' . str_replace('%', '%%', $creator) . '%';
     }
   }
 
-  private function filter_by_date_added(&$sets) {
+  private function filter_by_date_added(&$plan) {
     if (!empty($this->parameters['added'])) {
       $value = $this->parameters['added'];
       $op = $this->parameters['added-logic'] === 'le' ? '<=' : '>=';
-      $query = "SELECT ItemID FROM LibraryItem WHERE DateAdded $op ?";
-      $sets[] = $this->session->select($query, [$value], 'column');
+      $plan['conditions'][] = "i.DateAdded $op ?";
+      $plan['values'][] = $value;
     }
   }
 
-  private function filter_by_keywords(&$sets) {
+  private function filter_by_keywords(&$plan) {
     if (!empty($this->parameters['keyword'])) {
       $values = $this->parameters['keyword'];
       $op = $this->parameters['keyword-logic'] === 'ni' ? 'NOT IN' : 'IN';
       $ph = implode(',', array_fill(0, count($values), '?'));
-      $query = "
-        SELECT DISTINCT LibraryItem FROM LibraryItemKeyword
-                  WHERE LibraryKeyword $op ($ph)
+      $plan['conditions'][] = "
+        EXISTS (SELECT 1 FROM LibraryItemKeyword k
+                 WHERE k.LibraryItem = i.ItemID
+                   AND k.LibraryKeyword $op ($ph))
       ";
-      $sets[] = $this->session->select($query, $values, 'column');
+      array_push($plan['values'], ...$values);
     }
   }
 
-  private function filter_by_loans(&$sets) {
+  private function filter_by_loans(&$plan) {
     if (!empty($this->parameters['on-loan'])) {
-      $query = '
-        SELECT DIStINCT LibraryItem FROM LibraryLoan
-         WHERE LoanReturned IS NULL
-      ';
-      if ($this->parameters['on-loan'] === 'no') {
-        $query = "SELECT ItemID FROM LibraryItem WHERE ItemID NOT IN ($query)";
-      }
-      $sets[] = $this->session->select($query, null, 'column');
+      $on_loan = $this->parameters['on-loan'] === 'no' ? 0 : 1;
+      $plan['joins']['summary'] = self::SUMMARY_JOIN;
+      $plan['conditions'][] = 'COALESCE(s.OnLoan, 0) = ?';
+      $plan['values'][] = $on_loan;
     }
   }
 
-  private function filter_by_number_of_copies(&$sets) {
+  // The copies on hand come from the most recent inventory record.
+  private function filter_by_number_of_copies(&$plan) {
     if (!empty($this->parameters['copies'])) {
       $value = $this->parameters['copies'];
       $op = $this->parameters['copies-logic'] === 'lt' ? '<' : '>=';
-      $this->session->db->query('CREATE TEMPORARY TABLE t1 (i INT, s CHAR(26))');
-      $this->session->db->query('CREATE TEMPORARY TABLE t2 (i INT, k INT)');
-      $this->session->db->query("
-        INSERT INTO t1
-        SELECT LibraryItem,
-               CONCAT(IFNULL(InStockDate, '0000-00-00'), ':',
-                      LPAD(CAST(InventoryID AS CHAR), 15, '0'))
-          FROM LibraryInventory
-      ");
-      $this->session->db->query('
-        INSERT INTO t2
-        SELECT i, RIGHT(m, 15)
-          FROM (SELECT i, MAX(s) AS m FROM t1 GROUP BY i) AS t
-      ');
-      $query = "
-        SELECT LibraryItem FROM LibraryInventory i
-          JOIN t2 ON t2.k = i.InventoryID
-         WHERE i.InStock $op ?
-      ";
-      $sets[] = $this->session->select($query, [$value], 'column');
+      $plan['joins']['summary'] = self::SUMMARY_JOIN;
+      $plan['conditions'][] = "s.CopiesOnHand $op ?";
+      $plan['values'][] = $value;
     }
   }
 
-  private function filter_by_owner(&$sets) {
+  private function filter_by_owner(&$plan) {
     if (!empty($this->parameters['owner'])) {
       $values = $this->parameters['owner'];
       $op = $this->parameters['owner-logic'] === 'ni' ? 'NOT IN' : 'IN';
       $ph = implode(',', array_fill(0, count($values), '?'));
-      $query = "SELECT ItemID FROM LibraryItem WHERE OwnerID $op ($ph)";
-      $sets[] = $this->session->select($query, $values, 'column');
+      $plan['conditions'][] = "i.OwnerID $op ($ph)";
+      array_push($plan['values'], ...$values);
     }
   }
 
-  private function filter_by_performances(&$sets) {
+  private function filter_by_performances(&$plan) {
     if (!empty($this->parameters['performance'])) {
       $value = $this->parameters['performance'];
       $op = $this->parameters['performance-logic'] === 'le' ? '<=' : '>=';
-      $query = "
-        SELECT LibraryItem, MAX(PerformanceDate) FROM LibraryPerformance
-      GROUP BY LibraryItem
-        HAVING MAX(PerformanceDate) $op ?
-      ";
-      $sets[] = $this->session->select($query, [$value], 'column');
+      $plan['joins']['summary'] = self::SUMMARY_JOIN;
+      $plan['conditions'][] = "s.LastPerformance $op ?";
+      $plan['values'][] = $value;
     }
   }
 
-  private function filter_by_season(&$sets) {
+  private function filter_by_season(&$plan) {
     if (!empty($this->parameters['season'])) {
       $values = $this->parameters['season'];
       $op = $this->parameters['season-logic'] === 'ni' ? 'NOT IN' : 'IN';
       $ph = implode(',', array_fill(0, count($values), '?'));
-      $query = "SELECT ItemID FROM LibraryItem WHERE SeasonID $op ($ph)";
-      $sets[] = $this->session->select($query, $values, 'column');
+      $plan['conditions'][] = "i.SeasonID $op ($ph)";
+      array_push($plan['values'], ...$values);
     }
   }
 
-  private function filter_by_tags(&$sets) {
+  private function filter_by_tags(&$plan) {
     if (!empty($this->parameters['tag'])) {
       $values = $this->parameters['tag'];
       $op = $this->parameters['tag-logic'] === 'ni' ? 'NOT IN' : 'IN';
       $ph = implode(',', array_fill(0, count($values), '?'));
-      $query = "
-        SELECT DISTINCT LibraryItem FROM LibraryItemTag
-                  WHERE LibraryTag $op ($ph)
+      $plan['conditions'][] = "
+        EXISTS (SELECT 1 FROM LibraryItemTag t
+                 WHERE t.LibraryItem = i.ItemID
+                   AND t.LibraryTag $op ($ph))
       ";
-      $sets[] = $this->session->select($query, $values, 'column');
+      array_push($plan['values'], ...$values);
     }
   }
 
-  private function filter_by_title(&$sets) {
+  private function filter_by_title(&$plan) {
     $title = trim($this->parameters['title'] ?? '');
     if (!empty($title)) {
       $op = $this->parameters['title-logic'] === 'nl' ? 'NOT LIKE' : 'LIKE';
-      $query = "
-        SELECT ItemID FROM LibraryItem
-         WHERE ItemTitle $op ? OR OtherTitle $op ?
-      ";
+      $plan['conditions'][] = "(i.ItemTitle $op ? OR i.OtherTitle $op ?)";
       $value = '%' . str_replace('%', '%%', $title) . '%';
-      $sets[] = $this->session->select($query, [$value, $value], 'column');
+      array_push($plan['values'], $value, $value);
     }
   }
 
   // Figure out which items match the filtering criteria.
   private function apply_filters() {
-    $query = 'SELECT ItemID FROM LibraryItem';
-    $sets = [$this->session->select($query, null, 'column')];
-    $this->filter_by_arrangement($sets);
-    $this->filter_by_cataloger($sets);
-    $this->filter_by_collection($sets);
-    $this->filter_by_creator($sets);
-    $this->filter_by_date_added($sets);
-    $this->filter_by_keywords($sets);
-    $this->filter_by_loans($sets);
-    $this->filter_by_number_of_copies($sets);
-    $this->filter_by_owner($sets);
-    $this->filter_by_performances($sets);
-    $this->filter_by_season($sets);
-    $this->filter_by_tags($sets);
-    $this->filter_by_title($sets);
-    $this->session->debug_log('sets: ' . json_encode(array_slice($sets, 1)));
-    $item_keys = array_intersect(...$sets);
-    sort($item_keys);
+    $started = microtime(true);
+    list($query, $values) = $this->plan_filters();
+    $item_keys = $this->session->select($query, $values, 'column');
+    $this->timings['filters'] = microtime(true) - $started;
     $this->session->debug_log('selected item keys: ' . json_encode($item_keys));
     return $item_keys;
   }
 
-  // Fetch the choices the user made for this report.
-  private function load_parameters() {
-    $query = 'SELECT parameters FROM report_request WHERE request_id = ?';
-    $parameters = $this->session->select($query, [$this->id], 'value');
+  // Turn the filtering criteria into a single query the DBMS can optimize.
+  private function plan_filters() {
+    $plan = ['joins' => [], 'conditions' => [], 'values' => []];
+    $this->filter_by_arrangement($plan);
+    $this->filter_by_cataloger($plan);
+    $this->filter_by_collection($plan);
+    $this->filter_by_creator($plan);
+    $this->filter_by_date_added($plan);
+    $this->filter_by_keywords($plan);
+    $this->filter_by_loans($plan);
+    $this->filter_by_number_of_copies($plan);
+    $this->filter_by_owner($plan);
+    $this->filter_by_performances($plan);
+    $this->filter_by_season($plan);
+    $this->filter_by_tags($plan);
+    $this->filter_by_title($plan);
+    $query = 'SELECT i.ItemID FROM LibraryItem i';
+    if (!empty($plan['joins'])) {
+      $query .= ' ' . implode(' ', $plan['joins']);
+    }
+    if (!empty($plan['conditions'])) {
+      $query .= ' WHERE ' . implode(' AND ', $plan['conditions']);
+    }
+    $query .= ' ORDER BY i.ItemID';
+    $this->session->debug_log("filter query: $query");
+    $this->session->debug_log('filter values: ' . json_encode($plan['values']));
+    return [$query, $plan['values']];
+  }
+
+  // Unpack the choices the user made for this report.
+  private function load_parameters($parameters) {
     $this->session->debug_log("report parameters: $parameters");
-    return json_decode($parameters, true);
+    $this->parameters = json_decode($parameters, true);
+    $this->title = $this->parameters['report-title'];
+    $this->format = $this->parameters['report-format'] ?? 'html';
+    $this->columns = $this->parameters['report-columns'];
   }
 
+  // Fetch the report request, with its status.
+  //
+  // Requests are always read from (and written to) the primary database,
+  // which has them as soon as they're queued.
+  private function load_request() {
+    $query = 'SELECT * FROM report_request WHERE request_id = ?';
+    return $this->session->on_primary(function() use ($query) {
+      return $this->session->select($query, [$this->id], 'row');
+    });
+  }
+
+  // Find the result the background worker stored for this report.
+  //
+  // Downloads are sent straight to the browser. Returns null if the
+  // result has been evicted from the cache.
+  private function load_result() {
+    $results = new Cache($this->session, 'report-results');
+    $extension = self::EXTENSIONS[$this->format] ?? 'json';
+    $path = $results->find("{$this->id}.$extension");
+    if (!$path) {
+      return null;
+    }
+    if ($extension !== 'json') {
+      $this->send_cached_file($path);
+    }
+    $payload = json_decode(file_get_contents($path), true);
+    $payload['rows'] = new \ArrayIterator($payload['rows']);
+    return $payload;
+  }
+
+  // Get the rows for the report, from the cache if we have them.
+  private function load_rows() {
+    $rows_key = $this->make_cache_key(false);
+    $rows = $this->cache->get($rows_key);
+    if ($rows !== null) {
+      $this->rows = json_decode($rows, true);
+      $this->cached = true;
+      $this->record_progress(90);
+    } else {
+      $this->item_ids = $this->apply_filters();
+      $this->record_progress(10);
+      $this->rows = $this->assemble_values();
+      $this->cache->put($rows_key, json_encode($this->rows));
+    }
+    $this->session->debug_log('report timings: ' . json_encode($this->timings));
+  }
+
+  // Get ready to use the cached rows and files for the current catalog.
+  private function open_cache() {
+    $this->cache = new Cache($this->session, 'reports');
+    $this->version = $this->session->catalog_version();
+
+    // A lagging replica reports an older version than the primary, so
+    // only purge when reading from the primary (otherwise requests for
+    // the two would keep purging each other's entries); the cache's
+    // size limit takes care of anything left behind.
+    if ($this->session->db === $this->session->primary) {
+      $this->cache->purge("{$this->version}-");
+    }
+  }
+
+  // Assemble the report for the HTML view.
+  private function make_payload($elapsed) {
+    return [
+      'status' => 'success',
+      'title' => $this->title,
+      'columns' => $this->columns,
+      'rows' => $this->rows,
+      'elapsed' => $elapsed,
+      'timings' => $this->timings,
+      'cached' => $this->cached,
+    ];
+  }
+
+  // Let anyone polling know how far along a background report is.
+  private function record_progress($percent) {
+    if ($this->background) {
+      $this->update_request(['progress' => $percent]);
+    }
+  }
+
+  // Tell the client where the report request stands.
+  //
+  // The elapsed time is how long the request has been waiting (if
+  // it's still queued), running, or how long it took (if it's done).
+  private function report_status($request) {
+    $status = $request['status'];
+    switch ($status) {
+    case 'queued':
+      $elapsed = self::seconds_since($request['requested']);
+      break;
+    case 'running':
+      $elapsed = self::seconds_since($request['started']);
+      break;
+    default:
+      $elapsed = (float)$request['elapsed'];
+    }
+    if (!in_array($status, ['done', 'failed'])) {
+      http_response_code(202);
+    }
+    return [
+      'status' => 'success',
+      'request_id' => (int)$this->id,
+      'request_status' => $status,
+      'progress' => (int)$request['progress'],
+      'elapsed' => $elapsed,
+      'message' => $request['error'],
+    ];
+  }
+
+  // Work out how long ago something recorded with local time happened.
+  private static function seconds_since($when) {
+    $timezone = new \DateTimeZone(Session::TIMEZONE);
+    $then = new \DateTime($when, $timezone);
+    return max(0.0, microtime(true) - (float)$then->format('U.u'));
+  }
+
+  // Record changes to the request's status.
+  private function update_request($values) {
+    $columns = array_map(fn($name) => "$name = ?", array_keys($values));
+    $columns = implode(', ', $columns);
+    $sql = "UPDATE report_request SET $columns WHERE request_id = ?";
+    $values = array_values($values);
+    $values[] = $this->id;
+    $this->session->on_primary(fn() => $this->session->execute($sql, $values));
+  }
+
+  // Get the values for each of the columns in the report.
+  //
+  // All of the columns come from a single query, whose rows are turned
+  // into the report's rows as they are fetched.
   private function assemble_values() {
-    // Now get the values for each of the columns in the report.
-    $this->session->db->query('CREATE TEMPORARY TABLE ReportKeys (k INTEGER)');
-    $stmt = $this->session->db->prepare('INSERT INTO ReportKeys (k) VALUES (?)');
-    foreach ($this->item_ids as $id) {
-      $stmt->execute([$id]);
+    $this->load_report_keys();
+    $started = microtime(true);
+    list($query, $columns) = $this->plan_columns();
+    $this->session->debug_log("report values query: $query");
+    $db = $this->session->db;
+    if ($db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'mysql') {
+      $db->exec('SET SESSION group_concat_max_len = ' . self::MAX_CONCAT_LENGTH);
     }
-    $rows = array_fill(0, count($this->item_ids), []);
+    $stmt = $this->session->execute($query);
+    $rows = [];
+    while ($values = $stmt->fetch(\PDO::FETCH_NUM)) {
+      $row = [];
+      foreach ($columns as $column) {
+        $row[] = $column($values);
+      }
+      $rows[] = $row;
+    }
+    $this->timings['values'] = microtime(true) - $started;
+    $this->record_progress(80);
+    return $this->sort_rows($rows);
+  }
+
+  // Turn the report's columns into a single query the DBMS can optimize.
+  //
+  // Each column adds the expressions it needs to the SELECT list (with
+  // the joins they use, shared by columns needing the same table) and a
+  // function which finds its value in a row of the query's results.
+  // Columns with multiple values per item (for example, keywords) get
+  // them from a correlated subquery which strings the values together.
+  private function plan_columns() {
+    $sqlite = $this->session->db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'sqlite';
+    $select = [];
+    $joins = [];
+    $columns = [];
     $report_column_config = $this->session->config['report_columns'];
-    foreach ($this->columns as $column) {
-      $config = json_decode(json_encode($report_column_config[$column]));
+    foreach ($this->columns as $n => $column) {
+      $config = (object)$report_column_config[$column];
+      $position = count($select);
       switch ($config->type) {
 
       case 'key':
-        $values = array_map(function($id) use ($config) {
-          return sprintf($config->format, $id);
-        }, $this->item_ids);
-        sort($values);
+        $select[] = 'i.ItemID';
+        $columns[] = fn($row) => sprintf($config->format, $row[$position]);
         break;
 
       case 'direct':
-        $query = "
-          SELECT i.{$config->value_column} FROM ReportKeys r
-            JOIN LibraryItem i ON i.ItemID = r.k
-        ORDER BY i.ItemID
-        ";
-        $values = $this->session->select($query, null, 'column');
-        if (!empty($config->format)) {
-          $values = array_map(function($value) use ($config) {
+        $select[] = "i.{$config->value_column}";
+        if (empty($config->format)) {
+          $columns[] = fn($row) => $row[$position];
+        } else {
+          $columns[] = function($row) use ($config, $position) {
+            $value = $row[$position];
             return $value ? sprintf($config->format, $value) : '';
-          }, $values);
+          };
         }
         break;
 
       case 'person':
-        $stmt = $this->session->db->query("
-          SELECT p.LastName, p.FirstName, p.Dates FROM ReportKeys r
-            JOIN LibraryItem i ON i.ItemID = r.k
-       LEFT JOIN LibraryPerson p ON p.PersonID = i.{$config->join_key}
-        ORDER BY i.ItemID
-        ");
-        $values = [];
-        while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
-          $value = trim($row[0]);
-          $forename = trim($row[1]);
-          $dates = trim($row[2]);
+        $joins["p$n"] = "LEFT JOIN LibraryPerson p$n ON p$n.PersonID = i.{$config->join_key}";
+        array_push($select, "p$n.LastName", "p$n.FirstName", "p$n.Dates");
+        $columns[] = function($row) use ($position) {
+          $value = trim($row[$position] ?? '');
+          $forename = trim($row[$position + 1] ?? '');
+          $dates = trim($row[$position + 2] ?? '');
           if ($forename) {
             $value .= ", $forename";
           }
           if ($dates) {
             $value .= " ($dates)";
           }
-          $values[] = $value;
-        }
+          return $value;
+        };
         break;
 
       case 'multiple':
-        $query = "SELECT DISTINCT r.k, v.{$config->value_column}";
-        $query .= " FROM {$config->value_table} v";
+        $value = "m$n.{$config->value_column}";
+        $from = "{$config->value_table} m$n";
         if (!empty($config->join_table)) {
-          $query .= " JOIN {$config->join_table} j";
-          $query .= " ON j.{$config->join_key} = v.{$config->value_key}";
-          $query .= ' JOIN ReportKeys r ON r.k = j.LibraryItem';
+          $from .= " JOIN {$config->join_table} j$n";
+          $from .= " ON j$n.{$config->join_key} = m$n.{$config->value_key}";
+          $conditions = ["j$n.LibraryItem = i.ItemID"];
         } else {
-          $query .= ' JOIN ReportKeys r ON r.k = v.LibraryItem';
+          $conditions = ["m$n.LibraryItem = i.ItemID"];
         }
         if (!empty($config->condition)) {
-          $query .= " {$config->condition}";
+          $conditions[] = preg_replace('/^\s*WHERE\s+/i', '', $config->condition);
         }
-        $query .= " ORDER BY v.{$config->value_column}";
-        $stmt = $this->session->db->query($query);
-        $map = [];
-        while ($row = $stmt->fetch(\PDO::FETCH_NUM)) {
-          list($id, $value) = $row;
-          if ($value) {
-            if (!array_key_exists($id, $map)) {
-              $map[$id] = [];
-            }
-            $map[$id][] = $value;
-          }
+        $conditions[] = "$value IS NOT NULL";
+        $where = implode(' AND ', $conditions);
+        $separator = self::VALUE_SEPARATOR;
+        if ($sqlite) {
+          // SQLite's GROUP_CONCAT() can't combine DISTINCT with a
+          // separator, so the values are sorted and deduplicated here
+          // (byte order, which is how SQLite compares them).
+          $select[] = "(SELECT GROUP_CONCAT($value, '$separator')
+                          FROM $from WHERE $where)";
+        } else {
+          $select[] = "(SELECT GROUP_CONCAT(DISTINCT $value ORDER BY $value
+                                            SEPARATOR '$separator')
+                          FROM $from WHERE $where)";
         }
-        $values = [];
-        foreach ($this->item_ids as $key) {
-          if (array_key_exists($key, $map)) {
-            $values[] = implode('; ', $map[$key]);
-          } else {
-            $values[] = '';
+        $columns[] = function($row) use ($position, $sqlite) {
+          $values = explode(self::VALUE_SEPARATOR, $row[$position] ?? '');
+          $values = array_filter($values);
+          if ($sqlite) {
+            $values = array_unique($values);
+            sort($values, SORT_STRING);
           }
-        }
+          return implode('; ', $values);
+        };
         break;
 
       case 'lookup':
-        $query = "
-          SELECT v.{$config->value_column} FROM ReportKeys r
-            JOIN LibraryItem i ON i.ItemID = r.k
-       LEFT JOIN {$config->value_table} v
-              ON v.{$config->value_key} = i.{$config->join_key}
-        ORDER BY r.k
-        ";
-        $values = $this->session->select($query, null, 'column');
+        $join = "LEFT JOIN {$config->value_table} l$n";
+        $join .= " ON l$n.{$config->value_key} = i.{$config->join_key}";
+        $joins["l$n"] = $join;
+        $select[] = "l$n.{$config->value_column}";
+        $columns[] = fn($row) => $row[$position];
         break;
 
       case 'inventory':
-        $query = "
-          SELECT (SELECT {$config->value_column}
-                    FROM LibraryInventory
-                   WHERE LibraryItem = r.k
-                ORDER BY CONCAT(IFNULL(InStockDate, '0000-00-00'), ':',
-                                LPAD(CAST(InventoryID AS CHAR), 15, '0')) DESC
-                   LIMIT 1) AS N,
-                 r.k
-            FROM ReportKeys r
-        ORDER BY r.k
-        ";
-        $values = $this->session->select($query, null, 'column');
+        $joins['s'] = self::SUMMARY_JOIN;
+        $joins['v'] = 'LEFT JOIN LibraryInventory v ON v.InventoryID = s.InventoryID';
+        $select[] = $config->value_column;
+        $columns[] = fn($row) => $row[$position];
         break;
 
       case 'last-performance':
-        $query = '
-          SELECT MAX(p.PerformanceDate), r.k FROM ReportKeys r
-       LEFT JOIN LibraryPerformance p ON p.LibraryItem = r.k
-        GROUP BY r.k
-        ORDER BY r.k
-        ';
-        $values = $this->session->select($query, null, 'column');
+        $joins['s'] = self::SUMMARY_JOIN;
+        $select[] = 's.LastPerformance';
+        $columns[] = fn($row) => $row[$position];
         break;
       }
+    }
+    $query = 'SELECT ' . implode(', ', $select);
+    $query .= ' FROM ReportKeys r JOIN LibraryItem i ON i.ItemID = r.k';
+    if (!empty($joins)) {
+      $query .= ' ' . implode(' ', $joins);
+    }
+    $query .= ' ORDER BY r.k';
+    return [$query, $columns];
+  }
+
+  // Fold a value to the form used for comparing it with other values.
+  private static function collation_key($value) {
+    return strtolower((string)iconv('UTF-8', 'ASCII//TRANSLIT', $value));
+  }
 
-      for ($i = 0; $i < count($rows); ++$i) {
-        $rows[$i][] = $values[$i];
+  // Find out how the user wants the rows to be ordered.
+  //
+  // The `report-sorting` parameter is either 'normal', 'reversed', or a
+  // list of column specifications, each of which can be a column name
+  // (with a leading '-' for descending order) or an array with `column`
+  // and `order` ('asc' or 'desc') members. The entire row is always used
+  // as the final sort key (ascending unless the order is 'reversed').
+  private function load_sort_specs() {
+    $sorting = $this->parameters['report-sorting'] ?? 'normal';
+    $specs = [];
+    if (is_array($sorting)) {
+      foreach ($sorting as $spec) {
+        if (is_string($spec)) {
+          $descending = str_starts_with($spec, '-');
+          $column = $descending ? substr($spec, 1) : $spec;
+        } else {
+          $column = $spec['column'] ?? '';
+          $descending = strtolower($spec['order'] ?? 'asc') === 'desc';
+        }
+        $position = array_search($column, $this->columns, true);
+        if ($position === false) {
+          $this->session->debug_log("ignoring sort on unknown column $column");
+          continue;
+        }
+        $specs[] = ['position' => $position, 'descending' => $descending];
       }
     }
-    usort($rows, function($a, $b) {
-      $a = iconv('UTF-8', 'ASCII//TRANSLIT', join("\t", $a));
-      $b = iconv('UTF-8', 'ASCII//TRANSLIT', join("\t", $b));
-      return strcasecmp($a, $b);
-    });
-    if ($this->parameters['report-sorting'] === 'reversed') {
-      $rows = array_reverse($rows);
+    $specs[] = ['position' => null, 'descending' => $sorting === 'reversed'];
+    return $specs;
+  }
+
+  // Sort the rows, computing each row's collation keys only once.
+  private function sort_rows($rows) {
+    $started = microtime(true);
+    $args = [];
+    foreach ($this->load_sort_specs() as $spec) {
+      $keys = [];
+      foreach ($rows as $row) {
+        if ($spec['position'] === null) {
+          $value = join("\t", $row);
+        } else {
+          $value = $row[$spec['position']] ?? '';
+        }
+        $keys[] = self::collation_key($value);
+      }
+      $args[] = $keys;
+      $args[] = $spec['descending'] ? SORT_DESC : SORT_ASC;
+      $args[] = SORT_STRING;
     }
+    $args[] = array_keys($rows);
+    array_multisort(...$args);
+    $sorted = [];
+    foreach (end($args) as $i) {
+      $sorted[] = $rows[$i];
+    }
+    $this->timings['sort'] = microtime(true) - $started;
+    return $sorted;
+  }
 
-    return $rows;
+  // Populate the ReportKeys table without a round trip for each item.
+  private function load_report_keys() {
+    $started = microtime(true);
+    $db = $this->session->db;
+    $sqlite = $db->getAttribute(\PDO::ATTR_DRIVER_NAME) === 'sqlite';
+
+    // A persistent connection may still have the table from an earlier request.
+    if ($sqlite) {
+      $db->exec('DROP TABLE IF EXISTS temp.ReportKeys');
+    } else {
+      $db->exec('DROP TEMPORARY TABLE IF EXISTS ReportKeys');
+    }
+    $db->exec('CREATE TEMPORARY TABLE ReportKeys (k INTEGER PRIMARY KEY)');
+    $count = count($this->item_ids);
+    if ($count > 0) {
+      $first = $this->item_ids[0];
+      $last = $this->item_ids[$count - 1];
+      if ($last - $first + 1 === $count) {
+        // Sorted, unique IDs spanning exactly $count values: no gaps.
+        $method = 'range';
+        $this->session->execute('
+          INSERT INTO ReportKeys (k)
+          SELECT ItemID FROM LibraryItem WHERE ItemID BETWEEN ? AND ?
+        ', [$first, $last]);
+      } elseif ($sqlite) {
+        $method = 'json';
+        $this->session->execute('
+          INSERT INTO ReportKeys (k) SELECT value FROM json_each(?)
+        ', [json_encode(array_map('intval', $this->item_ids))]);
+      } else {
+        $method = 'batches';
+        foreach (array_chunk($this->item_ids, self::KEY_BATCH_SIZE) as $ids) {
+          $ph = implode(',', array_fill(0, count($ids), '(?)'));
+          $this->session->execute("INSERT INTO ReportKeys (k) VALUES $ph", $ids);
+        }
+      }
+      $this->session->debug_log("loaded $count report keys using $method");
+    }
+    $this->timings['keys'] = microtime(true) - $started;
   }
 
-  // Render the report as an Excel workbook and return it to the browser.
-  private function write_excel() {
+  // Pick the filename used when the report is downloaded.
+  private function make_filename($extension) {
     $stamp = date('Ymd');
-    $filename = "{$this->title} {$stamp}-{$this->id}.xlsx";
+    $filename = "{$this->title} {$stamp}-{$this->id}.$extension";
     $this->session->debug_log("report filename: $filename");
-    $workbook = new Spreadsheet();
-    while ($workbook->getSheetCount() > 0) {
-      $workbook->removeSheetByIndex(0);
+    return $filename;
+  }
+
+  // Send the headers for a downloaded report.
+  private static function send_download_headers($extension, $filename) {
+    $content_type = self::CONTENT_TYPES[$extension];
+    header("Content-Type: $content_type");
+    header('Content-Disposition: attachment;filename="' . $filename . '"');
+    header('Cache-Control: max-age=0');
+    header('X-Filename: ' . $filename);
+  }
+
+  // Send a piece of a downloaded report, keeping a copy for the cache.
+  private function emit($chunk, $handle) {
+    if (!$this->background) {
+      echo $chunk;
+      flush();
+    }
+    if ($handle) {
+      fwrite($handle, $chunk);
+    }
+  }
+
+  // Drain the CSV buffer, sending what has accumulated there.
+  private function emit_buffer($buffer, $handle) {
+    rewind($buffer);
+    $this->emit(stream_get_contents($buffer), $handle);
+    ftruncate($buffer, 0);
+    rewind($buffer);
+  }
+
+  // Start a copy of a downloaded report for the cache.
+  private function open_cache_file() {
+    if (empty($this->cache_file)) {
+      return null;
+    }
+    return fopen($this->cache_file[2], 'w') ?: null;
+  }
+
+  // Add the copy of a downloaded report to the cache.
+  private function close_cache_file($handle) {
+    if ($handle) {
+      fclose($handle);
+      list($cache, $key, $path) = $this->cache_file;
+      $cache->put_file($key, $path);
+    }
+  }
+
+  // Return the report as comma-separated values, a batch at a time.
+  private function write_csv() {
+    if (!$this->background) {
+      self::send_download_headers('csv', $this->make_filename('csv'));
+    }
+    $handle = $this->open_cache_file();
+    $buffer = fopen('php://memory', 'w+');
+    fputcsv($buffer, $this->columns, ',', '"', '');
+    foreach ($this->rows as $i => $row) {
+      $values = array_map(fn($value) => trim($value ?? ''), $row);
+      fputcsv($buffer, $values, ',', '"', '');
+      if (($i + 1) % self::FLUSH_INTERVAL === 0) {
+        $this->emit_buffer($buffer, $handle);
+      }
+    }
+    $this->emit_buffer($buffer, $handle);
+    fclose($buffer);
+    $this->close_cache_file($handle);
+    $elapsed = microtime(true) - $this->session->start;
+    $this->session->debug_log("wrote CSV report in $elapsed seconds");
+  }
+
+  // Return the report as newline-delimited JSON objects, one per row.
+  private function write_ndjson() {
+    if (!$this->background) {
+      self::send_download_headers('ndjson', $this->make_filename('ndjson'));
     }
-    $worksheet = $workbook->createSheet();
-    $worksheet->setTitle('Report');
+    $handle = $this->open_cache_file();
+    $lines = '';
+    foreach ($this->rows as $i => $row) {
+      $lines .= json_encode(array_combine($this->columns, $row)) . "\n";
+      if (($i + 1) % self::FLUSH_INTERVAL === 0) {
+        $this->emit($lines, $handle);
+        $lines = '';
+      }
+    }
+    $this->emit($lines, $handle);
+    $this->close_cache_file($handle);
+    $elapsed = microtime(true) - $this->session->start;
+    $this->session->debug_log("wrote NDJSON report in $elapsed seconds");
+  }
+
+  // Render the report as an Excel workbook (and send it to the browser).
+  private function write_excel() {
     $config = $this->session->config['report_columns'];
-    for ($i = 1; $i <= count($this->columns); ++$i) {
-      $width = $config[$this->columns[$i - 1]]['width'];
-      $worksheet->getColumnDimensionByColumn($i)->setWidth($width);
-    }
-    $title_style = [
-      'font' => [
-        'bold' => true,
-        'size' => 12,
-        'color' => ['argb' => 'FF008000'],
-      ],
-      'alignment' => ['horizontal' => Alignment::HORIZONTAL_CENTER],
-    ];
-    $header_style = [
-      'font' => [
-        'bold' => true,
-        'color' => ['argb' => Color::COLOR_WHITE],
-      ],
-      'alignment' => [
-        'horizontal' => Alignment::HORIZONTAL_CENTER,
-        'vertical' => Alignment::VERTICAL_CENTER,
-      ],
-      'fill' => [
-        'fillType' => Fill::FILL_SOLID,
-        'startColor' => ['argb' => 'FF008000'],
-      ],
-    ];
-    $worksheet->setCellValue([1, 1], $this->title);
-    $worksheet->getStyle([1, 1])->applyFromArray($title_style);
-    $last_cell = self::column_row(count($this->columns), 1);
-    $worksheet->mergeCells("A1:{$last_cell}");
-    $c = 1;
+    $widths = [];
     foreach ($this->columns as $name) {
-      $worksheet->setCellValue([$c, 3], $name);
-      $worksheet->getStyle([$c++, 3])->applyFromArray($header_style);
+      $widths[] = $config[$name]['width'] ?? $config['default']['width'];
     }
-    $worksheet->freezePane('A4');
-    $r = 4;
+    $workbook = new Workbook('Report', $widths, 'A4');
+    $workbook->add_row([$this->title], Workbook::TITLE_STYLE);
+    $workbook->merge_cells(1, 1, count($this->columns), 1);
+    $workbook->add_row([]);
+    $workbook->add_row($this->columns, Workbook::HEADER_STYLE);
     foreach ($this->rows as $row) {
-      $c = 1;
+      $values = [];
       foreach ($row as $val) {
         if (is_numeric($val)) {
           if ((string)(int)$val === $val)
@@ -486,21 +922,275 @@ class Report {
         }
         elseif (is_string($val))
           $val = trim($val);
-        $worksheet->setCellValue([$c++, $r], $val);
+        $values[] = $val;
       }
-      $r++;
+      $workbook->add_row($values);
+    }
+    if (empty($this->cache_file)) {
+      $path = tempnam(sys_get_temp_dir(), 'ml-xlsx-');
+    } else {
+      list($cache, $key, $path) = $this->cache_file;
+    }
+    try {
+      $workbook->save($path);
+    } catch (\Exception $e) {
+      @unlink($path);
+      if ($this->background) {
+        throw $e;  // run() marks the request as failed
+      }
+      $message = $e->getMessage();
+      error_log($message);
+      $this->update_request(['status' => 'failed', 'error' => $message]);
+      http_response_code(500);
+      $this->session->reply(['status' => 'failure', 'message' => $message]);
+    }
+    if (!$this->background) {
+      self::send_download_headers('xlsx', $this->make_filename('xlsx'));
+      header('Content-transfer-encoding: binary');
+      header('Content-Length: ' . filesize($path));
+      readfile($path);
+    }
+    if (empty($this->cache_file)) {
+      unlink($path);
+    } else {
+      $cache->put_file($key, $path);
     }
-    header('Content-Type: application/' .
-           'vnd.openxmlformats-officedocument.spreadsheetml.sheet');
-    header('Content-Disposition: attachment;filename="' . $filename . '"');
-    header('Content-transfer-encoding: binary');
-    header('Cache-Control: max-age=0');
-    header('X-Filename: ' . $filename);
-    $writer = new Xlsx($workbook);
-    $writer->save('php://output');
     $elapsed = microtime(true) - $this->session->start;
-    $this->session->debug_log("sent Excel report in $elapsed seconds");
-    exit();
+    $this->session->debug_log("wrote Excel report in $elapsed seconds");
+  }
+
+  // Render the report in the format the user asked for.
+  private function write_file() {
+    switch ($this->format) {
+    case 'excel':
+      $this->session->debug_log('writing excel workbook');
+      $this->write_excel();
+      break;
+    case 'csv':
+      $this->write_csv();
+      break;
+    case 'ndjson':
+      $this->write_ndjson();
+      break;
+    }
+  }
+
+}
+
+// Minimal Excel workbook writer whose memory use doesn't grow with the
+// number of rows. Rows are appended to the worksheet XML in a temporary
+// file as they are added, using inline strings so that no shared string
+// table has to be held in memory, and the package is zipped on disk.
+class Workbook {
+
+  const DEFAULT_STYLE = 0;
+  const TITLE_STYLE = 1;
+  const HEADER_STYLE = 2;
+  const MAX_STRING_LENGTH = 32767;
+  const NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main';
+  const REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships';
+  const PKG_NS = 'http://schemas.openxmlformats.org/package/2006';
+  const CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml';
+  const STYLES = <<<XML
+<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="3">
+<font><sz val="11"/><name val="Calibri"/></font>
+<font><b/><sz val="12"/><color rgb="FF008000"/><name val="Calibri"/></font>
+<font><b/><sz val="11"/><color rgb="FFFFFFFF"/><name val="Calibri"/></font>
+</fonts>
+<fills count="3">
+<fill><patternFill patternType="none"/></fill>
+<fill><patternFill patternType="gray125"/></fill>
+<fill><patternFill patternType="solid"><fgColor rgb="FF008000"/><bgColor rgb="FF008000"/></patternFill></fill>
+</fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="3">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1" applyAlignment="1"><alignment horizontal="center"/></xf>
+<xf numFmtId="0" fontId="2" fillId="2" borderId="0" xfId="0" applyFont="1" applyFill="1" applyAlignment="1"><alignment horizontal="center" vertical="center"/></xf>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>
+XML;
+
+  private $merged = [];
+  private $path;
+  private $row = 0;
+  private $sheet;
+  private $title;
+
+  // Start the worksheet, with the column widths and frozen pane settings.
+  public function __construct($title, $widths, $freeze = null) {
+    $this->title = $title;
+    $this->path = tempnam(sys_get_temp_dir(), 'ml-sheet-');
+    $this->sheet = fopen($this->path, 'w');
+    $ns = self::NS;
+    $xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' . "\n";
+    $xml .= "<worksheet xmlns=\"$ns\">";
+    $xml .= '<sheetViews><sheetView workbookViewId="0">';
+    if ($freeze) {
+      $rows = (int)preg_replace('/^[A-Z]+/', '', $freeze) - 1;
+      $xml .= "<pane ySplit=\"$rows\" topLeftCell=\"$freeze\"";
+      $xml .= ' activePane="bottomLeft" state="frozen"/>';
+      $xml .= '<selection pane="bottomLeft"/>';
+    }
+    $xml .= '</sheetView></sheetViews>';
+    $xml .= '<sheetFormatPr defaultRowHeight="15"/>';
+    if (!empty($widths)) {
+      $xml .= '<cols>';
+      foreach (array_values($widths) as $i => $width) {
+        $n = $i + 1;
+        $xml .= "<col min=\"$n\" max=\"$n\" width=\"$width\" customWidth=\"1\"/>";
+      }
+      $xml .= '</cols>';
+    }
+    $xml .= '<sheetData>';
+    fwrite($this->sheet, $xml);
+  }
+
+  // Clean up if the workbook is abandoned before it is sent.
+  public function __destruct() {
+    if (is_resource($this->sheet)) {
+      fclose($this->sheet);
+    }
+    if ($this->path && file_exists($this->path)) {
+      unlink($this->path);
+    }
+  }
+
+  // Append the next row to the worksheet (an empty array skips a row).
+  public function add_row($values, $style = self::DEFAULT_STYLE) {
+    $r = ++$this->row;
+    if (empty($values)) {
+      return;
+    }
+    $xml = "<row r=\"$r\">";
+    $c = 0;
+    foreach ($values as $value) {
+      $ref = self::column_row(++$c, $r);
+      $s = $style ? " s=\"$style\"" : '';
+      if (is_int($value) || is_float($value)) {
+        $xml .= "<c r=\"$ref\"$s><v>$value</v></c>";
+      } elseif ($value !== null && $value !== '') {
+        $value = self::escape($value);
+        $xml .= "<c r=\"$ref\"$s t=\"inlineStr\"><is><t xml:space=\"preserve\">";
+        $xml .= "$value</t></is></c>";
+      } elseif ($style) {
+        $xml .= "<c r=\"$ref\"$s/>";
+      }
+    }
+    $xml .= '</row>';
+    fwrite($this->sheet, $xml);
+  }
+
+  // Convert a column number (starting with 1) and row to a cell reference.
+  public static function column_row($column, $row) {
+    $dividend = $column;
+    $letter = '';
+    while ($dividend > 0) {
+        $modulo = ($dividend - 1) % 26;
+        $letter = chr(65 + $modulo) . $letter;
+        $dividend = intval(($dividend - $modulo) / 26);
+    }
+    return "$letter$row";
+  }
+
+  // Remember a block of cells to be merged when the sheet is finished.
+  public function merge_cells($first_column, $first_row, $last_column, $last_row) {
+    $from = self::column_row($first_column, $first_row);
+    $to = self::column_row($last_column, $last_row);
+    if ($from !== $to) {
+      $this->merged[] = "$from:$to";
+    }
+  }
+
+  // Finish the package and write it to the specified location.
+  //
+  // Throws an exception if the package can't be written, rather than
+  // leaving a missing or partial file behind to be sent (and cached).
+  public function save($path) {
+    $xml = '</sheetData>';
+    if (!empty($this->merged)) {
+      $count = count($this->merged);
+      $xml .= "<mergeCells count=\"$count\">";
+      foreach ($this->merged as $ref) {
+        $xml .= "<mergeCell ref=\"$ref\"/>";
+      }
+      $xml .= '</mergeCells>';
+    }
+    $xml .= '<pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75"';
+    $xml .= ' header="0.3" footer="0.3"/></worksheet>';
+    fwrite($this->sheet, $xml);
+    fclose($this->sheet);
+    $zip = new \ZipArchive();
+    $result = $zip->open($path, \ZipArchive::CREATE | \ZipArchive::OVERWRITE);
+    if ($result !== true) {
+      throw new \Exception("unable to create workbook $path (error $result)");
+    }
+    $zip->addFromString('[Content_Types].xml', $this->content_types());
+    $zip->addFromString('_rels/.rels', $this->package_relationships());
+    $zip->addFromString('xl/workbook.xml', $this->workbook());
+    $zip->addFromString('xl/_rels/workbook.xml.rels', $this->relationships());
+    $zip->addFromString('xl/styles.xml', self::STYLES);
+    if (!$zip->addFile($this->path, 'xl/worksheets/sheet1.xml')) {
+      $error = $zip->getStatusString();
+      $zip->close();
+      throw new \Exception("unable to add worksheet to $path: $error");
+    }
+    if ($zip->close() === false) {
+      throw new \Exception("unable to write workbook $path");
+    }
+  }
+
+  private function content_types() {
+    $ns = self::PKG_NS . '/content-types';
+    $type = self::CONTENT_TYPE;
+    return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' . "\n"
+      . "<Types xmlns=\"$ns\">"
+      . '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+      . '<Default Extension="xml" ContentType="application/xml"/>'
+      . "<Override PartName=\"/xl/workbook.xml\" ContentType=\"$type.sheet.main+xml\"/>"
+      . "<Override PartName=\"/xl/worksheets/sheet1.xml\" ContentType=\"$type.worksheet+xml\"/>"
+      . "<Override PartName=\"/xl/styles.xml\" ContentType=\"$type.styles+xml\"/>"
+      . '</Types>';
+  }
+
+  private static function escape($value) {
+    $value = preg_replace('/[\x00-\x08\x0B\x0C\x0E-\x1F]/', '', (string)$value);
+    $value = mb_substr($value, 0, self::MAX_STRING_LENGTH);
+    return htmlspecialchars($value, ENT_XML1 | ENT_QUOTES, 'UTF-8');
+  }
+
+  private function package_relationships() {
+    $ns = self::PKG_NS . '/relationships';
+    $type = self::REL_NS . '/officeDocument';
+    return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' . "\n"
+      . "<Relationships xmlns=\"$ns\">"
+      . "<Relationship Id=\"rId1\" Type=\"$type\" Target=\"xl/workbook.xml\"/>"
+      . '</Relationships>';
+  }
+
+  private function relationships() {
+    $ns = self::PKG_NS . '/relationships';
+    $sheet = self::REL_NS . '/worksheet';
+    $styles = self::REL_NS . '/styles';
+    return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' . "\n"
+      . "<Relationships xmlns=\"$ns\">"
+      . "<Relationship Id=\"rId1\" Type=\"$sheet\" Target=\"worksheets/sheet1.xml\"/>"
+      . "<Relationship Id=\"rId2\" Type=\"$styles\" Target=\"styles.xml\"/>"
+      . '</Relationships>';
+  }
+
+  private function workbook() {
+    $ns = self::NS;
+    $rel_ns = self::REL_NS;
+    $title = self::escape($this->title);
+    return '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' . "\n"
+      . "<workbook xmlns=\"$ns\" xmlns:r=\"$rel_ns\">"
+      . "<sheets><sheet name=\"$title\" sheetId=\"1\" r:id=\"rId1\"/></sheets>"
+      . '</workbook>';
   }
 
 }
@@ -0,0 +1,184 @@
+<?php
+
+/**
+ * Full-text index for the titles and creators of catalog items.
+ *
+ * SQLite uses an FTS5 virtual table (keyed by rowid) and MySQL uses
+ * an InnoDB table with FULLTEXT indexes. Either way the table holds
+ * one row per item, with the item's titles in one column and the
+ * search keys for its composer and arranger in the other.
+ */
+
+namespace MusicLibrary\Search;
+
+class Index {
+
+  const BATCH_SIZE = 500;
+
+  public $db;
+  public $driver;
+
+  public function __construct($db) {
+    $this->db = $db;
+    $this->driver = $db->getAttribute(\PDO::ATTR_DRIVER_NAME);
+  }
+
+  // Create the index table if it isn't already there.
+  public function create() {
+    if ($this->driver === 'sqlite') {
+      $this->db->exec("
+        CREATE VIRTUAL TABLE IF NOT EXISTS LibraryItemSearch
+        USING fts5(Titles, Creators,
+                   tokenize = 'unicode61 remove_diacritics 2')
+      ");
+    } else {
+      $this->db->exec('
+        CREATE TABLE IF NOT EXISTS LibraryItemSearch (
+          ItemID INTEGER NOT NULL,
+          Titles TEXT,
+          Creators TEXT,
+          PRIMARY KEY (ItemID),
+          FULLTEXT (Titles),
+          FULLTEXT (Creators)
+        ) ENGINE=InnoDB
+      ');
+    }
+  }
+
+  // Assemble the pieces needed to add the search to a query of items.
+  //
+  // Returns null if there are no words to search for. Otherwise, the
+  // array returned has the join clause, the conditions (and their
+  // values), and an ORDER BY expression ranking the best matches first
+  // (with its own values, which follow the conditions' values).
+  public function plan($titles, $creators) {
+    $titles = self::terms($titles);
+    $creators = self::terms($creators);
+    if (empty($titles) && empty($creators)) {
+      return null;
+    }
+    if ($this->driver === 'sqlite') {
+      $expressions = [];
+      foreach (['Titles' => $titles, 'Creators' => $creators] as $column => $terms) {
+        if (!empty($terms)) {
+          $terms = array_map(fn($term) => "\"$term\"*", $terms);
+          $expressions[] = "{{$column}} : (" . implode(' AND ', $terms) . ')';
+        }
+      }
+      return [
+        'join' => 'JOIN LibraryItemSearch ON LibraryItemSearch.rowid = i.ItemID',
+        'conditions' => ['LibraryItemSearch MATCH ?'],
+        'values' => [implode(' AND ', $expressions)],
+        'order' => 'LibraryItemSearch.rank',
+        'order_values' => [],
+      ];
+    }
+    $plan = [
+      'join' => 'JOIN LibraryItemSearch s ON s.ItemID = i.ItemID',
+      'conditions' => [],
+      'values' => [],
+      'order' => [],
+      'order_values' => [],
+    ];
+    foreach (['Titles' => $titles, 'Creators' => $creators] as $column => $terms) {
+      if (!empty($terms)) {
+        $match = "MATCH(s.$column) AGAINST (? IN BOOLEAN MODE)";
+        $value = implode(' ', array_map(fn($term) => "+$term*", $terms));
+        $plan['conditions'][] = $match;
+        $plan['values'][] = $value;
+        $plan['order'][] = $match;
+        $plan['order_values'][] = $value;
+      }
+    }
+    $plan['order'] = '(' . implode(' + ', $plan['order']) . ') DESC';
+    return $plan;
+  }
+
+  // Throw away the index and build it again from scratch.
+  //
+  // The table is created first, because MySQL commits DDL implicitly;
+  // the index is then replaced in a single transaction (unless the
+  // caller already has one open), so searches never see it half empty.
+  public function rebuild() {
+    $this->create();
+    $owner = !$this->db->inTransaction();
+    if ($owner) {
+      $this->db->beginTransaction();
+    }
+    try {
+      $this->db->exec('DELETE FROM LibraryItemSearch');
+      $this->db->exec($this->populate_sql(''));
+      $count = $this->db->query('SELECT COUNT(*) FROM LibraryItemSearch')->fetchColumn();
+      if ($owner) {
+        $this->db->commit();
+      }
+    } catch (\Exception $e) {
+      if ($owner && $this->db->inTransaction()) {
+        $this->db->rollBack();
+      }
+      throw $e;
+    }
+    return $count;
+  }
+
+  // Drop an item which has been deleted from the catalog.
+  public function remove($item_id) {
+    $key = $this->key_column();
+    $stmt = $this->db->prepare("DELETE FROM LibraryItemSearch WHERE $key = ?");
+    $stmt->execute([$item_id]);
+  }
+
+  // Bring the index entries for the specified items up to date.
+  public function update($item_ids) {
+    $key = $this->key_column();
+    foreach (array_chunk($item_ids, self::BATCH_SIZE) as $ids) {
+      $ph = implode(',', array_fill(0, count($ids), '?'));
+      $sql = "DELETE FROM LibraryItemSearch WHERE $key IN ($ph)";
+      $stmt = $this->db->prepare($sql);
+      $stmt->execute($ids);
+      $stmt = $this->db->prepare($this->populate_sql("WHERE i.ItemID IN ($ph)"));
+      $stmt->execute($ids);
+    }
+  }
+
+  // Refresh the entries for items whose composer or arranger has changed.
+  public function update_for_person($person_id) {
+    $stmt = $this->db->prepare('
+      SELECT ItemID FROM LibraryItem WHERE ComposerID = ? OR ArrangerID = ?
+    ');
+    $stmt->execute([$person_id, $person_id]);
+    $this->update($stmt->fetchAll(\PDO::FETCH_COLUMN));
+  }
+
+  // Which column of the index table holds the item's ID?
+  private function key_column() {
+    return $this->driver === 'sqlite' ? 'rowid' : 'ItemID';
+  }
+
+  // Create the SQL for adding index entries for a set of items.
+  private function populate_sql($where) {
+    if ($this->driver === 'sqlite') {
+      $key = 'rowid';
+      $titles = "i.ItemTitle || ' ' || IFNULL(i.OtherTitle, '')";
+      $creators = "IFNULL(c.SearchKey, '') || ' ' || IFNULL(a.SearchKey, '')";
+    } else {
+      $key = 'ItemID';
+      $titles = "CONCAT_WS(' ', i.ItemTitle, i.OtherTitle)";
+      $creators = "CONCAT_WS(' ', c.SearchKey, a.SearchKey)";
+    }
+    return "
+      INSERT INTO LibraryItemSearch ($key, Titles, Creators)
+      SELECT i.ItemID, $titles, $creators
+        FROM LibraryItem i
+   LEFT JOIN LibraryPerson c ON c.PersonID = i.ComposerID
+   LEFT JOIN LibraryPerson a ON a.PersonID = i.ArrangerID
+      $where
+    ";
+  }
+
+  // Break a search string into the words we'll look for.
+  private static function terms($text) {
+    return preg_split('/[^\p{L}\p{N}]+/u', $text ?? '', -1, PREG_SPLIT_NO_EMPTY);
+  }
+
+}
@@ -0,0 +1,114 @@
+<?php
+
+/**
+ * Values derived from each catalog item's subrecords.
+ *
+ * The reports filter and display the copies on hand from an item's
+ * latest inventory record, the date it was last performed, and whether
+ * it is out on loan. Rather than work those out from the subrecord
+ * tables for every item on every report, they are kept (one row per
+ * item) in LibraryItemSummary, which is brought up to date whenever an
+ * item's subrecords are saved.
+ */
+
+namespace MusicLibrary\Summary;
+
+class ItemSummary {
+
+  const BATCH_SIZE = 500;
+
+  public $db;
+
+  public function __construct($db) {
+    $this->db = $db;
+  }
+
+  // Create the summary table if it isn't already there.
+  public function create() {
+    $this->db->exec('
+      CREATE TABLE IF NOT EXISTS LibraryItemSummary (
+        ItemID INTEGER NOT NULL,
+        InventoryID INTEGER,
+        CopiesOnHand INTEGER,
+        LastPerformance DATE,
+        OnLoan INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (ItemID)
+      )
+    ');
+  }
+
+  // Throw away the summaries and derive them again from scratch.
+  //
+  // As with the search index, the table is created before the
+  // transaction in which the summaries are replaced.
+  public function rebuild() {
+    $this->create();
+    $owner = !$this->db->inTransaction();
+    if ($owner) {
+      $this->db->beginTransaction();
+    }
+    try {
+      $this->db->exec('DELETE FROM LibraryItemSummary');
+      $this->db->exec(self::populate_sql(''));
+      $count = $this->db->query('SELECT COUNT(*) FROM LibraryItemSummary')->fetchColumn();
+      if ($owner) {
+        $this->db->commit();
+      }
+    } catch (\Exception $e) {
+      if ($owner && $this->db->inTransaction()) {
+        $this->db->rollBack();
+      }
+      throw $e;
+    }
+    return $count;
+  }
+
+  // Drop the summary for an item which has been deleted from the catalog.
+  public function remove($item_id) {
+    $stmt = $this->db->prepare('DELETE FROM LibraryItemSummary WHERE ItemID = ?');
+    $stmt->execute([$item_id]);
+  }
+
+  // Bring the summaries for the specified items up to date.
+  public function update($item_ids) {
+    foreach (array_chunk($item_ids, self::BATCH_SIZE) as $ids) {
+      $ph = implode(',', array_fill(0, count($ids), '?'));
+      $sql = "DELETE FROM LibraryItemSummary WHERE ItemID IN ($ph)";
+      $stmt = $this->db->prepare($sql);
+      $stmt->execute($ids);
+      $stmt = $this->db->prepare(self::populate_sql("WHERE i.ItemID IN ($ph)"));
+      $stmt->execute($ids);
+    }
+  }
+
+  // Create the SQL for adding summaries for a set of items.
+  //
+  // The latest inventory record is the one with the most recent date
+  // (ties going to the one entered last).
+  private static function populate_sql($where) {
+    $latest = '
+      SELECT %s FROM LibraryInventory v
+       WHERE v.LibraryItem = i.ItemID
+    ORDER BY v.InStockDate DESC, v.InventoryID DESC
+       LIMIT 1
+    ';
+    $inventory_id = sprintf($latest, 'v.InventoryID');
+    $in_stock = sprintf($latest, 'v.InStock');
+    return "
+      INSERT INTO LibraryItemSummary (ItemID, InventoryID, CopiesOnHand,
+                                      LastPerformance, OnLoan)
+      SELECT i.ItemID,
+             ($inventory_id),
+             ($in_stock),
+             (SELECT MAX(p.PerformanceDate) FROM LibraryPerformance p
+               WHERE p.LibraryItem = i.ItemID),
+             CASE WHEN EXISTS (SELECT 1 FROM LibraryLoan l
+                                WHERE l.LibraryItem = i.ItemID
+                                  AND l.LoanReturned IS NULL)
+                  THEN 1 ELSE 0 END
+        FROM LibraryItem i
+      $where
+    ";
+  }
+
+}
@@ -2,6 +2,11 @@
 
 namespace MusicLibrary\Lookup;
 
+require_once 'search.php';
+
+use MusicLibrary\Search\Index;
+use MusicLibrary\Utilities\Cache;
+
 class Tables {
 
   public $session;
@@ -10,6 +15,49 @@ class Tables {
     $this->session = $session;
   }
 
+  // Assemble several picklists (e.g., ?names=person,company) at once.
+  //
+  // The lists only change when the catalog's version does, so that
+  // version determines the ETag, and the lists themselves are cached.
+  public function bundle() {
+    $names = array_filter(array_map('trim', explode(',', $_GET['names'] ?? '')));
+    $names = array_unique($names);
+    sort($names);
+    $record_types = [];
+    foreach ($names as $name) {
+      $record_type = $this->session->config['record_types'][$name] ?? null;
+      if (empty($record_type) || $record_type === 'LibraryItem') {
+        http_response_code(400);
+        $message = "$name picklist not supported";
+        error_log($message);
+        return ['status' => 'failure', 'message' => $message];
+      }
+      $record_types[$name] = $record_type;
+    }
+    $version = $this->session->catalog_version();
+    $this->session->check_etag(sha1("$version-" . implode(',', $names)));
+    $cache = new Cache($this->session, 'picklists');
+    if ($this->session->db === $this->session->primary) {
+      $cache->purge("$version-");  // see Report::open_cache()
+    }
+    $picklists = [];
+    foreach ($record_types as $name => $record_type) {
+      $key = "$version-$name.json";
+      $json = $cache->get($key);
+      if ($json === null) {
+        $list = $this->list($record_type);
+        if ($list instanceof \Traversable) {
+          $list = iterator_to_array($list, false);
+        }
+        $picklists[$name] = $list;
+        $cache->put($key, json_encode($picklists[$name]));
+      } else {
+        $picklists[$name] = json_decode($json, true);
+      }
+    }
+    return $picklists;
+  }
+
   // Delete a record in a lookup table.
   public function delete() {
     $this->session->verify_not_readonly();
@@ -28,25 +76,26 @@ class Tables {
     $config = $this->session->config;
     $primary_key = $config['tables'][$record_type]['primary_key'];
     $query = "DELETE FROM $record_type WHERE $primary_key = ?";
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare($query);
-      $stmt->execute([$record_id]);
-      $stmt = $this->session->db->prepare("
+    $save = function() use ($query, $record_id, $record_type) {
+      $this->session->execute($query, [$record_id]);
+      if ($record_type === 'LibraryPerson') {
+        (new Index($this->session->db))->update_for_person($record_id);
+      }
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'DELETE', ?, ?)
-      ");
-      $stmt->execute([
+      ", [
         $this->session->user->name,
         $this->session->localtime,
         $record_type,
         $record_id,
       ]);
-      $this->session->db->commit();
+    };
+    try {
+      $this->session->transaction($save);
       return ['status' => 'success'];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -57,7 +106,7 @@ class Tables {
   // Fetch a single record from a lookup table for editing.
   public function get() {
     if (empty($this->session->record_id))
-      return $this->list();
+      return $this->list($this->session->record_type);
     $record_id = $this->session->record_id;
     $record_type = $this->session->record_type;
     $record_type || die("unsupported entity type $this->session->endpoint");
@@ -131,18 +180,18 @@ class Tables {
     $sql = "INSERT INTO $record_type ($columns) VALUES ($placeholders)";
     $this->session->debug_log($sql);
     $this->session->debug_log(json_encode($values));
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare($sql);
-      $stmt->execute($values);
+    $save = function() use ($sql, $values, $record_type) {
+      $this->session->execute($sql, $values);
       $id = $this->session->db->lastInsertId();
-      $stmt = $this->session->db->prepare("
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'INSERT', ?, ?)
-      ");
-      $stmt->execute([$this->session->user->name, $this->session->localtime, $record_type, $id]);
-      $this->session->db->commit();
+      ", [$this->session->user->name, $this->session->localtime, $record_type, $id]);
+      return $id;
+    };
+    try {
+      $id = $this->session->transaction($save);
       http_response_code(201);
       $response = ['status' => 'success', 'id' => $id, 'display' => $key];
       $this->session->debug_log('response: ' . json_encode($response));
@@ -150,7 +199,6 @@ class Tables {
     } catch (\Exception $e) {
       $message = $e->getMessage();
       error_log($message);
-      $this->session->db->rollback();
       http_response_code(500);
       return ['status' => 'failure', 'message' => $message];
     }
@@ -186,25 +234,26 @@ class Tables {
     $sql = "UPDATE $record_type SET $assignments WHERE $primary_key = ?";
     $this->session->debug_log($sql);
     $this->session->debug_log(json_encode($values));
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare($sql);
-      $stmt->execute($values);
-      $stmt = $this->session->db->prepare("
+    $save = function() use ($sql, $values, $record_id, $record_type) {
+      $this->session->execute($sql, $values);
+      if ($record_type === 'LibraryPerson') {
+        (new Index($this->session->db))->update_for_person($record_id);
+      }
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'UPDATE', ?, ?)
-      ");
-      $stmt->execute([
+      ", [
         $this->session->user->name,
         $this->session->localtime,
         $record_type,
         $record_id,
       ]);
-      $this->session->db->commit();
+    };
+    try {
+      $this->session->transaction($save);
       return ['status' => 'success', 'display' => $display];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -213,8 +262,10 @@ class Tables {
   }
 
   // Assemble the ID and display values for a picklist.
-  private function list() {
-    $record_type = $this->session->record_type;
+  //
+  // The values come back as a generator, so that reply() can stream
+  // them to the client as they're fetched.
+  private function list($record_type) {
     switch ($record_type) {
     case 'LibraryCollection':
       $query = "
@@ -223,7 +274,7 @@ class Tables {
          WHERE IsCollection = 'Y'
       ORDER BY ItemTitle
       ";
-      return $this->session->select($query);
+      return $this->session->cursor($query);
     case 'LibraryAccompaniment':
     case 'LibraryArrangement':
     case 'LibraryFormat':
@@ -240,7 +291,7 @@ class Tables {
         $query .= 'SortPosition AS sort, ';
       $query .= "Comments as comments FROM $record_type ORDER BY $sort";
       $this->session->debug_log($query);
-      return $this->session->select($query);
+      return $this->session->cursor($query);
     case 'LibraryTag':
       $query = '
         SELECT t.TagID, g.TagGroupName, t.TagName, t.Comments
@@ -249,52 +300,51 @@ class Tables {
             ON g.TagGroupID = t.TagGroup
       ORDER BY g.TagGroupName, t.TagName
       ';
-      $rows = $this->session->select($query, null, 'obj');
-      $payload = [];
-      foreach ($rows as $row) {
-        $group = trim($row->TagGroupName);
-        $tag = trim($row->TagName);
-        $values = [
-          'id' => $row->TagID,
-          'display' => "$group: $tag",
-          'comments' => $row->Comments,
-        ];
-        $payload[] = $values;
-      }
-      return $payload;
+      $rows = $this->session->cursor($query, null, \PDO::FETCH_OBJ);
+      return (function() use ($rows) {
+        foreach ($rows as $row) {
+          $group = trim($row->TagGroupName);
+          $tag = trim($row->TagName);
+          yield [
+            'id' => $row->TagID,
+            'display' => "$group: $tag",
+            'comments' => $row->Comments,
+          ];
+        }
+      })();
     case 'LibraryPerson':
       $query = '
         SELECT PersonID, LastName, FirstName, Dates
           FROM LibraryPerson
       ORDER BY SearchKey
       ';
-      $rows = $this->session->select($query, null, 'obj');
-      $payload = [];
-      foreach ($rows as $row) {
-        $name = $row->LastName;
-        if ($row->FirstName) {
-          $name .= ", {$row->FirstName}";
+      $rows = $this->session->cursor($query, null, \PDO::FETCH_OBJ);
+      return (function() use ($rows) {
+        foreach ($rows as $row) {
+          $name = $row->LastName;
+          if ($row->FirstName) {
+            $name .= ", {$row->FirstName}";
+          }
+          if ($row->Dates) {
+            $name .= " ({$row->Dates})";
+          }
+          yield ['id' => $row->PersonID, 'display' => $name];
         }
-        if ($row->Dates) {
-          $name .= " ({$row->Dates})";
-        }
-        $payload[] = ['id' => $row->PersonID, 'display' => $name];
-      }
-      return $payload;
+      })();
     case 'LibraryCompany':
       $query = '
         SELECT CompanyID AS id, CompanyName AS display
           FROM LibraryCompany
       ORDER BY CompanyName
       ';
-      return $this->session->select($query);
+      return $this->session->cursor($query);
     case 'LibraryTagGroup':
       $query = '
         SELECT TagGroupID AS id, TagGroupName AS display
           FROM LibraryTagGroup
       ORDER BY TagGroupName
       ';
-      return $this->session->select($query);
+      return $this->session->cursor($query);
     case 'login_account':
       $query = '
         SELECT DISTINCT a.account_name AS id, a.account_fullname AS display
@@ -303,7 +353,7 @@ class Tables {
                      ON i.AddedBy = a.account_name
                ORDER BY a.account_fullname
       ';
-      return $this->session->select($query);
+      return $this->session->cursor($query);
     default:
       http_response_code(400);
       $message = "$record_type records not supported";
@@ -2,6 +2,8 @@
 
 namespace MusicLibrary\Users;
 
+use MusicLibrary\Utilities\AuthCache;
+
 class User {
   public $session;
   public function __construct($session) {
@@ -15,8 +17,8 @@ class User {
     $record_id || die('Missing record ID');
     $sql = 'DELETE FROM login_account WHERE account_id = ?';
     try {
-      $stmt = $this->session->db->prepare($sql);
-      $stmt->execute([$record_id]);
+      $this->session->execute($sql, [$record_id]);
+      (new AuthCache($this->session))->invalidate();
       return ['status' => 'success'];
     } catch (\Exception $e) {
       $message = $e->getMessage();
@@ -66,31 +68,31 @@ class User {
       $password ? password_hash($password, PASSWORD_DEFAULT) : null,
     ];
     $placeholders = implode(',', array_fill(0, count($values), '?'));
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare("
+    $save = function() use ($placeholders, $values) {
+      $this->session->execute("
         INSERT INTO login_account (account_name, account_fullname,
                                    account_password, account_comment,
                                    account_admin, account_readonly,
                                    account_status, account_hash)
              VALUES ($placeholders)
-      ");
-      $stmt->execute($values);
+      ", $values);
       $account_id = $this->session->db->lastInsertId();
       $user = $this->session->user->name;
       $message = "$user saving new account: " . json_encode($values);
       $this->session->debug_log($message);
-      $stmt = $this->session->db->prepare("
+      $this->session->execute("
         INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
                                   AuditTable, AuditKey)
              VALUES (?, ?, 'INSERT', 'login_account', ?)
-      ");
-      $stmt->execute([$user, $this->session->localtime, $account_id]);
-      $this->session->db->commit();
+      ", [$user, $this->session->localtime, $account_id]);
+      return $account_id;
+    };
+    try {
+      $account_id = $this->session->transaction($save);
+      (new AuthCache($this->session))->invalidate();
       http_response_code(201);
       return ['status' => 'success', 'account_id' => $account_id];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -115,9 +117,8 @@ class User {
       $password ? password_hash($password, PASSWORD_DEFAULT) : null,
       $record_id,
     ];
-    $this->session->db->beginTransaction();
-    try {
-      $stmt = $this->session->db->prepare('
+    $save = function() use ($record_id, $values) {
+      $this->session->execute('
         UPDATE login_account
            SET account_name = ?,
                account_fullname = ?,
@@ -128,21 +129,21 @@ class User {
                account_status = ?,
                account_hash = ?
          WHERE account_id = ?
-      ');
-      $stmt->execute($values);
-      $stmt = $this->session->db->prepare("
-        INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
-                                  AuditTable, AuditKey)
-             VALUES (?, ?, 'UPDATE', 'login_account', ?)
-      ");
+      ', $values);
       $user = $this->session->user->name;
       $message = "$user updating account: " . json_encode($values);
       $this->session->debug_log($message);
-      $stmt->execute([$user, $this->session->localtime, $record_id]);
-      $this->session->db->commit();
+      $this->session->execute("
+        INSERT INTO LibraryAudit (AuditWho, AuditWhen, AuditAction,
+                                  AuditTable, AuditKey)
+             VALUES (?, ?, 'UPDATE', 'login_account', ?)
+      ", [$user, $this->session->localtime, $record_id]);
+    };
+    try {
+      $this->session->transaction($save);
+      (new AuthCache($this->session))->invalidate();
       return ['status' => 'success', 'account_id' => $record_id];
     } catch (\Exception $e) {
-      $this->session->db->rollback();
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -13,38 +13,68 @@ use Ramsey\Uuid\Uuid;
 class Session {
 
   const API_PATH = '/library/api';
+  const BUSY_ERRORS = [
+    'mysql' => [1205, 1213],  // lock wait timeout, deadlock
+    'sqlite' => [5, 6],       // SQLITE_BUSY, SQLITE_LOCKED
+  ];
   const CONFIG = __DIR__ . '/config.json';
+  const DEFAULT_BUSY_TIMEOUT = 5000;
   const ID = 'MLSESSID';
   const SECRETS = __DIR__ . '/secrets.json';
   const PROD_URL = __DIR__ . '/prod.url';
+  const SLOW_QUERY_LOG = Cache::DIRECTORY . '/logs/slow-queries.log';
+  const TIMEZONE = 'America/New_York';
+  const WRITTEN = 'MLWRITTEN';
 
+  public $background = false;
   public $config;
   public $db;
   public $debugging;
   public $endpoint;
+  public $executes = 0;
   public $id;
   public $localtime;
+  public $lock_wait = 0.0;
   public $method;
   public $now;
   public $path_segments;
+  public $phases = [];
+  public $prepares = 0;
+  public $primary;
+  public $queries = [];
+  public $query_time = 0.0;
   public $record_id;
   public $record_type;
   public $request_data;
   public $request_uri;
+  public $write_retries = 0;
   public $start;
+  public $statements = [];
+  public $streaming = [];
   public $user;
   public $initialized;
 
   // Assemble the values for the current session.
-  public function __construct() {
+  //
+  // Command-line scripts (such as the report worker) pass false to get
+  // the database connection and the configuration without a request.
+  // Failed queries then throw exceptions instead of replying.
+  public function __construct($request = true) {
     $this->now = time();
     $this->start = microtime(true);
     $this->debugging = isset($_REQUEST['debug']);
-    $this->db = self::connect_to_database();
-    $this->initialized = $this->has_accounts();
+    $this->db = $this->primary = self::connect_to_database();
+    $began = $_SERVER['REQUEST_TIME_FLOAT'] ?? $this->start;
+    $this->phases['bootstrap'] = microtime(true) - $began;
+    $this->config = $this->time_phase('config', fn() => $this->load_config());
+    if (!$request) {
+      $this->background = true;
+      $this->localtime = self::get_localtime();
+      return;
+    }
+    $this->initialized = $this->time_phase('auth', fn() => $this->has_accounts());
     $this->id = $_COOKIE[self::ID] ?? null;
     $this->method = $_SERVER['REQUEST_METHOD'];
-    $this->config = self::load_config();
     $this->request_uri = self::get_request_uri();
     $this->localtime = self::get_localtime();
     $this->request_data = self::load_request_data();
@@ -52,7 +82,17 @@ class Session {
     $this->endpoint = $this->path_segments[2];
     $this->record_id = $this->path_segments[3] ?? null;
     $this->record_type = $this->config['record_types'][$this->endpoint] ?? null;
-    $this->user = new User($this);
+    $this->user = $this->time_phase('auth', fn() => new User($this));
+    register_shutdown_function(fn() => $this->log_slow_queries());
+  }
+
+  // Find out which version of the catalog the database holds.
+  //
+  // Every change to an item, lookup value, or account is recorded in the
+  // audit table, so its highest key changes whenever the catalog does.
+  public function catalog_version() {
+    $query = 'SELECT MAX(AuditID) FROM LibraryAudit';
+    return (int)$this->select($query, null, 'value');
   }
 
   // See if we're in maintenance mode.
@@ -60,6 +100,41 @@ class Session {
     return ['maintenance_mode' => file_exists('../maintenance-mode')];
   }
 
+  // Send a bodiless 304 response if the client has the current payload.
+  public function check_etag($etag) {
+    header("ETag: \"$etag\"");
+    header('Cache-Control: private, no-cache');
+    foreach (explode(',', $_SERVER['HTTP_IF_NONE_MATCH'] ?? '') as $tag) {
+      $tag = preg_replace(['#^W/#', '#-gzip"$#'], ['', '"'], trim($tag));
+      if ($tag === '*' || trim($tag, '"') === $etag) {
+        http_response_code(304);
+        exit();
+      }
+    }
+  }
+
+  // Run a query whose rows are fetched one at a time, as they're used.
+  //
+  // Returns a generator, which reply() will encode and send a row at a
+  // time, so a big result set never has to be held in memory. Errors in
+  // the query itself are handled (as they are by select()) right away.
+  public function cursor($sql, $values = null, $mode = \PDO::FETCH_ASSOC) {
+    try {
+      $stmt = $this->execute($sql, $values);
+      $index = array_key_last($this->queries);
+      $this->streaming[spl_object_id($stmt)] = true;
+      return $this->fetch_rows($stmt, $index, $values, $mode);
+    } catch (\Exception $e) {
+      if ($this->background) {
+        throw $e;
+      }
+      $message = $e->getMessage();
+      error_log($message);
+      http_response_code(500);
+      $this->reply(['status' => 'failure', 'message' => $message]);
+    }
+  }
+
   // Conditional logging for debug purposes.
   public function debug_log($what) {
     if ($this->debugging) {
@@ -72,18 +147,39 @@ class Session {
     if (empty($this->id)) {
       return ['status' => 'warning', 'message' => 'Not logged in'];
     }
-    $stmt = $this->db->prepare('
+    $this->execute('
       UPDATE login_session
          SET sess_closed = ?
        WHERE sess_id = ?
-    ');
-    $stmt->execute([$this->localtime, $this->id]);
+    ', [$this->localtime, $this->id]);
+    (new AuthCache($this))->forget($this->id);
     setcookie(self::ID, '', $this->now - 3600);
     unset($_COOKIE[self::ID]);
     error_log("closed session {$this->id} at {$this->localtime}");
     return ['status' => 'success', 'message' => 'Logout successful'];
   }
 
+  // Run a statement with its parameter values, returning it for fetching.
+  //
+  // The time the statement takes is recorded, along with the number of
+  // rows it changed (for a query, select() fills in the rows fetched).
+  // The shape of the bound values is only kept for slow statements.
+  public function execute($sql, $values = null) {
+    $stmt = $this->prepare($sql);
+    $started = microtime(true);
+    $stmt->execute($values);
+    $elapsed = microtime(true) - $started;
+    $this->executes++;
+    $this->query_time += $elapsed;
+    $this->queries[] = [
+      'sql' => $sql,
+      'elapsed' => $elapsed,
+      'rows' => $stmt->columnCount() ? null : $stmt->rowCount(),
+    ];
+    $this->note_if_slow(array_key_last($this->queries), $values);
+    return $stmt;
+  }
+
   // Provide information about the currently logged-in user.
   public function get() {
     $prod = file_exists(self::PROD_URL) ? file_get_contents(self::PROD_URL) : '';
@@ -92,12 +188,8 @@ class Session {
 
   // Load the information which informs our processing of the app's values.
   private function load_config() {
-    // $this->debug_log('config path=' . self::CONFIG);
-    $this->debug_log("config path={self::CONFIG}");
-    $json = file_get_contents(self::CONFIG);
-    $config = json_decode($json, true);
-    $this->debug_log('loaded config ' . json_encode($config));
-    return $config;
+    $this->debug_log('config path=' . self::CONFIG);
+    return Config::load(self::CONFIG);
   }
 
   // Do our own session management (PHP's isn't reliable).
@@ -118,12 +210,11 @@ class Session {
       http_response_code(401);
       $this->reply(['status' => 'failure', 'message' => 'Account retired']);
     }
-    $stmt = $this->db->prepare('
+    $uuid = Uuid::uuid4()->toString();
+    $this->execute('
       INSERT INTO login_session (sess_id, sess_user, sess_start, sess_last)
            VALUES (?, ?, ?, ?)
-    ');
-    $uuid = Uuid::uuid4()->toString();
-    $stmt->execute([$uuid, $username, $this->localtime, $this->now]);
+    ', [$uuid, $username, $this->localtime, $this->now]);
     $expire = $this->now + 60 * 60 * 24 * 365;  // cookie will live for a year
     $this->debug_log('setting cookie expiry to ' . date('Y-m-d H:i:s', $expire));
     setcookie(self::ID, $uuid, $expire);
@@ -140,38 +231,103 @@ class Session {
     ];
   }
 
+  // Get a prepared statement, reusing one this request has already made.
+  //
+  // A statement whose rows a cursor() generator is still handing out
+  // can't be reused without cutting the generator short, so the same
+  // SQL gets a statement of its own (not cached) in that case.
+  public function prepare($sql) {
+    $key = $this->db === $this->primary ? $sql : "replica:$sql";
+    if (array_key_exists($key, $this->statements)) {
+      $stmt = $this->statements[$key];
+      if (!isset($this->streaming[spl_object_id($stmt)])) {
+        $stmt->closeCursor();
+        return $stmt;
+      }
+      $this->prepares++;
+      return $this->db->prepare($sql);
+    }
+    $this->prepares++;
+    return $this->statements[$key] = $this->db->prepare($sql);
+  }
+
+  // Do database work which must use the primary database, even if the
+  // request's reads have been sent to the replica (see use_replica()).
+  public function on_primary($work) {
+    $db = $this->db;
+    $this->db = $this->primary;
+    try {
+      return $work();
+    } finally {
+      $this->db = $db;
+    }
+  }
+
   // Send a response to the client.
+  //
+  // If the payload is an iterator (such as the generator returned by
+  // cursor()), or any of its values is, the response is streamed (see
+  // stream_reply()).
   public function reply($payload) {
+    $statements = "prepares={$this->prepares}, executes={$this->executes}";
+    $this->debug_log("SQL statements: $statements");
+    header("X-SQL-Statements: $statements");
+    $wait = sprintf('%.3f', $this->lock_wait);
+    header("X-Write-Contention: retries={$this->write_retries}, wait=$wait");
+    if (self::is_streamed($payload)) {
+      $this->stream_reply($payload);
+    }
+    $json = $this->time_phase('serialize', fn() => json_encode($payload));
+    header('Server-Timing: ' . $this->server_timing());
     header('Content-Type: application/json');
-    echo json_encode($payload);
+    echo $json;
     exit();
   }
 
   // Submit a SELECT query to the database the retrieve the results.
   public function select($sql, $values = null, $fetch = 'all') {
     try {
-      if (empty($values)) {
-        $stmt = $this->db->query($sql);
-      } else {
-        $stmt = $this->db->prepare($sql);
-        $stmt->execute($values);
-      }
+      $stmt = $this->execute($sql, $values);
+      $started = microtime(true);
       switch ($fetch) {
       case 'value':
-        return $stmt->fetchColumn();
+        $result = $stmt->fetchColumn();
+        break;
       case 'column':
-        return $stmt->fetchAll(\PDO::FETCH_COLUMN);
+        $result = $stmt->fetchAll(\PDO::FETCH_COLUMN);
+        break;
       case 'row':
-        return $stmt->fetch(\PDO::FETCH_ASSOC);
+        $result = $stmt->fetch(\PDO::FETCH_ASSOC);
+        break;
       case 'num':
-        return $stmt->fetch(\PDO::FETCH_NUM);
+        $result = $stmt->fetch(\PDO::FETCH_NUM);
+        break;
       case 'obj':
-        return $stmt->fetchAll(\PDO::FETCH_OBJ);
+        $result = $stmt->fetchAll(\PDO::FETCH_OBJ);
+        break;
       case 'all':
       default:
-        return $stmt->fetchAll(\PDO::FETCH_ASSOC);
+        $result = $stmt->fetchAll(\PDO::FETCH_ASSOC);
+      }
+      $elapsed = microtime(true) - $started;
+      $this->query_time += $elapsed;
+      $query = &$this->queries[array_key_last($this->queries)];
+      $query['elapsed'] += $elapsed;
+      if (in_array($fetch, ['value', 'row', 'num'])) {
+        $query['rows'] = $result === false ? 0 : 1;
+      } else {
+        $query['rows'] = count($result);
       }
+      unset($query);
+      $this->note_if_slow(array_key_last($this->queries), $values);
+      return $result;
     } catch (\Exception $e) {
+      if ($this->db->inTransaction()) {
+        throw $e;  // let transaction() roll back (and maybe retry)
+      }
+      if ($this->background) {
+        throw $e;  // there's no client to reply to
+      }
       $message = $e->getMessage();
       error_log($message);
       http_response_code(500);
@@ -179,6 +335,83 @@ class Session {
     }
   }
 
+  // Run a unit of work which writes to the database as one transaction.
+  //
+  // When other writers have the database tied up (SQLite still reports
+  // the database as locked after waiting out its busy timeout, or MySQL
+  // gives up waiting for a row lock or picks this transaction as a
+  // deadlock victim) the transaction is rolled back and the work is
+  // tried again after a growing, randomized delay. Returns whatever the
+  // work returns; any other exception (or running out of attempts)
+  // rolls back the transaction and passes the exception along. The time
+  // lost to failed attempts and the delays is tallied in $lock_wait.
+  public function transaction($work) {
+    $settings = $this->config['write_retry'] ?? [];
+    $attempts = $settings['attempts'] ?? 5;
+    $delay = ($settings['initial_delay_ms'] ?? 25) / 1000;
+    $max_delay = ($settings['max_delay_ms'] ?? 1000) / 1000;
+    $driver = $this->db->getAttribute(\PDO::ATTR_DRIVER_NAME);
+    for ($attempt = 1; ; ++$attempt) {
+      $started = microtime(true);
+      try {
+        $this->db->beginTransaction();
+        $result = $work();
+        $this->db->commit();
+        $this->remember_write();
+        return $result;
+      } catch (\Exception $e) {
+        if ($this->db->inTransaction()) {
+          $this->db->rollBack();
+        }
+        $code = $e instanceof \PDOException ? ($e->errorInfo[1] ?? null) : null;
+        $busy = in_array($code, self::BUSY_ERRORS[$driver] ?? []);
+        if (!$busy || $attempt >= $attempts) {
+          throw $e;
+        }
+        $pause = min($delay * 2 ** ($attempt - 1), $max_delay);
+        $pause *= 0.5 + mt_rand() / mt_getrandmax() / 2;
+        error_log("write attempt $attempt failed ({$e->getMessage()}); retrying");
+        $this->write_retries++;
+        $this->lock_wait += microtime(true) - $started + $pause;
+        usleep((int)($pause * 1000000));
+      }
+    }
+  }
+
+  // Send this request's reads to the read-only replica, if there is one.
+  //
+  // Users always see their own changes: the version of the catalog each
+  // user last changed is kept in a cookie, and the replica is only used
+  // for that user's requests once it has caught up with that version.
+  // If the replica can't be reached, the primary database is used.
+  public function use_replica() {
+    $settings = self::load_database_settings()->replica ?? null;
+    if (empty($settings)) {
+      return false;
+    }
+    try {
+      $this->db = self::connect_to_database($settings);
+      $written = (int)($_COOKIE[self::WRITTEN] ?? 0);
+      $version = 0;
+      if ($written) {
+        $query = 'SELECT MAX(AuditID) FROM LibraryAudit';
+        $version = (int)$this->db->query($query)->fetchColumn();
+      }
+    } catch (\Exception $e) {
+      error_log('unable to use the replica: ' . $e->getMessage());
+      $this->db = $this->primary;
+      return false;
+    }
+    if ($version < $written) {
+      $this->debug_log("replica is at version $version, user wrote $written");
+      $this->db = $this->primary;
+      header('X-Read-From: primary');
+      return false;
+    }
+    header('X-Read-From: replica');
+    return true;
+  }
+
   // Make sure the user is authorized to perform administrative tasks.
   public function verify_is_admin() {
     if (!$this->user->admin) {
@@ -207,29 +440,98 @@ class Session {
   }
 
   // Use the credentials on the disk to establish a database connection.
-  private static function connect_to_database() {
-    $secrets = json_decode(file_get_contents(self::SECRETS));
-    $args = [$secrets->database->uri];
-    if (isset($secrets->database->account)) {
-      $args[] = $secrets->database->account;
-      if (isset($secrets->database->password)) {
-        $args[] = $secrets->database->password;
-      }
+  //
+  // The settings for the read-only replica (the `replica` member of the
+  // database settings) can be passed in place of the primary's.
+  public static function connect_to_database($settings = null) {
+    $settings ??= self::load_database_settings();
+    $options = [];
+    if (!empty($settings->persistent)) {
+      $options[\PDO::ATTR_PERSISTENT] = true;
     }
-    $db = new \PDO(...$args);
-    if (str_starts_with($secrets->database->uri, 'mysql:')) {
+    $sqlite = str_starts_with($settings->uri, 'sqlite:');
+    if ($sqlite && !empty($settings->read_only)) {
+      $options[\PDO::SQLITE_ATTR_OPEN_FLAGS] = \PDO::SQLITE_OPEN_READONLY;
+    }
+    $db = new \PDO(
+      $settings->uri,
+      $settings->account ?? null,
+      $settings->password ?? null,
+      $options
+    );
+    if (str_starts_with($settings->uri, 'mysql:')) {
       $db->exec("SET NAMES 'utf8'");
+    } elseif ($sqlite) {
+      $pragmas = (array)($settings->pragmas ?? []);
+      $pragmas['busy_timeout'] ??= self::DEFAULT_BUSY_TIMEOUT;
+      foreach ($pragmas as $name => $value) {
+        $db->exec("PRAGMA $name = $value");
+      }
+    }
+    if (!empty($settings->migrate)) {
+      require_once 'migrations.php';
+      \MusicLibrary\Migrations\Migrator::ensure_current($db);
     }
     return $db;
   }
 
   // Construct the standard ISO-formatted string for the current time.
-  private static function get_localtime() {
-    $tz = new \DateTimeZone('America/New_York');
+  public static function get_localtime() {
+    $tz = new \DateTimeZone(self::TIMEZONE);
     $datetime = new \DateTime('now', $tz);
     return $datetime->format('Y-m-d H:i:s.u');
   }
 
+  // Describe the values bound to a statement without giving them away.
+  //
+  // For example, ['int*3', 'string', 'null'] (runs of the same type are
+  // collapsed, which keeps long IN lists readable).
+  private static function bind_shape($values) {
+    $shape = [];
+    $previous = null;
+    $count = 0;
+    foreach ($values ?? [] as $value) {
+      $type = get_debug_type($value);
+      if ($type !== $previous && $count) {
+        $shape[] = $count > 1 ? "$previous*$count" : $previous;
+        $count = 0;
+      }
+      $previous = $type;
+      $count++;
+    }
+    if ($count) {
+      $shape[] = $count > 1 ? "$previous*$count" : $previous;
+    }
+    return $shape;
+  }
+
+  // Fetch a query's rows, adding the time taken to the query's statistics.
+  //
+  // The statement is marked as in use (see prepare()) until the rows
+  // run out, or the generator is abandoned.
+  private function fetch_rows($stmt, $index, $values, $mode) {
+    $count = 0;
+    $elapsed = 0.0;
+    try {
+      while (true) {
+        $started = microtime(true);
+        $row = $stmt->fetch($mode);
+        $elapsed += microtime(true) - $started;
+        if ($row === false) {
+          break;
+        }
+        $count++;
+        yield $row;
+      }
+    } finally {
+      unset($this->streaming[spl_object_id($stmt)]);
+    }
+    $this->query_time += $elapsed;
+    $this->queries[$index]['elapsed'] += $elapsed;
+    $this->queries[$index]['rows'] = $count;
+    $this->note_if_slow($index, $values);
+  }
+
   // Find out what wa were asked to do, and verify that it's supported.
   private static function get_request_uri() {
     $request_uri = $_SERVER['REQUEST_URI'];
@@ -241,8 +543,12 @@ class Session {
 
   // See if we have any user accounts.
   private function has_accounts() {
-    $stmt = $this->db->query('SELECT COUNT(*) FROM login_account');
-    if ($stmt->fetchColumn() > 0) {
+    $cache = new AuthCache($this);
+    if ($cache->get('has-accounts')) {
+      return true;
+    }
+    if ($this->select('SELECT 1 FROM login_account LIMIT 1', null, 'value')) {
+      $cache->put('has-accounts', true);
       return true;
     };
     setcookie(self::ID, '', $this->now - 3600);
@@ -250,6 +556,28 @@ class Session {
     return false;
   }
 
+  // Find out whether a payload should be streamed to the client.
+  private static function is_streamed($payload) {
+    if ($payload instanceof \Traversable) {
+      return true;
+    }
+    foreach ((array)$payload as $value) {
+      if ($value instanceof \Traversable) {
+        return true;
+      }
+    }
+    return false;
+  }
+
+  // Read the database settings from the secrets file (once).
+  private static function load_database_settings() {
+    static $settings = null;
+    if ($settings === null) {
+      $settings = json_decode(file_get_contents(self::SECRETS))->database;
+    }
+    return $settings;
+  }
+
   // Break down the request URI into its parts.
   private function load_path_segments() {
     $path = explode('?', $this->request_uri)[0];
@@ -262,6 +590,140 @@ class Session {
     return $json ? json_decode($json, true) : [];
   }
 
+  // Write the queries which took too long to the slow query log.
+  //
+  // Each line is a JSON object with the SQL, the shape of its bound
+  // values (never the values themselves), its time, and its row count.
+  private function log_slow_queries() {
+    $settings = $this->config['instrumentation'] ?? [];
+    $threshold = $settings['slow_query_ms'] ?? null;
+    if ($threshold === null) {
+      return;
+    }
+    $lines = '';
+    foreach ($this->queries as $query) {
+      $ms = $query['elapsed'] * 1000;
+      if ($ms >= $threshold) {
+        $lines .= json_encode([
+          'when' => $this->localtime,
+          'method' => $this->method,
+          'uri' => $this->request_uri,
+          'user' => $this->user->name ?? null,
+          'ms' => round($ms, 1),
+          'rows' => $query['rows'],
+          'sql' => preg_replace('/\s+/', ' ', trim($query['sql'])),
+          'binds' => $query['binds'] ?? [],
+        ]) . "\n";
+      }
+    }
+    if ($lines !== '') {
+      $path = $settings['slow_query_log'] ?? self::SLOW_QUERY_LOG;
+      Cache::make_directory(dirname($path));
+      file_put_contents($path, $lines, FILE_APPEND | LOCK_EX);
+    }
+  }
+
+  // Keep the shape of a statement's bound values if it was slow.
+  //
+  // Only the slow statements are logged, so there's no point in holding
+  // on to the values for the others (a long report or import runs
+  // thousands of them).
+  private function note_if_slow($index, $values) {
+    $query = &$this->queries[$index];
+    $threshold = $this->config['instrumentation']['slow_query_ms'] ?? null;
+    if ($threshold === null || isset($query['binds'])) {
+      return;
+    }
+    if ($query['elapsed'] * 1000 >= $threshold) {
+      $query['binds'] = self::bind_shape($values);
+    }
+  }
+
+  // Note the version of the catalog the user has just changed.
+  //
+  // Only needed if there's a replica (see use_replica()).
+  private function remember_write() {
+    if (empty(self::load_database_settings()->replica)) {
+      return;
+    }
+    setcookie(self::WRITTEN, $this->catalog_version(), [
+      'expires' => $this->now + 86400,
+      'path' => self::API_PATH,
+      'httponly' => true,
+      'samesite' => 'Strict',
+    ]);
+  }
+
+  // Assemble the Server-Timing header value (durations in milliseconds).
+  private function server_timing() {
+    $began = $_SERVER['REQUEST_TIME_FLOAT'] ?? $this->start;
+    $phases = $this->phases;
+    $phases['query'] = $this->query_time;
+    $phases['total'] = microtime(true) - $began;
+    $metrics = [];
+    $names = ['bootstrap', 'config', 'auth', 'query', 'serialize', 'total'];
+    foreach ($names as $name) {
+      $metric = sprintf('%s;dur=%.1f', $name, ($phases[$name] ?? 0) * 1000);
+      if ($name === 'query') {
+        $metric .= ";desc=\"{$this->executes} statements\"";
+      }
+      $metrics[] = $metric;
+    }
+    return implode(', ', $metrics);
+  }
+
+  // Encode and send the payload a row at a time, compressing it if the
+  // client accepts that.
+  //
+  // The iterators in the payload become JSON arrays. Closures in the
+  // payload are called when the values before them have been sent, so
+  // they can use what the iterators found (see Trail::get() for an
+  // example). The response headers have to go out before the payload
+  // is encoded, so their Server-Timing values leave out the encoding.
+  private function stream_reply($payload) {
+    header('Server-Timing: ' . $this->server_timing());
+    header('Content-Type: application/json');
+    $stream = new ResponseStream();
+    if ($payload instanceof \Traversable) {
+      self::stream_list($stream, $payload);
+    } else {
+      $separator = '{';
+      foreach ($payload as $name => $value) {
+        if ($value instanceof \Closure) {
+          $value = $value();
+        }
+        $stream->write($separator . json_encode((string)$name) . ':');
+        if ($value instanceof \Traversable) {
+          self::stream_list($stream, $value);
+        } else {
+          $stream->write(json_encode($value));
+        }
+        $separator = ',';
+      }
+      $stream->write('}');
+    }
+    $stream->close();
+    exit();
+  }
+
+  // Send the values from an iterator as a JSON array.
+  private static function stream_list($stream, $values) {
+    $separator = '[';
+    foreach ($values as $value) {
+      $stream->write($separator . json_encode($value));
+      $separator = ',';
+    }
+    $stream->write($separator === '[' ? '[]' : ']');
+  }
+
+  // Run part of the request's processing, adding its time to a phase.
+  private function time_phase($name, $work) {
+    $started = microtime(true);
+    $result = $work();
+    $this->phases[$name] = ($this->phases[$name] ?? 0) + microtime(true) - $started;
+    return $result;
+  }
+
 }
 
 class User {
@@ -281,36 +743,44 @@ class User {
       $this->fullname = 'Database Initialization';
       $this->active = $this->admin = true;
     } elseif (!empty($session->id)) {
-      $stmt = $session->db->prepare('
-        SELECT sess_user, sess_last, sess_closed
-          FROM login_session
-         WHERE sess_id = ?'
-      );
-      $stmt->execute([$session->id]);
-      $row = $stmt->fetch(\PDO::FETCH_ASSOC);
-      $session_closed = $row['sess_closed'];
-      $last_activity = $row['sess_last'];
+      $cache = new AuthCache($session);
+      $row = $cache->get($session->id);
+      if ($row === null) {
+        $stmt = $session->execute('
+             SELECT s.sess_user, s.sess_last, s.sess_closed,
+                    a.account_id, a.account_name, a.account_fullname,
+                    a.account_readonly, a.account_status, a.account_admin
+               FROM login_session s
+          LEFT JOIN login_account a
+                 ON a.account_name = s.sess_user
+              WHERE s.sess_id = ?
+        ', [$session->id]);
+        $row = $stmt->fetch(\PDO::FETCH_ASSOC);
+        if ($row) {
+          $cache->put($session->id, $row);
+        }
+      }
+      $session_closed = $row['sess_closed'] ?? null;
+      $last_activity = $row['sess_last'] ?? 0;
       if (!empty($session_closed)) {
         error_log("session {$session->id} closed $session_closed");
       } elseif ($session->now - $last_activity > 60 * 60 * 48) {  // >= two days
         $session->delete();
       } else {
         $username = $row['sess_user'];
-        $stmt = $session->db->prepare('
-          UPDATE login_session
-             SET sess_last = ?
-           WHERE sess_id = ?
-        ');
-        $stmt->execute([$session->now, $session->id]);
-        $stmt = $session->db->prepare('
-          SELECT account_id, account_name, account_fullname, account_readonly,
-                 account_status, account_admin
-            FROM login_account
-           WHERE account_name = ?
-        ');
-        $stmt->execute([$username]);
-        $row = $stmt->fetch(\PDO::FETCH_ASSOC);
-        if ($row) {
+
+        // Only record activity once in a while, so reads don't become writes.
+        $interval = $session->config['auth']['activity_interval'] ?? 300;
+        if ($session->now - $last_activity >= $interval) {
+          $session->execute('
+            UPDATE login_session
+               SET sess_last = ?
+             WHERE sess_id = ?
+          ', [$session->now, $session->id]);
+          $row['sess_last'] = $session->now;
+          $cache->put($session->id, $row);
+        }
+        if (!empty($row['account_name'])) {
           $session->debug_log(json_encode($row));
           $this->id = $row['account_id'];
           $this->name = $row['account_name'];
@@ -331,3 +801,323 @@ class User {
   }
 
 }
+
+// Authenticated session information remembered briefly between requests.
+//
+// Uses APCu when the extension is available, and otherwise does nothing,
+// so every request falls back to the database. Entries are tagged with a
+// generation number, which is bumped whenever accounts change, so that
+// all of the remembered account information is dropped at once.
+class AuthCache {
+
+  const PREFIX = 'music-library:auth:';
+
+  public $enabled;
+  public $ttl;
+
+  public function __construct($session) {
+    $this->enabled = function_exists('apcu_enabled') && apcu_enabled();
+    $this->ttl = $session->config['auth']['cache_ttl'] ?? 60;
+  }
+
+  // Forget what we know about a single session (e.g., on logout).
+  public function forget($key) {
+    if ($this->enabled) {
+      apcu_delete(self::PREFIX . $key);
+    }
+  }
+
+  // Fetch a remembered value (null if we don't have a current one).
+  public function get($key) {
+    if (!$this->enabled) {
+      return null;
+    }
+    $entry = apcu_fetch(self::PREFIX . $key, $found);
+    if (!$found || $entry['generation'] !== $this->generation()) {
+      return null;
+    }
+    return $entry['value'];
+  }
+
+  // Invalidate everything, because an account was added, changed or dropped.
+  public function invalidate() {
+    if ($this->enabled) {
+      apcu_add(self::PREFIX . 'generation', 0);
+      apcu_inc(self::PREFIX . 'generation');
+    }
+  }
+
+  // Remember a value for a short while.
+  public function put($key, $value) {
+    if ($this->enabled) {
+      $entry = ['generation' => $this->generation(), 'value' => $value];
+      apcu_store(self::PREFIX . $key, $entry, $this->ttl);
+    }
+  }
+
+  // Find out which generation of account information is current.
+  private function generation() {
+    $generation = apcu_fetch(self::PREFIX . 'generation', $found);
+    return $found ? $generation : 0;
+  }
+
+}
+
+// Configuration settings, compiled from JSON to PHP so opcache can hold them.
+//
+// The compiled file records the modification time of the JSON it came
+// from, so editing the JSON file causes it to be recompiled automatically.
+class Config {
+
+  const DIRECTORY = Cache::DIRECTORY . '/config';
+
+  // Parse a JSON configuration file and save the values as PHP code.
+  public static function compile($path) {
+    $values = self::validate($path);
+    $compiled = self::compiled_path($path);
+    $code = var_export(['mtime' => filemtime($path), 'values' => $values], true);
+    $code = "<?php\n\n// Compiled from $path (do not edit).\n\nreturn $code;\n";
+    Cache::make_directory(self::DIRECTORY);
+    $temp = @tempnam(self::DIRECTORY, '.tmp-');
+    if (!$temp || @file_put_contents($temp, $code) === false || !@rename($temp, $compiled)) {
+      error_log("unable to save compiled configuration $compiled");
+      if ($temp) {
+        @unlink($temp);
+      }
+    } elseif (function_exists('opcache_invalidate')) {
+      opcache_invalidate($compiled, true);
+    }
+    return $values;
+  }
+
+  // Get the values for a configuration file, recompiling it if necessary.
+  public static function load($path) {
+    $compiled = @include self::compiled_path($path);
+    if (is_array($compiled) && $compiled['mtime'] === filemtime($path)) {
+      return $compiled['values'];
+    }
+    return self::compile($path);
+  }
+
+  // Parse a JSON configuration file, throwing an exception if it's broken.
+  public static function validate($path) {
+    $json = @file_get_contents($path);
+    if ($json === false) {
+      throw new \Exception("unable to read $path");
+    }
+    $values = json_decode($json, true, 512, JSON_THROW_ON_ERROR);
+    if (!is_array($values) || array_is_list($values)) {
+      throw new \Exception("$path does not contain a JSON object");
+    }
+    return $values;
+  }
+
+  // Decide where the compiled version of a configuration file belongs.
+  private static function compiled_path($path) {
+    $name = basename($path, '.json');
+    $hash = substr(md5(realpath($path) ?: $path), 0, 12);
+    return self::DIRECTORY . "/$name-$hash.php";
+  }
+
+}
+
+// Files cached on disk, with least-recently-used eviction.
+class Cache {
+
+  const DIRECTORY = __DIR__ . '/cache';
+  const FILE_MODE = 0644;
+
+  public $directory;
+  public $max_bytes;
+  public $max_entries;
+
+  public function __construct($session, $name) {
+    $settings = $session->config['cache'][$name] ?? [];
+    $this->directory = self::DIRECTORY . "/$name";
+    $this->max_bytes = $settings['max_bytes'] ?? 100 * 1024 * 1024;
+    $this->max_entries = $settings['max_entries'] ?? 500;
+    self::make_directory($this->directory);
+  }
+
+  // Create a directory for cached files, keeping the web server out of it.
+  public static function make_directory($directory) {
+    if (!is_dir($directory)) {
+      @mkdir($directory, 0775, true);
+      $htaccess = self::DIRECTORY . '/.htaccess';
+      if (!file_exists($htaccess)) {
+        @file_put_contents($htaccess, "Require all denied\n");
+      }
+    }
+  }
+
+  // Remove all of the entries in this cache.
+  public function clear() {
+    $this->purge('');
+  }
+
+  // Fetch the contents of a cache entry (null if we don't have it).
+  public function get($key) {
+    $path = $this->find($key);
+    return $path ? file_get_contents($path) : null;
+  }
+
+  // Get the location of an entry, marking it as recently used.
+  public function find($key) {
+    $path = $this->path($key);
+    if (!is_file($path)) {
+      return null;
+    }
+    @touch($path);
+    return $path;
+  }
+
+  // Drop entries whose keys don't start with the specified prefix.
+  public function purge($keep) {
+    foreach (glob("{$this->directory}/*") as $path) {
+      if ($keep === '' || !str_starts_with(basename($path), $keep)) {
+        @unlink($path);
+      }
+    }
+  }
+
+  // Store a new entry.
+  public function put($key, $contents) {
+    $temp = $this->temp_path();
+    if (@file_put_contents($temp, $contents) === false) {
+      error_log("unable to write cache file $temp");
+      return;
+    }
+    $this->put_file($key, $temp);
+  }
+
+  // Move a file (for example, a rendered report) into the cache.
+  //
+  // Temporary files are only readable by their owner, so the entry is
+  // opened up to other users, in case it was made by another account
+  // (for example, the report worker's) than the web server's.
+  public function put_file($key, $source) {
+    $path = $this->path($key);
+    if (!@rename($source, $path)) {
+      error_log("unable to cache $source as $key");
+      @unlink($source);
+      return;
+    }
+    @chmod($path, self::FILE_MODE);
+    $this->evict();
+  }
+
+  // Get a location where a file can be built before adding it to the cache.
+  public function temp_path() {
+    return tempnam($this->directory, '.tmp-');
+  }
+
+  // Discard the least recently used entries until we're under our limits.
+  private function evict() {
+    $entries = [];
+    $total = 0;
+    foreach (glob("{$this->directory}/*") as $path) {
+      $stat = @stat($path);
+      if ($stat) {
+        $entries[$path] = [$stat['mtime'], $stat['size']];
+        $total += $stat['size'];
+      }
+    }
+    uasort($entries, function($a, $b) { return $a[0] <=> $b[0]; });
+    $count = count($entries);
+    foreach ($entries as $path => list($mtime, $size)) {
+      if ($count <= $this->max_entries && $total <= $this->max_bytes) {
+        break;
+      }
+      if (@unlink($path)) {
+        $count--;
+        $total -= $size;
+      }
+    }
+  }
+
+  // Turn a cache key into the location of its file.
+  private function path($key) {
+    return "{$this->directory}/" . preg_replace('/[^\w.-]/', '_', $key);
+  }
+
+}
+
+// Compressing writer for responses which are sent a piece at a time.
+//
+// Brotli is used if the client accepts it and the brotli extension is
+// installed, otherwise gzip (if the client accepts it). The compressed
+// output is flushed to the client each time a chunk has accumulated.
+class ResponseStream {
+
+  const BROTLI_QUALITY = 5;
+  const CHUNK_SIZE = 64 * 1024;
+
+  public $buffer = '';
+  public $context = null;
+  public $encoding = null;
+
+  public function __construct() {
+    $accepted = $_SERVER['HTTP_ACCEPT_ENCODING'] ?? '';
+    if (!ini_get('zlib.output_compression')) {
+      if (function_exists('brotli_compress_init') && self::accepts($accepted, 'br')) {
+        $this->encoding = 'br';
+        $this->context = brotli_compress_init(self::BROTLI_QUALITY);
+      } elseif (function_exists('deflate_init') && self::accepts($accepted, 'gzip')) {
+        $this->encoding = 'gzip';
+        $this->context = deflate_init(ZLIB_ENCODING_GZIP);
+      }
+    }
+    header('Vary: Accept-Encoding');
+    if ($this->encoding) {
+      header("Content-Encoding: {$this->encoding}");
+    }
+    while (ob_get_level() > 0) {
+      ob_end_flush();
+    }
+  }
+
+  // Send whatever is left, finishing the compressed stream.
+  public function close() {
+    $this->send(true);
+  }
+
+  // Add to the response, sending it on once we have a full chunk.
+  public function write($data) {
+    $this->buffer .= $data;
+    if (strlen($this->buffer) >= self::CHUNK_SIZE) {
+      $this->send(false);
+    }
+  }
+
+  // See if the Accept-Encoding header includes a content coding.
+  private static function accepts($header, $coding) {
+    foreach (explode(',', strtolower($header)) as $item) {
+      $parts = array_map('trim', explode(';', $item));
+      if ($parts[0] === $coding) {
+        foreach (array_slice($parts, 1) as $parameter) {
+          if (preg_match('/^q\s*=\s*0(\.0*)?$/', $parameter)) {
+            return false;
+          }
+        }
+        return true;
+      }
+    }
+    return false;
+  }
+
+  // Compress (if appropriate) and send the buffered output.
+  private function send($final) {
+    $data = $this->buffer;
+    $this->buffer = '';
+    if ($this->encoding === 'br') {
+      $mode = $final ? BROTLI_FINISH : BROTLI_FLUSH;
+      $data = brotli_compress_add($this->context, $data, $mode);
+    } elseif ($this->encoding === 'gzip') {
+      $mode = $final ? ZLIB_FINISH : ZLIB_SYNC_FLUSH;
+      $data = deflate_add($this->context, $data, $mode);
+    }
+    echo $data;
+    flush();
+  }
+
+}
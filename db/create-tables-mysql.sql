@@ -21,6 +21,19 @@ CREATE TABLE `LibraryAudit` (
 	`AuditKey` INTEGER NOT NULL,
 	PRIMARY KEY (`AuditID`)
 );
+CREATE INDEX `LibraryAuditWhen` ON `LibraryAudit` (`AuditWhen`, `AuditID`);
+CREATE INDEX `LibraryAuditWho` ON `LibraryAudit` (`AuditWho`, `AuditWhen`, `AuditID`);
+CREATE INDEX `LibraryAuditTable` ON `LibraryAudit` (`AuditTable`, `AuditWhen`, `AuditID`);
+CREATE TABLE `LibraryAuditArchive` (
+	`AuditID` INTEGER NOT NULL,
+	`AuditWho` VARCHAR(20) NOT NULL,
+	`AuditWhen` DATETIME NOT NULL,
+	`AuditAction` VARCHAR(20) NOT NULL,
+	`AuditTable` VARCHAR(32) NOT NULL,
+	`AuditKey` INTEGER NOT NULL,
+	PRIMARY KEY (`AuditID`)
+);
+CREATE INDEX `LibraryAuditArchiveWhen` ON `LibraryAuditArchive` (`AuditWhen`);
 CREATE TABLE `LibraryCompany` (
 	`CompanyID` INTEGER NOT NULL AUTO_INCREMENT,
 	`CompanyName` VARCHAR(100) NOT NULL,
@@ -48,11 +61,13 @@ CREATE TABLE `LibraryItemKeyword` (
 	`LibraryKeyword` INTEGER NOT NULL,
 	PRIMARY KEY (`LibraryItem`, `LibraryKeyword`)
 );
+CREATE INDEX `LibraryItemKeywordKeyword` ON `LibraryItemKeyword` (`LibraryKeyword`);
 CREATE TABLE `LibraryItemTag` (
 	`LibraryItem` INTEGER NOT NULL,
 	`LibraryTag` INTEGER NOT NULL,
 	PRIMARY KEY (`LibraryItem`, `LibraryTag`)
 );
+CREATE INDEX `LibraryItemTagTag` ON `LibraryItemTag` (`LibraryTag`);
 CREATE TABLE `LibraryKey` (
 	`LookupID` INTEGER NOT NULL AUTO_INCREMENT,
 	`LookupValue` VARCHAR(255) NOT NULL,
@@ -104,6 +119,7 @@ CREATE TABLE `LibraryTag` (
 	`Comments` TEXT,
 	PRIMARY KEY (`TagID`)
 );
+CREATE INDEX `LibraryTagTagGroup` ON `LibraryTag` (`TagGroup`);
 CREATE TABLE `LibraryTagGroup` (
 	`TagGroupID` INTEGER NOT NULL AUTO_INCREMENT,
 	`TagGroupName` VARCHAR(255) NOT NULL,
@@ -138,8 +154,15 @@ CREATE TABLE report_request (
 	requested DATETIME,
 	parameters TEXT,
 	elapsed FLOAT,
+	status VARCHAR(10) NOT NULL DEFAULT 'queued',
+	progress INTEGER NOT NULL DEFAULT 0,
+	started DATETIME,
+	finished DATETIME,
+	worker VARCHAR(100),
+	error TEXT,
 	PRIMARY KEY (request_id)
 );
+CREATE INDEX report_request_status ON report_request (status, request_id);
 CREATE TABLE `LibraryItem` (
 	`ItemID` INTEGER NOT NULL AUTO_INCREMENT,
 	`ItemTitle` VARCHAR(100) NOT NULL,
@@ -176,6 +199,7 @@ CREATE TABLE `LibraryItem` (
 	`AddedBy` VARCHAR(20),
 	`DateModified` DATETIME,
 	`ModifiedBy` VARCHAR(20),
+	`MemberCount` INTEGER NOT NULL DEFAULT 0,
 	PRIMARY KEY (`ItemID`),
 	FOREIGN KEY(`ComposerID`) REFERENCES `LibraryPerson` (`PersonID`),
 	FOREIGN KEY(`LyricistID`) REFERENCES `LibraryPerson` (`PersonID`),
@@ -195,6 +219,32 @@ CREATE TABLE `LibraryItem` (
 	FOREIGN KEY(`HandbellEnsembleID`) REFERENCES `LibraryHandbellEnsemble` (`LookupID`),
 	FOREIGN KEY(`CollectionID`) REFERENCES `LibraryItem` (`ItemID`)
 );
+CREATE INDEX `LibraryItemCollection` ON `LibraryItem` (`CollectionID`);
+CREATE INDEX `LibraryItemSortKey` ON `LibraryItem` (`SortKey`);
+CREATE INDEX `LibraryItemAccompaniment` ON `LibraryItem` (`AccompanimentID`);
+CREATE INDEX `LibraryItemAlto` ON `LibraryItem` (`AltoID`);
+CREATE INDEX `LibraryItemArrangement` ON `LibraryItem` (`ArrangementID`);
+CREATE INDEX `LibraryItemArranger` ON `LibraryItem` (`ArrangerID`);
+CREATE INDEX `LibraryItemBass` ON `LibraryItem` (`BassID`);
+CREATE INDEX `LibraryItemComposer` ON `LibraryItem` (`ComposerID`);
+CREATE INDEX `LibraryItemHandbellEnsemble` ON `LibraryItem` (`HandbellEnsembleID`);
+CREATE INDEX `LibraryItemKey` ON `LibraryItem` (`KeyID`);
+CREATE INDEX `LibraryItemLyricist` ON `LibraryItem` (`LyricistID`);
+CREATE INDEX `LibraryItemOwner` ON `LibraryItem` (`OwnerID`);
+CREATE INDEX `LibraryItemPublisher` ON `LibraryItem` (`PublisherID`);
+CREATE INDEX `LibraryItemSeason` ON `LibraryItem` (`SeasonID`);
+CREATE INDEX `LibraryItemSkill` ON `LibraryItem` (`SkillID`);
+CREATE INDEX `LibraryItemSoprano` ON `LibraryItem` (`SopranoID`);
+CREATE INDEX `LibraryItemSupplier` ON `LibraryItem` (`SupplierID`);
+CREATE INDEX `LibraryItemTenor` ON `LibraryItem` (`TenorID`);
+CREATE TABLE `LibraryItemSearch` (
+	`ItemID` INTEGER NOT NULL,
+	`Titles` TEXT,
+	`Creators` TEXT,
+	PRIMARY KEY (`ItemID`),
+	FULLTEXT (`Titles`),
+	FULLTEXT (`Creators`)
+);
 CREATE TABLE `LibraryInventory` (
 	`InventoryID` INTEGER NOT NULL AUTO_INCREMENT,
 	`LibraryItem` INTEGER NOT NULL,
@@ -207,6 +257,7 @@ CREATE TABLE `LibraryInventory` (
 	PRIMARY KEY (`InventoryID`),
 	FOREIGN KEY(`LibraryItem`) REFERENCES `LibraryItem` (`ItemID`)
 );
+CREATE INDEX `LibraryInventoryItem` ON `LibraryInventory` (`LibraryItem`);
 CREATE TABLE `LibraryLoan` (
 	`LoanID` INTEGER NOT NULL AUTO_INCREMENT,
 	`LibraryItem` INTEGER NOT NULL,
@@ -217,6 +268,7 @@ CREATE TABLE `LibraryLoan` (
 	PRIMARY KEY (`LoanID`),
 	FOREIGN KEY(`LibraryItem`) REFERENCES `LibraryItem` (`ItemID`)
 );
+CREATE INDEX `LibraryLoanItem` ON `LibraryLoan` (`LibraryItem`, `LoanReturned`);
 CREATE TABLE `LibraryPart` (
 	`PartID` INTEGER NOT NULL AUTO_INCREMENT,
 	`LibraryItem` INTEGER NOT NULL,
@@ -230,6 +282,7 @@ CREATE TABLE `LibraryPart` (
 	PRIMARY KEY (`PartID`),
 	FOREIGN KEY(`LibraryItem`) REFERENCES `LibraryItem` (`ItemID`)
 );
+CREATE INDEX `LibraryPartItem` ON `LibraryPart` (`LibraryItem`);
 CREATE TABLE `LibraryPerformance` (
 	`PerformanceID` INTEGER NOT NULL AUTO_INCREMENT,
 	`PerformanceDate` DATE NOT NULL,
@@ -238,3 +291,12 @@ CREATE TABLE `LibraryPerformance` (
 	PRIMARY KEY (`PerformanceID`),
 	FOREIGN KEY(`LibraryItem`) REFERENCES `LibraryItem` (`ItemID`)
 );
+CREATE INDEX `LibraryPerformanceItem` ON `LibraryPerformance` (`LibraryItem`);
+CREATE TABLE `LibraryItemSummary` (
+	`ItemID` INTEGER NOT NULL,
+	`InventoryID` INTEGER,
+	`CopiesOnHand` INTEGER,
+	`LastPerformance` DATE,
+	`OnLoan` INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY (`ItemID`)
+);
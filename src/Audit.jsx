@@ -7,19 +7,45 @@ import React, { useEffect, useState } from 'react';
 import { Table } from 'react-bootstrap';
 import { toast } from 'react-toastify';
 
+const PAGE_SIZE = 100;
+
 const Audit = (props) => {
   const cols = ['When', 'What', 'Who', 'Table', 'Row Key'];
+  const fields = [
+    ['who', 'User', 'text'],
+    ['table', 'Table', 'text'],
+    ['action', 'Action', 'text'],
+    ['from', 'From', 'date'],
+    ['to', 'To', 'date'],
+  ];
   const [loading, setLoading] = useState(true);
-  const [rows, setRows] = useState(null);
-  const fetchAuditTrail = async () => {
-    const parms = props.debugging ? '?debug=true' : '';
+  const [rows, setRows] = useState([]);
+  const [next, setNext] = useState(null);
+  const [filters, setFilters] = useState({});
+  const [applied, setApplied] = useState({});
+
+  // Fetch a page of the audit trail, starting after the cursor (if any).
+  const fetchAuditTrail = async (after) => {
+    const parms = new URLSearchParams({ limit: PAGE_SIZE });
+    Object.entries(applied).forEach(([name, value]) => {
+      if (value.trim()) {
+        parms.set(name, value.trim());
+      }
+    });
+    if (after) {
+      parms.set('after', after);
+    }
+    if (props.debugging) {
+      parms.set('debug', 'true');
+    }
     try {
-      const response = await fetch(`/library/api/audit${parms}`);
+      const response = await fetch(`/library/api/audit?${parms}`);
       if (!response.ok) {
         throw new Error('Network error');
       }
       const data = await response.json();
-      setRows(data);
+      setRows(prevRows => after ? [...prevRows, ...data.rows] : data.rows);
+      setNext(data.next);
     } catch (error) {
       console.error(error);
       toast.error(`Failure loading audit trail records: ${error.message}`);
@@ -27,11 +53,24 @@ const Audit = (props) => {
       setLoading(false);
     }
   };
-  // Load the login accounts for the site.
+
+  // Load the first page, and start over when the filters change.
   useEffect(() => {
     setLoading(true);
-    fetchAuditTrail();
-  }, []);
+    fetchAuditTrail(null);
+  }, [applied]);
+
+  // Keep track of the current filter values.
+  const handleChange = (e) => {
+    const { name, value } = e.target;
+    setFilters(prevState => ({ ...prevState, [name]: value }));
+  };
+
+  const handleSubmit = (e) => {
+    e.preventDefault();
+    setApplied(filters);
+  };
+
   if (loading) {
     return <div>Loading...</div>;
   }
@@ -39,6 +78,26 @@ const Audit = (props) => {
   return (
     <>
       <h1>Audit Trail</h1>
+      <form onSubmit={handleSubmit}>
+        <div className="row">
+          {fields.map(([name, label, type]) => (
+            <div className="col-md" key={name}>
+              <div className="mb-3">
+                <label htmlFor={name} className="form-label">{label}</label>
+                <input type={type}
+                       className="form-control"
+                       id={name}
+                       name={name}
+                       value={filters[name] || ''}
+                       onChange={handleChange} />
+              </div>
+            </div>
+          ))}
+        </div>
+        <div className="d-flex justify-content-start mb-3">
+          <button type="submit" className="btn btn-primary">Filter</button>
+        </div>
+      </form>
       <Table size="sm" responsive>
         <thead>
           <tr>
@@ -46,8 +105,8 @@ const Audit = (props) => {
           </tr>
         </thead>
         <tbody>
-          {rows.map((row, key) => (
-            <tr key={key}>
+          {rows.map(row => (
+            <tr key={row.AuditID}>
               <td>{row.AuditWhen}</td>
               <td>{row.AuditAction}</td>
               <td>{row.AuditWho}</td>
@@ -57,6 +116,11 @@ const Audit = (props) => {
           ))}
         </tbody>
       </Table>
+      {next && (
+        <button type="button"
+                className="btn btn-secondary"
+                onClick={() => fetchAuditTrail(next)}>More</button>
+      )}
     </>
   );
 };
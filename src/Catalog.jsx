@@ -3,7 +3,7 @@
  * @author Bob Kline
  * @date 2024-11-08
  */
-import React, { useEffect, useState } from 'react';
+import React, { useEffect, useRef, useState } from 'react';
 import { toast } from 'react-toastify';
 import EditForm from './EditForm';
 import SearchForm from './SearchForm';
@@ -18,6 +18,7 @@ const Catalog = (props) => {
   const [totalRecords, setTotalRecords] = useState([]);
   const [editingRecord, setEditingRecord] = useState(false);
   const [editRecord, setEditRecord] = useState(null);
+  const cursors = useRef({});
   const pageSize = 10;
 
   // Fetch the row data for the current page.
@@ -33,7 +34,11 @@ const Catalog = (props) => {
       });
       params.set('limit', pageSize);
       if (page > 1) {
-        params.set('offset', pageSize * (page - 1));
+        const cursor = cursors.current[page];
+        if (cursor)
+          params.set('after', cursor);
+        else
+          params.set('offset', pageSize * (page - 1));
       }
       if (props.debugging) {
         params.set('debug', 'true');
@@ -42,12 +47,23 @@ const Catalog = (props) => {
       const response = await fetch(url);
       const responseValues = await response.json();
       setRecords(responseValues.results);
-      setTotalRecords(responseValues.total);
-      if (!responseValues.total)
-        toast.warn('No matching records found.');
+      if (responseValues.next)
+        cursors.current[page + 1] = responseValues.next;
+      if ('total' in responseValues) {
+        setTotalRecords(responseValues.total);
+        if (!responseValues.total)
+          toast.warn('No matching records found.');
+      }
     }
   };
 
+  // Start a new search from the first page.
+  const handleSearch = (newFilters) => {
+    cursors.current = {};
+    setPage(1);
+    setFilters(newFilters);
+  };
+
   // Save a new or changed record.
   const handleSave = async (record) => {
     const method = record.ItemID ? 'PUT' : 'POST';
@@ -103,6 +119,7 @@ const Catalog = (props) => {
     if (data.status === 'success') {
       const newTotalRecords = totalRecords - 1;
       const totalPages = Math.ceil((newTotalRecords) / pageSize);
+      setTotalRecords(newTotalRecords);
       if (page > totalPages) {
         setPage(totalPages);
       }
@@ -142,7 +159,7 @@ const Catalog = (props) => {
     <>
       <SearchForm
         filters={filters}
-        setFilters={setFilters}
+        setFilters={handleSearch}
         onAddNew={handleAddNew}
         user={props.user}
       />
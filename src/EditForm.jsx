@@ -26,33 +26,26 @@ const EditForm = (props) => {
   // Load the picklists for controlled-value fields.
   useEffect(() => {
     const fetchPicklists = async () => {
-      const values = {};
-      const parms = props.debugging ? '?debug=true' : '';
-      const done = [];
+      const names = [];
+      props.config.fieldsets.forEach(fieldset =>
+        fieldset.rows.forEach(row =>
+          row.forEach(field => {
+            if (field.picklist && !names.includes(field.picklist))
+              names.push(field.picklist);
+          })
+        )
+      );
+      const params = new URLSearchParams({ names: names.join(',') });
+      if (props.debugging) {
+        params.set('debug', 'true');
+      }
+      const url = `/library/api/picklists?${params.toString()}`;
       try {
-        const promises = props.config.fieldsets.flatMap(fieldset =>
-          fieldset.rows.flatMap(row =>
-            row.filter(field =>
-              field.picklist && !done.includes(field.picklist)
-            ).map(async field => {
-              done.push(field.picklist);
-              const url = `/library/api/${field.picklist}${parms}`;
-              try {
-                const response = await fetch(url);
-                if (!response.ok) {
-                  throw new Error(`Network error for ${url}`);
-                }
-                const data = await response.json();
-                values[field.picklist] = data;
-              } catch (error) {
-                console.error(url, error);
-                throw error;
-              }
-            })
-          )
-        );
-        await Promise.all(promises);
-        setPicklists(values);
+        const response = await fetch(url);
+        if (!response.ok) {
+          throw new Error(`Network error for ${url}`);
+        }
+        setPicklists(await response.json());
       } catch (error) {
         console.error("Error fetching picklists:", error);
         toast.error('Unable to load picklists for editing form.');
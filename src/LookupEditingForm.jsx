@@ -41,24 +41,16 @@ const LookupEditingForm = (props) => {
     });
     if (names.length > 0) {
       const fetchPicklists = async () => {
-        const values = {};
-        const parms = props.debugging ? '?debug=true' : '';
-        const promises = names.map(async name => {
-          try {
-            const response = await fetch(`/library/api/${name}${parms}`);
-            if (!response.ok) {
-              throw new Error('Network error');
-            }
-            const data = await response.json();
-            values[name] = data;
-          } catch (error) {
-            console.error('Error fetching picklist:', error);
-            throw error;
-          }
-        });
+        const params = new URLSearchParams({ names: names.join(',') });
+        if (props.debugging) {
+          params.set('debug', 'true');
+        }
         try {
-          await Promise.all(promises);
-          setPicklists(values);
+          const response = await fetch(`/library/api/picklists?${params}`);
+          if (!response.ok) {
+            throw new Error('Network error');
+          }
+          setPicklists(await response.json());
         } catch (error) {
           toast.error('Failure loading picklists.');
           console.error("Error fetching picklists:", error);
@@ -66,7 +58,7 @@ const LookupEditingForm = (props) => {
           setLoading(false);
         }
       };
-      fetchPicklists(names);
+      fetchPicklists();
     } else {
       setLoading(false);
     }
@@ -10,42 +10,55 @@ import './print.css';
 
 const Print = (props) => {
   const { id } = useParams();
-  const [ record, setRecord ] = useState(null);
+  const [ records, setRecords ] = useState([]);
   const [ loading, setLoading ] = useState(true);
 
-  const fetchRecord = async (recid) => {
-    const debug = props.debugging ? '?debug=true' : '';
-    const response = await fetch(`/library/api/print/${recid}${debug}`);
+  // A comma-separated list of IDs prints the items one per page.
+  const fetchRecords = async (ids) => {
+    const params = new URLSearchParams();
+    if (props.debugging) {
+      params.set('debug', 'true');
+    }
+    let url = `/library/api/print/${ids}?${params}`;
+    if (ids.includes(',')) {
+      params.set('ids', ids);
+      url = `/library/api/print?${params}`;
+    }
+    const response = await fetch(url);
     const values = await response.json();
-    setRecord(values);
+    setRecords(values.items ?? [values]);
     setLoading(false);
   };
-  useEffect(() => { fetchRecord(id); }, []);
+  useEffect(() => { fetchRecords(id); }, []);
   if (loading) { return <p>Loading ...</p>; }
 
   return (
-    <div className="print mt-5">
-      <h1 className="text-center fs-4">
-        {record.title} [item ID {id}]
-      </h1>
-      <Table size="sm" borderless>
-        <tbody>
-          {record.blocks.map((block, blockIndex) => (
-            <React.Fragment key={blockIndex}>
-              <tr key={`block-${blockIndex}`}>
-                <th colSpan="2" className="group">{block.label}</th>
-              </tr>
-              {block.values.map((value, valueIndex) => (
-                <tr key={`value-${blockIndex}-${valueIndex}`}>
-                  <th className="text-end">{value.label}</th>
-                  <td>{value.display}</td>
-                </tr>
+    <>
+      {records.map(record => (
+        <div className="print mt-5" key={record.id}>
+          <h1 className="text-center fs-4">
+            {record.title} [item ID {record.id}]
+          </h1>
+          <Table size="sm" borderless>
+            <tbody>
+              {(record.blocks ?? []).map((block, blockIndex) => (
+                <React.Fragment key={blockIndex}>
+                  <tr key={`block-${blockIndex}`}>
+                    <th colSpan="2" className="group">{block.label}</th>
+                  </tr>
+                  {block.values.map((value, valueIndex) => (
+                    <tr key={`value-${blockIndex}-${valueIndex}`}>
+                      <th className="text-end">{value.label}</th>
+                      <td>{value.display}</td>
+                    </tr>
+                  ))}
+                </React.Fragment>
               ))}
-            </React.Fragment>
-          ))}
-        </tbody>
-      </Table>
-    </div>
+            </tbody>
+          </Table>
+        </div>
+      ))}
+    </>
   );
 };
 
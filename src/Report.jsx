@@ -8,34 +8,60 @@ import { Table } from 'react-bootstrap';
 import { useParams } from 'react-router-dom';
 import { toast } from 'react-toastify';
 
+const POLL_INTERVAL = 2000;
+
 const Report = (props) => {
   const [report, setReport] = useState(null);
+  const [progress, setProgress] = useState(null);
   const [waiting, setWaiting] = useState(true);
   const { request } = useParams();
   const debugging = props.debugging ? '?debug=true' : '';
   useEffect(() => {
+    let timer = null;
+
+    // A 202 response means the report is still queued or running in
+    // the background, so we check again in a little while.
     const fetchReport = async () => {
       const url = `/library/api/report/${request}${debugging}`;
       try {
         const response = await fetch(url);
         const data = await response.json();
+        if (response.status === 202) {
+          setProgress(data);
+          timer = setTimeout(fetchReport, POLL_INTERVAL);
+          return;
+        }
+        if (!response.ok) {
+          throw new Error(data.message ?? 'Network error');
+        }
         setReport(data);
       } catch (error) {
         console.error(error);
-        toast.error(`Report failure: ${error}`);
-      } finally {
-        setWaiting(false);
+        toast.error(`Report failure: ${error.message}`);
       }
+      setWaiting(false);
     };
     fetchReport();
+    return () => clearTimeout(timer);
   }, []);
   if (waiting) {
+    if (progress) {
+      const seconds = Math.round(progress.elapsed);
+      const state = progress.request_status === 'queued' ?
+            `queued for ${seconds} seconds` :
+            `${progress.progress}% done after ${seconds} seconds`;
+      return <div>Waiting ... (report {state})</div>
+    }
     return <div>Waiting ...</div>
   }
+  if (!report) {
+    return <div>The report could not be produced.</div>
+  }
   const elapsed = report.elapsed.toFixed(3);
   const rows = report.rows.length;
   const { user } = props;
-  const footer = `${rows} rows in ${elapsed} seconds for ${user.fullname}`;
+  const cached = report.cached ? ' (from cache)' : '';
+  const footer = `${rows} rows in ${elapsed} seconds${cached} for ${user.fullname}`;
   return (
     <>
       <h1>{report.title}</h1>
@@ -10,6 +10,8 @@ import { toast } from 'react-toastify';
 import SortableTypeahead from './SortableTypeahead';
 import validateForm from './utils';
 
+const POLL_INTERVAL = 2000;
+
 const Reports = (props) => {
   const reportConfig = props.config.report;
   const defaults = {};
@@ -42,27 +44,19 @@ const Reports = (props) => {
   // Load the picklists for controlled-value fields.
   useEffect(() => {
     const fetchPicklists = async () => {
-      const values = {};
       const slugs = [
         'arrangement', 'keyword', 'tag', 'season', 'user', 'owner',
       ];
-      const parms = props.debugging ? '?debug=true' : '';
-      const promises = slugs.map(async slug => {
-        try {
-          const response = await fetch(`/library/api/${slug}${parms}`);
-          if (!response.ok) {
-            throw new Error('Network error');
-          }
-          const data = await response.json();
-          values[slug] = data;
-        } catch (error) {
-          console.error('Error fetching picklist:', error);
-          throw error;
-        }
-      });
+      const params = new URLSearchParams({ names: slugs.join(',') });
+      if (props.debugging) {
+        params.set('debug', 'true');
+      }
       try {
-        await Promise.all(promises);
-        setPicklists(values);
+        const response = await fetch(`/library/api/picklists?${params}`);
+        if (!response.ok) {
+          throw new Error('Network error');
+        }
+        setPicklists(await response.json());
       } catch (error) {
         console.error("Error fetching picklists:", error);
       } finally {
@@ -130,16 +124,26 @@ const Reports = (props) => {
       }
       const data = await response.json();
       const requestId = data.request_id;
-      if (request.parms['report-format'] === 'excel') {
+      const format = request.parms['report-format'] ?? 'html';
+      if (format !== 'html') {
         const url = `/library/api/report/${requestId}${parms}`;
+        const extension = format === 'excel' ? 'xlsx' : format;
         try {
-          const excelResponse = await fetch(url);
+          let excelResponse = await fetch(url);
+          if (excelResponse.status === 202) {
+            toast.info('Report queued; it will download when ready.');
+          }
+          while (excelResponse.status === 202) {
+            await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL));
+            excelResponse = await fetch(url);
+          }
           if (!excelResponse.ok) {
-            console.error('Excel report failure:', excelResponse);
+            console.error('Report download failure:', excelResponse);
             throw new Error('Network error');
           }
           const blob = await excelResponse.blob();
-          const fn = excelResponse.headers.get('x-filename') || 'report.xlsx';
+          const fn = excelResponse.headers.get('x-filename') ||
+                     `report.${extension}`;
           const link = document.createElement('a');
           link.href = window.URL.createObjectURL(blob);
           link.setAttribute('download', fn);
@@ -148,8 +152,8 @@ const Reports = (props) => {
           document.body.removeChild(link);
           toast.success(`Report ${fn} ready.`);
         } catch (error) {
-          console.error('failure generating Excel report:', error);
-          toast.error('Failure generating Excel report.');
+          console.error(`failure generating ${format} report:`, error);
+          toast.error('Failure generating report file.');
         }
       } else {
         const reportUrl = `/library/report/${requestId}${parms}`;
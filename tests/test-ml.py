@@ -13,22 +13,32 @@ The most efficient way to run the tests involves launching Chrome
 for Testing before invoking the test script.
 
 Finally, you will need to supply the credentials for an account that
-has write access to the Music Library Catalog.
+has write access to the Music Library Catalog. The API tests (bulk
+import and so on) also need that account to have administrative access.
 
 With a perfect test suite, any of the tests could be run independently.
 However, some of the other tests assume that the first test has been run,
 creating a test item.
+
+With --soak the browser tests are skipped. Instead, the requested number
+of concurrent writers hammer the API with item and lookup value edits
+(each writer cleaning up after itself), and a summary of the lock waits,
+retries, and failed writes is reported. This is intended for a local
+(for example, Docker) instance using SQLite, so --base is required.
 """
 
 from argparse import ArgumentParser
 from base64 import b64decode
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from functools import cached_property
 from io import BytesIO
+from json import dumps as json_dumps
 from logging import getLogger, Formatter, FileHandler
 from re import compile as re_compile
-from sys import argv
-from time import sleep
+from sys import argv, exit
+from threading import Lock
+from time import perf_counter, sleep
 from unittest import TestCase, main
 from openpyxl import load_workbook
 from requests import Session
@@ -1528,6 +1538,322 @@ class Tests(TestCase):
             sleep(1)
 
 
+class APITests(TestCase):
+    """Checks of API endpoints which have no user interface of their own"""
+
+    IMPORT_TITLE = "Test Import Item"
+
+    def setUp(self):
+        """Log in to the API (no browser is needed for these tests)."""
+
+        self.started = datetime.now()
+        self.session = self.login(Tests.USERNAME, Tests.PASSWORD)
+
+    def tearDown(self):
+        """Remove anything the test created."""
+
+        for item_id in self.item_ids:
+            self.session.delete(f"{self.api}/music/{item_id}")
+        for account_id in self.account_ids:
+            self.session.delete(f"{self.api}/account/{account_id}")
+        elapsed = datetime.now() - self.started
+        method_name = self.id().split(".")[2]
+        Tests.LOGGER.info("%s elapsed for %s", elapsed, method_name)
+
+    @cached_property
+    def account_ids(self):
+        """Accounts created by the current test."""
+        return []
+
+    @cached_property
+    def api(self):
+        """Base URL for the API."""
+        return f"{Tests.BASE}/library/api"
+
+    @cached_property
+    def item_ids(self):
+        """Catalog items created by the current test."""
+        return []
+
+    def fetch_audit_rows(self, **params):
+        """Fetch every page of the audit trail matching some filters.
+
+        Optional keyword arguments:
+          params - filters (and the page size) for the audit trail
+
+        Return:
+          list of audit row dictionaries, newest first
+        """
+
+        rows = []
+        url = f"{self.api}/audit"
+        while True:
+            body = self.session.get(url, params=params).json()
+            self.assertEqual(body["status"], "success")
+            rows.extend(body["rows"])
+            if not body["next"]:
+                return rows
+            params["after"] = body["next"]
+
+    def import_items(self, lines, session=None):
+        """Submit items for bulk import as NDJSON.
+
+        Required positional argument:
+          lines - sequence of items (dictionaries) or raw strings
+
+        Optional keyword argument:
+          session - logged-in session to use (default is the admin's)
+
+        Return:
+          requests Response object
+        """
+
+        body = "\n".join(
+            line if isinstance(line, str) else json_dumps(line)
+            for line in lines
+        )
+        headers = {"Content-Type": "application/x-ndjson"}
+        session = session or self.session
+        url = f"{self.api}/import"
+        data = body.encode("utf-8")
+        response = session.post(url, data=data, headers=headers)
+        if response.ok:
+            self.item_ids.extend(response.json()["ids"])
+        return response
+
+    def login(self, username, password):
+        """Create a new API session for an account."""
+
+        session = Session()
+        credentials = dict(username=username, password=password)
+        response = session.post(f"{self.api}/session", json=credentials)
+        self.assertEqual(response.json()["status"], "success")
+        return session
+
+    def test_01_import(self):
+        """Import a mix of good and bad items."""
+
+        lines = [
+            dict(ItemTitle=f"{self.IMPORT_TITLE} One", IsCollection="N"),
+            "this is not JSON",
+            dict(OtherTitle="Missing Title", IsCollection="N"),
+            dict(ItemTitle=f"{self.IMPORT_TITLE} Two", IsCollection="N"),
+        ]
+        response = self.import_items(lines)
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(body["status"], "partial")
+        self.assertEqual(body["imported"], 2)
+        self.assertEqual(len(body["ids"]), 2)
+        self.assertEqual([error["row"] for error in body["errors"]], [2, 3])
+        for error in body["errors"]:
+            self.assertTrue(error["error"])
+        params = dict(title=self.IMPORT_TITLE)
+        response = self.session.get(f"{self.api}/music", params=params)
+        found = {item["id"] for item in response.json()["results"]}
+        self.assertTrue(set(body["ids"]) <= found)
+        url = f"{self.api}/music/{body['ids'][1]}"
+        item = self.session.get(url).json()
+        self.assertEqual(item["ItemTitle"], f"{self.IMPORT_TITLE} Two")
+
+    def test_02_import_requires_admin(self):
+        """Make sure only administrators can import items."""
+
+        username = "apitest"
+        password = "Api Test Password 1!"
+        account = dict(
+            account_name=username,
+            account_fullname="API Test Account",
+            account_password=password,
+            account_comment="Created by the API tests",
+            account_admin=False,
+            account_readonly=False,
+            account_status="Active",
+        )
+        url = f"{self.api}/account"
+        body = self.session.post(url, json=account).json()
+        self.assertEqual(body["status"], "success")
+        self.account_ids.append(body["account_id"])
+        session = self.login(username, password)
+        title = f"{self.IMPORT_TITLE} Forbidden"
+        item = dict(ItemTitle=title, IsCollection="N")
+        response = self.import_items([item], session)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()["status"], "failure")
+
+    def test_03_audit_trail(self):
+        """Page through and filter the audit trail."""
+
+        lines = [
+            dict(ItemTitle=f"{self.IMPORT_TITLE} {n}", IsCollection="N")
+            for n in range(1, 6)
+        ]
+        body = self.import_items(lines).json()
+        self.assertEqual(body["status"], "success")
+        ids = set(body["ids"])
+        filters = dict(who=Tests.USERNAME, table="LibraryItem", action="IMP")
+        rows = self.fetch_audit_rows(limit=1000, **filters)
+        ours = [row for row in rows if int(row["AuditKey"]) in ids]
+        self.assertEqual(len(ours), len(ids))
+        for row in rows:
+            self.assertEqual(row["AuditWho"], Tests.USERNAME)
+            self.assertEqual(row["AuditTable"], "LibraryItem")
+            self.assertTrue(row["AuditAction"].startswith("IMP"))
+        for row in ours:
+            self.assertEqual(row["AuditAction"], "IMPORT")
+
+        # Small pages must add up to the same rows as one big page.
+        day = ours[0]["AuditWhen"][:10]
+        filters.update({"from": day, "to": day})
+        everything = self.fetch_audit_rows(limit=1000, **filters)
+        paged = self.fetch_audit_rows(limit=2, **filters)
+        self.assertEqual(
+            [int(row["AuditID"]) for row in paged],
+            [int(row["AuditID"]) for row in everything],
+        )
+        self.assertTrue(ids <= {int(row["AuditKey"]) for row in everything})
+
+        # The end of the date range is inclusive.
+        filters["to"] = day
+        filters["from"] = "2000-01-01"
+        rows = self.fetch_audit_rows(limit=1000, **filters)
+        self.assertTrue(ids <= {int(row["AuditKey"]) for row in rows})
+        previous = date.fromisoformat(day) - timedelta(days=1)
+        filters["to"] = str(previous)
+        rows = self.fetch_audit_rows(limit=1000, **filters)
+        self.assertFalse(ids & {int(row["AuditKey"]) for row in rows})
+
+        # Dates which don't exist are rejected.
+        for name in ("from", "to"):
+            params = {name: "2024-02-30"}
+            response = self.session.get(f"{self.api}/audit", params=params)
+            self.assertEqual(response.status_code, 400)
+            body = response.json()
+            self.assertEqual(body["status"], "failure")
+            self.assertIn(name, body["message"])
+
+
+class SoakTest:
+    """Concurrent writers exercising the API's write transactions."""
+
+    CONTENTION = re_compile(r"retries=(\d+), wait=([\d.]+)")
+
+    def __init__(self, base, username, password, writers, writes):
+        """Capture the options for the run."""
+
+        self.api = f"{base}/library/api"
+        self.username = username
+        self.password = password
+        self.writers = writers
+        self.writes = writes
+        self.lock = Lock()
+        self.results = {}
+
+    def run(self):
+        """Start the writers, wait for them to finish, and report."""
+
+        Tests.LOGGER.info(
+            "soak test: %d writers x %d writes against %s",
+            self.writers,
+            self.writes,
+            self.api,
+        )
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.writers) as executor:
+            list(executor.map(self.writer, range(self.writers)))
+        elapsed = perf_counter() - started
+        failures = 0
+        print(f"{'operation':<16}{'count':>7}{'failed':>8}{'retries':>9}"
+              f"{'wait':>9}{'p50':>8}{'p95':>8}{'max':>8}")
+        for name, results in sorted(self.results.items()):
+            times = sorted(result["elapsed"] for result in results)
+            failed = sum(1 for result in results if not result["ok"])
+            retries = sum(result["retries"] for result in results)
+            wait = sum(result["wait"] for result in results)
+            p50 = times[len(times) // 2]
+            p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+            print(f"{name:<16}{len(results):>7}{failed:>8}{retries:>9}"
+                  f"{wait:>9.3f}{p50:>8.3f}{p95:>8.3f}{times[-1]:>8.3f}")
+            Tests.LOGGER.info(
+                "soak %s: count=%d failed=%d retries=%d wait=%.3f "
+                "p50=%.3f p95=%.3f max=%.3f",
+                name, len(results), failed, retries, wait,
+                p50, p95, times[-1],
+            )
+            failures += failed
+        print(f"{failures} failed writes in {elapsed:.1f} seconds")
+        return failures
+
+    def record(self, name, response, started):
+        """Remember how a request fared, returning its parsed body."""
+
+        elapsed = perf_counter() - started
+        retries, wait = 0, 0.0
+        header = response.headers.get("X-Write-Contention", "")
+        match = self.CONTENTION.search(header)
+        if match:
+            retries, wait = int(match.group(1)), float(match.group(2))
+        ok = response.ok
+        try:
+            body = response.json()
+            ok = ok and body.get("status") == "success"
+        except Exception:
+            body = {}
+            ok = False
+        if not ok:
+            Tests.LOGGER.warning(
+                "%s failed (%d): %s",
+                name,
+                response.status_code,
+                body.get("message") or response.text[:200],
+            )
+        result = dict(elapsed=elapsed, ok=ok, retries=retries, wait=wait)
+        with self.lock:
+            self.results.setdefault(name, []).append(result)
+        return body
+
+    def send(self, session, name, method, path, payload=None):
+        """Submit a single API request and record the outcome."""
+
+        started = perf_counter()
+        url = f"{self.api}/{path}"
+        response = session.request(method, url, json=payload)
+        return self.record(name, response, started)
+
+    def writer(self, number):
+        """Create, modify, and remove records as fast as we can."""
+
+        session = Session()
+        credentials = dict(username=self.username, password=self.password)
+        url = f"{self.api}/session"
+        if session.post(url, json=credentials).json()["status"] != "success":
+            raise Exception("soak test login failed")
+        for i in range(self.writes):
+            title = f"Soak Test Item {number}-{i}"
+            item = dict(
+                ItemTitle=title,
+                IsCollection="N",
+                Inventories=[dict(InStock=i, InStockDate="2025-01-01")],
+                Performances=[dict(PerformanceDate="2025-01-01")],
+            )
+            body = self.send(session, "item post", "POST", "music", item)
+            item_id = body.get("ItemID")
+            value = f"Soak Keyword {number}-{i}"
+            keyword = dict(LookupValue=value, Comments=None)
+            body = self.send(session, "lookup post", "POST", "keyword", keyword)
+            keyword_id = body.get("id")
+            if item_id:
+                item["ItemTitle"] = f"{title} (revised)"
+                if keyword_id:
+                    item["Keywords"] = [keyword_id]
+                path = f"music/{item_id}"
+                self.send(session, "item put", "PUT", path, item)
+                self.send(session, "item delete", "DELETE", path)
+            if keyword_id:
+                path = f"keyword/{keyword_id}"
+                self.send(session, "lookup delete", "DELETE", path)
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--username", "-u", required=True)
@@ -1535,7 +1861,15 @@ if __name__ == "__main__":
     parser.add_argument("--base", "-b")
     parser.add_argument("--verbose", "-v", action="store_true")
     parser.add_argument("--tests", "-t", nargs="*")
+    parser.add_argument("--soak", type=int, metavar="WRITERS")
+    parser.add_argument("--soak-writes", type=int, default=25)
     opts = parser.parse_args()
+    if opts.soak:
+        if not opts.base:
+            parser.error("--soak requires --base (use a local test server)")
+        args = opts.base, opts.username, opts.password
+        soak = SoakTest(*args, opts.soak, opts.soak_writes)
+        exit(1 if soak.run() else 0)
     Tests.USERNAME = opts.username
     Tests.PASSWORD = opts.password
     if opts.base: